@@ -0,0 +1,64 @@
+import time
+import argparse
+import numpy as np
+import point_set_dataloader as dl
+import data_management.hdf5_helpers as h5h
+
+parser = argparse.ArgumentParser(
+    description='Times per-window preparation in MidiNoteTupleDataset, excluding disk reads.')
+parser.add_argument('dset_path', help='hdf5 file made by make_lmd_hdf5.py.')
+parser.add_argument('-b', '--base', default='train', help='Group within the hdf5 file to read from.')
+parser.add_argument('-n', '--num_songs', type=int, default=200, help='Number of songs to use.')
+parser.add_argument('-s', '--seq_length', type=int, default=512, help='Window length.')
+parser.add_argument('-p', '--padding_amt', type=int, default=4, help='Padding at each end of songs.')
+args = vars(parser.parse_args())
+
+seq_length = args['seq_length']
+dset = dl.MidiNoteTupleDataset(args['dset_path'], seq_length, base=args['base'],
+                               padding_amt=args['padding_amt'], estimate_stats_batches=0,
+                               random_offsets=False, shuffle_files=False)
+dset.fnames = dset.fnames[:args['num_songs']]
+raw = {fname: h5h.read_song(dset.f, fname, dset.offsets_cache) for fname in dset.fnames}
+
+
+def old_window_prep(x):
+    '''
+    per-window preparation as MidiNoteTupleDataset used to do it, on an already-loaded file.
+    '''
+    programs = np.zeros(x.shape[0])
+    for k in dset.program_ranges.keys():
+        in_category = (k[0] < x[:, 5]) * (x[:, 5] <= k[1])
+        programs[in_category] = dset.program_ranges[k]
+    notetuples = np.concatenate([x[:, [0, 2, 3, 4]], np.expand_dims(programs, 1)], 1)
+    notetuples = notetuples[:, :dset.num_feats]
+    padded_nt = np.concatenate([dset.padding_seq, notetuples, dset.padding_seq])
+    num_seqs = int(np.floor(padded_nt.shape[0] / seq_length))
+    windows = []
+    for i in range(num_seqs):
+        seq = padded_nt[i * seq_length:(i + 1) * seq_length]
+        seq[:, 0] -= np.min(seq[:, 0])
+        windows.append(seq)
+    return windows
+
+
+def report(desc, func):
+    start_time = time.time()
+    num_windows = func()
+    elapsed = time.time() - start_time
+    print(f'{desc:40s} | {num_windows:7d} windows | {elapsed * 1e6 / max(num_windows, 1):8.2f} us/window')
+
+
+report('before: per-window loop', lambda: sum(len(old_window_prep(x)) for x in raw.values()))
+
+dset.cache = dl.NoteTupleCache(2 ** 40)
+for fname in dset.fnames:
+    dset.load_padded(fname)
+report('after: cached derived view, per file', lambda: sum(
+    len(w) for w in (dset.get_file_windows(fname) for fname in dset.fnames) if w is not None))
+
+dset.batch_size = 64
+report('after: cached derived view, batched', lambda: sum(len(b) for b in dset.iter_batches(dset.fnames)))
+
+dset.cache = None
+dset.load_resident()
+report('after: resident, batched', lambda: sum(len(b) for b in dset.iter_batches(dset.fnames)))
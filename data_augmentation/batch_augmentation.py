@@ -0,0 +1,78 @@
+# contains augmentations that take in whole collated batches of symbolic music as torch tensors of
+# shape (batch, seq_length, num_feats) and return augmented copies, on whatever device the batch
+# is on. each draws its random parameters for every sequence in the batch at once.
+
+import torch
+
+
+def transpose_batch(batch, pitch_col, max_shift, pitch_range=(1, 127)):
+    '''
+    shifts the pitches of each sequence by a random whole number of steps of at most @max_shift
+    in either direction, limited so that no note of the sequence leaves @pitch_range. only
+    entries in column @pitch_col that lie within @pitch_range (inclusive) count as notes; rests,
+    flags and padding are left alone.
+    '''
+    out = batch.clone()
+    pitches = out[..., pitch_col]
+    is_note = (pitches >= pitch_range[0]) & (pitches <= pitch_range[1])
+
+    big = torch.finfo(torch.float32).max
+    pitches_f = pitches.float()
+    lowest = torch.where(is_note, pitches_f, torch.full_like(pitches_f, big)).min(1).values
+    highest = torch.where(is_note, pitches_f, torch.full_like(pitches_f, -big)).max(1).values
+
+    # sequences without notes get a range of (0, 0), so are never shifted
+    has_notes = is_note.any(1)
+    lo = torch.where(has_notes, (pitch_range[0] - lowest).clamp(min=-max_shift), torch.zeros_like(lowest))
+    hi = torch.where(has_notes, (pitch_range[1] - highest).clamp(max=max_shift), torch.zeros_like(highest))
+
+    shifts = lo + torch.floor(torch.rand_like(lo) * (hi - lo + 1))
+    out[..., pitch_col] = torch.where(is_note, pitches + shifts[:, None].to(pitches.dtype), pitches)
+    return out
+
+
+def stretch_time(batch, time_cols, max_stretch):
+    '''
+    scales the time columns @time_cols (onsets, durations, time to next onset...) of each
+    sequence by a random factor between 1 / @max_stretch and @max_stretch, drawn uniformly in log
+    space, rounding the results to whole ticks.
+    '''
+    out = batch.clone()
+    log_max = torch.log(torch.tensor(float(max_stretch)))
+    log_factors = (torch.rand(batch.shape[0], device=batch.device) * 2 - 1) * log_max
+    factors = torch.exp(log_factors).to(out.dtype)[:, None, None]
+    out[..., time_cols] = torch.round(out[..., time_cols] * factors)
+    return out
+
+
+def permute_voices(batch, voice_col, num_voices, pitch_col=None, pitch_range=(1, 127)):
+    '''
+    relabels the voices in column @voice_col of each sequence with a random permutation of
+    0, ..., @num_voices - 1. entries outside that range (flags, padding) are left alone. if
+    @pitch_col is given, so are entries whose pitch lies outside @pitch_range, as for padding
+    rows whose voice column holds a valid voice number.
+    '''
+    out = batch.clone()
+    voices = out[..., voice_col]
+    is_voice = (voices >= 0) & (voices < num_voices)
+    if pitch_col is not None:
+        pitches = out[..., pitch_col]
+        is_voice &= (pitches >= pitch_range[0]) & (pitches <= pitch_range[1])
+
+    perms = torch.argsort(torch.rand(batch.shape[0], num_voices, device=batch.device), 1)
+    inds = torch.where(is_voice, voices, torch.zeros_like(voices)).long()
+    permuted = perms.gather(1, inds).to(voices.dtype)
+    out[..., voice_col] = torch.where(is_voice, permuted, voices)
+    return out
+
+
+def compose(*augmentations):
+    '''
+    chains augmentations, each taking and returning a batch, into a single one. use
+    functools.partial to fix the arguments of the functions above.
+    '''
+    def augment(batch):
+        for aug in augmentations:
+            batch = aug(batch)
+        return batch
+    return augment
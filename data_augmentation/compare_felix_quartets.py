@@ -2,6 +2,7 @@ import h5py
 import numpy as np
 import data_augmentation.needleman_wunsch_alignment as align
 from numba import njit
+import data_management.hdf5_helpers as h5h
 from collections import Counter
 import error_gen_logistic_regression as elgr
 
@@ -15,8 +16,8 @@ inds_subset = np.array([0, 2, 3, 4])
 with h5py.File(dset_path, 'a') as f:
     correct_fnames = [x for x in f.keys() if 'aligned' in x and 'op80' not in x]
     error_fnames = [x for x in f.keys() if 'omr' in x]
-    correct_dset = [f[x][:, inds_subset] for x in correct_fnames]
-    error_dset = [f[x][:, inds_subset] for x in error_fnames]
+    correct_dset = [h5h.read_note_array(f[x])[:, inds_subset] for x in correct_fnames]
+    error_dset = [h5h.read_note_array(f[x])[:, inds_subset] for x in error_fnames]
 
 error_notes = {x:[] for x in ['replace_mod', 'insert_mod']}
 correct_seqs_all = []
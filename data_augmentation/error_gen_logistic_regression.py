@@ -77,20 +77,35 @@ class ErrorGenerator(object):
         class_to_label = err_to_class = {0: 'O', 1: '~', 2: '+', 3: '-'}
         return ''.join(err_to_class[x] for x in labels)
 
-    def add_errors_to_batch(self, batch, parallel=1, verbose=0):
+    def add_errors_to_batch(self, batch, parallel=1, verbose=0, lengths=None):
+        '''
+        adds errors to every sequence in @batch. if @lengths is given, errors are only added to
+        the first lengths[i] entries of sequence i, and the rest is left as zero padding.
+        '''
         if not (type(batch) == np.ndarray):
             batch = batch.numpy()
         b = batch.astype('float32')
-        
+        if lengths is None:
+            seqs = [b[i] for i in range(b.shape[0])]
+        else:
+            seqs = [b[i, :int(lengths[i])] for i in range(b.shape[0])]
+
         if parallel >= 2:
             out = Parallel(n_jobs=parallel, verbose=verbose)(
-                delayed(self.add_errors_to_seq)(b[i]) for i in range(b.shape[0])
+                delayed(self.add_errors_to_seq)(x) for x in seqs
                 )
         else:
-            out = [self.add_errors_to_seq(b[i]) for i in range(b.shape[0])]
+            out = [self.add_errors_to_seq(x) for x in seqs]
 
-        X = np.stack([np.array(x[0]) for x in out], 0)
-        Y = np.stack([np.array(x[1]) for x in out], 0)
+        if lengths is None:
+            X = np.stack([np.array(x[0]) for x in out], 0)
+            Y = np.stack([np.array(x[1]) for x in out], 0)
+        else:
+            X = np.zeros(b.shape, dtype='float32')
+            Y = np.zeros(b.shape[:2], dtype='float32')
+            for i, x in enumerate(out):
+                X[i, :len(x[0])] = x[0]
+                Y[i, :len(x[1])] = x[1]
 
         return X, Y
 
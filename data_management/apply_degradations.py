@@ -22,16 +22,15 @@ def df_to_arr(inp):
 if __name__ == '__main__':
 
     import h5py
+    import data_management.hdf5_helpers as h5h
 
     dset_fname = r'essen_meertens_songs.hdf5'
     f = h5py.File(dset_fname, 'r')
 
-    fnames = []
-    for k in f.keys():
-        for n in f[k].keys():
-            fnames.append(rf'{k}/{n}')
+    # songs are compact compound datasets, or rows of packed groups
+    fnames = h5h.song_keys(f)
 
-    song = f[fnames[4]][:]
+    song = h5h.read_song(f, fnames[4])
 
     x = arr_to_df(song)
     x = degradations.pitch_shift(x)
@@ -0,0 +1,254 @@
+import time
+from collections import namedtuple
+import argparse
+from types import SimpleNamespace
+import h5py
+import numpy as np
+import point_set_dataloader as dl
+import data_management.factorizations as fcts
+import data_management.hdf5_helpers as h5h
+
+
+def arr_to_runlength_loop(arr, deltas, pitch_range, monophonic=False):
+    '''
+    event-by-event implementation of factorizations.arr_to_runlength, as a reference to check
+    the vectorized version against and to time it.
+    '''
+
+    tick_deltas_mapping = {v: i for i, v in enumerate(deltas)}
+    MIDIEvent = namedtuple("MIDIEvent", "type voice note tick")
+
+    def dict_add(dict, event):
+        if event.tick in dict.keys():
+            dict[event.tick].append(event)
+        else:
+            dict[event.tick] = [event]
+
+    events = {}
+
+    for n in arr:
+        clp_pitch = int(np.clip(n[0], pitch_range[0], pitch_range[1]))
+        start_event = MIDIEvent(
+            type='start', voice=0, note=clp_pitch, tick=n[1])
+        end_event = MIDIEvent(
+            type='end', voice=0, note=clp_pitch, tick=n[2] + n[1])
+
+        dict_add(events, start_event)
+        dict_add(events, end_event)
+
+    # structure of a change point:
+    # [1] absolute tick time of event in natural numbers
+    # [128] onset marker in {0, 1}
+    # [128] active note in {0, 1}
+
+    # alternative way is to use new arrays for each monophonic voice.
+
+    note_ons_rl = []
+    note_holds_rl = []
+    note_deltas_rl = []
+
+    num_notes = pitch_range[1] - pitch_range[0]
+    pitch_start = pitch_range[0]
+
+    sorted_events = sorted(list(events.keys()))
+
+    for i, t in enumerate(sorted_events):
+
+        note_ons = np.zeros(num_notes, dtype='int16') - 1
+        note_holds = np.zeros(num_notes, dtype='int16') - 1
+        deltas = np.zeros(len(tick_deltas_mapping))
+
+        # get length after this change point
+        try:
+            delta = sorted_events[i + 1] - t
+            delta_ind = tick_deltas_mapping[delta]
+        except IndexError:
+            # if this is at the end of the file, assign the longest possible value
+            delta_ind = -1
+        except KeyError:
+            # if this delta is uncommon, find the nearest common one
+            delta_keys = np.array(list(tick_deltas_mapping.keys()))
+            best_ind = np.argmin(np.abs(delta_keys - delta))
+            delta_ind = tick_deltas_mapping[delta_keys[best_ind]]
+
+        deltas[delta_ind] = 1
+
+        # for notes whose statuses are set directly by notes involved in the current change point,
+        # what do do is obvious:
+        for change in events[t]:
+            ind = change.note - pitch_start - 1
+            if change.type == 'start':
+                note_ons[ind] = 1
+                note_holds[ind] = 1
+            elif change.type == 'end':
+                note_ons[ind] = 0
+                note_holds[ind] = 0
+
+        # for onset-controlling indices, they're always off if not set explicitly on
+        note_ons[note_ons == -1] = 0
+
+        # for hold-controlling indices, we copy their previous state
+        try:
+            prev_note_hold = note_holds_rl[-1]
+        except IndexError:
+            prev_note_hold = np.zeros(num_notes, dtype='int16')
+
+        note_holds[note_holds == -1] = prev_note_hold[note_holds == -1]
+
+        # run_length.append(pt)
+        note_ons_rl.append(note_ons)
+        note_holds_rl.append(note_holds)
+        note_deltas_rl.append(deltas)
+
+    if monophonic:
+        new_note_holds = np.sum(np.stack(note_holds_rl), 1)
+        new_note_holds = 1 - np.clip(new_note_holds, 0, 1)
+        note_holds_rl = np.expand_dims(new_note_holds, 1)
+
+    run_length = np.concatenate([
+        np.stack(note_holds_rl),
+        np.stack(note_ons_rl),
+        np.stack(note_deltas_rl)], 1)
+
+    if monophonic:
+        assert run_length.shape[-1] == pitch_range[1] - pitch_range[0] \
+                                       + len(tick_deltas_mapping) + 1
+
+    return run_length
+
+
+def arr_to_note_tuple_loop(arr):
+    '''
+    reference implementation of factorizations.arr_to_note_tuple that sorts and fills rows one note at a time.
+    '''
+    sorted_notes = sorted(arr, key=lambda x: x[1])
+    res = np.zeros_like(arr)
+    last_onset_time = 0
+    for i, n in enumerate(sorted_notes):
+
+        # MIDI pitch
+        res[i, 0] = n[0]
+
+        # delta
+        res[i, 1] = n[1] - last_onset_time
+        last_onset_time = n[1]
+
+        # duration
+        res[i, 2] = n[2]
+    return res
+
+
+def pianoroll_to_runlength_loop(x):
+    '''
+    reference implementation of factorizations.pianoroll_to_runlength that compares timesteps one at a time.
+    '''
+    trs = [t.pianoroll for t in x.tracks if t.pianoroll.shape[0] > 0]
+    stack_pr = np.stack(trs).clip(0, 1)
+    reduced_pr = np.sum(stack_pr, 0)
+
+    # trim to minimum extent both vertically and horizontally
+    hz_proj = np.sum(reduced_pr, 1).nonzero()[0]
+    vt_proj = np.sum(reduced_pr, 0).nonzero()[0]
+    trim_pr = reduced_pr[hz_proj[0]:hz_proj[-1] + 1, vt_proj[0]:vt_proj[-1] + 1]
+
+    rl_arr = [trim_pr[0, :]]
+    deltas = []
+    sames = 0
+    last_n = 0
+    for n in range(1, trim_pr.shape[0]):
+
+        # if this timestep is the same as the last one, don't record it
+        if all(rl_arr[-1] == trim_pr[n, :]):
+            sames += 1
+            continue
+
+        # otherwise, make a new entry
+        new_entry = trim_pr[n, :]
+        rl_arr.append(new_entry)
+        deltas.append(n - last_n)
+        last_n = n
+    rl = np.stack(rl_arr)
+    deltas += [0]
+    deltas = np.expand_dims(np.array(deltas), 1)
+    rl = np.concatenate([deltas, rl], 1)
+
+    return rl
+
+
+parser = argparse.ArgumentParser(
+    description='Checks the vectorized factorizations against their reference implementations '
+                'on songs from an hdf5 file made by make_lmd_hdf5.py, and times both.')
+parser.add_argument('dset_path', help='hdf5 file made by make_lmd_hdf5.py.')
+parser.add_argument('-b', '--base', default='train', help='Group within the hdf5 file to read from.')
+parser.add_argument('-n', '--num_songs', type=int, default=50, help='Number of songs to use.')
+parser.add_argument('-d', '--num_dur_vals', type=int, default=16, help='Number of tick delta values.')
+parser.add_argument('-p', '--num_pianorolls', type=int, default=10,
+                    help='Number of songs to render as piano rolls, one frame per onset unit.')
+args = vars(parser.parse_args())
+
+with h5py.File(args['dset_path'], 'r') as f:
+    grp = f[args['base']]
+    fnames = dl.all_hdf5_keys(grp)[:args['num_songs']]
+    offsets_cache = {}
+    # lmd columns are onset, duration, time to next onset, pitch, velocity, program.
+    # the factorizations take rows of (pitch, onset, duration).
+    raw_songs = [h5h.read_song(grp, fname, offsets_cache).astype('int64') for fname in fnames]
+raw_songs = [x for x in raw_songs if x.shape[0] > 0]
+songs = [x[:, [3, 0, 1]] for x in raw_songs]
+num_notes = sum(x.shape[0] for x in songs)
+print(f'using {len(songs)} songs with {num_notes} notes from {args["dset_path"]}')
+
+all_pitches = np.concatenate([x[:, 0] for x in songs])
+pitch_range = (int(all_pitches.min()), int(all_pitches.max()))
+vals, counts = np.unique(np.concatenate([np.diff(np.unique(x[:, 1])) for x in songs]), return_counts=True)
+deltas = np.sort(vals[np.argsort(-counts)][:args['num_dur_vals']])
+
+
+
+
+def make_pianoroll(x):
+    '''
+    renders an lmd song as a pypianoroll-like object with one binary track per program.
+    '''
+    num_frames = int((x[:, 0] + x[:, 1]).max()) + 1
+    tracks = []
+    for program in np.unique(x[:, 5]):
+        notes = x[x[:, 5] == program]
+        roll = np.zeros((num_frames, 128), dtype='uint8')
+        for onset, duration, pitch in notes[:, [0, 1, 3]]:
+            roll[onset:onset + max(duration, 1), pitch] = 1
+        tracks.append(SimpleNamespace(pianoroll=roll))
+    return SimpleNamespace(tracks=tracks)
+
+
+pianorolls = [make_pianoroll(x) for x in raw_songs[:args['num_pianorolls']]]
+num_frames = sum(x.tracks[0].pianoroll.shape[0] for x in pianorolls)
+print(f'rendered {len(pianorolls)} piano rolls with {num_frames} frames '
+      f'(longest {max(x.tracks[0].pianoroll.shape[0] for x in pianorolls)})')
+
+
+def compare(desc, reference, vectorized, inputs=songs, unit='note'):
+    num_units = num_frames if unit == 'frame' else num_notes
+    start_time = time.time()
+    ref_out = [reference(x) for x in inputs]
+    ref_time = time.time() - start_time
+
+    start_time = time.time()
+    vec_out = [vectorized(x) for x in inputs]
+    vec_time = time.time() - start_time
+
+    identical = all(a.shape == b.shape and np.array_equal(a, b) for a, b in zip(ref_out, vec_out))
+    print(f'{desc:24s} | reference {ref_time * 1e6 / num_units:9.2f} us/{unit} | '
+          f'vectorized {vec_time * 1e6 / num_units:7.2f} us/{unit} | '
+          f'speedup {ref_time / vec_time:7.1f}x | identical: {identical}')
+
+
+compare('arr_to_runlength',
+        lambda x: arr_to_runlength_loop(x, deltas, pitch_range),
+        lambda x: fcts.arr_to_runlength(x, deltas, pitch_range))
+compare('arr_to_runlength (mono)',
+        lambda x: arr_to_runlength_loop(x, deltas, pitch_range, monophonic=True),
+        lambda x: fcts.arr_to_runlength(x, deltas, pitch_range, monophonic=True))
+compare('arr_to_note_tuple', arr_to_note_tuple_loop, fcts.arr_to_note_tuple)
+compare('pianoroll_to_runlength', pianoroll_to_runlength_loop, fcts.pianoroll_to_runlength,
+        inputs=pianorolls, unit='frame')
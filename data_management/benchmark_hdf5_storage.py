@@ -0,0 +1,67 @@
+import os
+import time
+import argparse
+import tempfile
+import h5py
+import numpy as np
+import point_set_dataloader as dl
+import data_management.hdf5_helpers as h5h
+
+parser = argparse.ArgumentParser(
+    description='Compares file size and read throughput of the point-set loader for different '
+                'on-disk dtypes and compression settings, using songs from an existing hdf5 file.')
+parser.add_argument('dset_path', help='hdf5 file made by make_lmd_hdf5.py.')
+parser.add_argument('-b', '--base', default='train', help='Group within the hdf5 file to read from.')
+parser.add_argument('-n', '--num_songs', type=int, default=500, help='Number of songs to copy.')
+parser.add_argument('-s', '--seq_length', type=int, default=512, help='Window length for the loader.')
+parser.add_argument('-e', '--epochs', type=int, default=3, help='Number of epochs to time.')
+args = vars(parser.parse_args())
+
+lmd_columns = ['onset', 'duration', 'next_onset', 'pitch', 'velocity', 'program']
+
+# (description, compact dtypes, compression, gzip level, chunk rows)
+settings = [
+    ('uint16 array, gzip 4', False, 'gzip', 4, None),
+    ('compact, uncompressed', True, None, 0, None),
+    ('compact, lzf', True, 'lzf', 0, None),
+    ('compact, gzip 1', True, 'gzip', 1, None),
+    ('compact, gzip 4', True, 'gzip', 4, None),
+    ('compact, gzip 9', True, 'gzip', 9, None),
+    ('compact, gzip 4, 4096-row chunks', True, 'gzip', 4, 4096),
+]
+
+with h5py.File(args['dset_path'], 'r') as f:
+    grp = f[args['base']]
+    fnames = dl.all_hdf5_keys(grp)[:args['num_songs']]
+    offsets_cache = {}
+    songs = {fname: h5h.read_song(grp, fname, offsets_cache) for fname in fnames}
+num_notes = sum(x.shape[0] for x in songs.values())
+print(f'copied {len(songs)} songs with {num_notes} notes from {args["dset_path"]}')
+
+tmp_dir = tempfile.mkdtemp()
+for desc, compact, compression, level, chunk_rows in settings:
+    fpath = os.path.join(tmp_dir, 'bench.hdf5')
+    with h5py.File(fpath, 'w') as f:
+        grp = f.create_group('train')
+        for fname, arr in songs.items():
+            name = fname.replace('/', '_')
+            if compact:
+                h5h.create_note_dataset(grp, name, arr, lmd_columns, compression, level, chunk_rows)
+            else:
+                kwargs = h5h.storage_kwargs(compression, level, chunk_rows, arr.shape[0])
+                grp.create_dataset(name, data=arr.astype('uint16'), **kwargs)
+    size_mb = os.path.getsize(fpath) / 2 ** 20
+
+    dset = dl.MidiNoteTupleDataset(fpath, args['seq_length'], base='train', estimate_stats_batches=0,
+                                   batch_size=64, random_offsets=False)
+    start_time = time.time()
+    for _ in range(args['epochs']):
+        num_windows = sum(x.shape[0] for x in dset)
+    elapsed = (time.time() - start_time) / args['epochs']
+    dset.f.file.close()
+    os.remove(fpath)
+
+    print(f'{desc:34s} | {size_mb:8.2f} MB | {elapsed:7.3f} s/epoch | '
+          f'{num_notes / elapsed:12.0f} notes/s | {num_windows / elapsed:9.0f} windows/s')
+
+os.rmdir(tmp_dir)
@@ -0,0 +1,251 @@
+import os
+import json
+import time
+import argparse
+from multiprocessing import Pool
+import numpy as np
+import h5py
+import data_management.hdf5_helpers as h5h
+
+# near-duplicate songs are found by the jaccard similarity of their sets of pitch interval
+# n-grams, estimated from minhash signatures. signatures are split into num_bands bands, and
+# songs that agree on every value of any one band become candidate pairs; with 16 bands of 8
+# rows, pairs with similarity 0.7 are caught about 99% of the time.
+splits = ['train', 'test', 'validate']
+duplicates_grp = 'duplicates'
+mersenne_prime = (1 << 61) - 1
+max_hash = (1 << 32) - 1
+
+
+def song_shingles(arr, pitch_col, ngram=5):
+    '''
+    hashes of the n-grams of @ngram consecutive pitch intervals of the note array @arr, whose
+    notes are ordered by onset. intervals make the shingles invariant to transposition. returns
+    a sorted array of unique uint32 hashes.
+    '''
+    intervals = np.clip(np.diff(arr[:, pitch_col].astype('int64')), -127, 127) + 127
+    if len(intervals) < ngram:
+        return np.zeros(0, dtype='uint64')
+
+    # each n-gram as one integer in base 255, then mixed down to 32 bits
+    windows = np.lib.stride_tricks.sliding_window_view(intervals, ngram)
+    codes = (windows * 255 ** np.arange(ngram)).sum(1).astype('uint64')
+    hashes = (codes * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)
+    return np.unique(hashes)
+
+
+def permutations(num_perm, seed=0):
+    '''
+    parameters (a, b) of the @num_perm universal hash functions used for minhash signatures.
+    '''
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, max_hash, num_perm, dtype='int64').astype('uint64')
+    b = rng.randint(0, max_hash, num_perm, dtype='int64').astype('uint64')
+    return a, b
+
+
+def minhash_signature(shingles, perms):
+    '''
+    minhash signature of the set of uint32 hashes @shingles under the hash functions @perms.
+    empty sets get a signature of all max_hash, which matches no other song's.
+    '''
+    a, b = perms
+    sig = np.full(len(a), max_hash, dtype='uint32')
+    if len(shingles) == 0:
+        return sig
+
+    # a and the shingles are below 2 ** 32, so nothing overflows. hash functions are applied a
+    # block at a time to bound memory on long songs.
+    for i in range(0, len(a), 32):
+        hashed = (shingles[None, :] * a[i:i + 32, None] + b[i:i + 32, None]) % np.uint64(mersenne_prime)
+        sig[i:i + 32] = (hashed & np.uint64(max_hash)).min(1)
+    return sig
+
+
+def song_signatures(dset_fname, paths, pitch_col, ngram, perms):
+    '''
+    minhash signatures of the songs at @paths in the hdf5 file @dset_fname, as rows of an array.
+    opens its own handle to the file so that it can run in a worker process.
+    '''
+    with h5py.File(dset_fname, 'r') as f:
+        sigs = [minhash_signature(song_shingles(h5h.read_note_array(f[path]), pitch_col, ngram), perms)
+                for path in paths]
+    return np.stack(sigs, 0) if sigs else np.zeros((0, len(perms[0])), dtype='uint32')
+
+
+def lsh_candidates(signatures, num_bands):
+    '''
+    pairs (i, j), i < j, of rows of @signatures that agree on every value of at least one of
+    @num_bands bands of the signature.
+    '''
+    rows_per_band = signatures.shape[1] // num_bands
+    pairs = set()
+    for band in range(num_bands):
+        cols = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        buckets = {}
+        for i, key in enumerate(map(bytes, np.ascontiguousarray(cols))):
+            buckets.setdefault(key, []).append(i)
+        for members in buckets.values():
+            for x in range(len(members)):
+                for y in range(x + 1, len(members)):
+                    pairs.add((members[x], members[y]))
+    return sorted(pairs)
+
+
+def find_clusters(signatures, num_bands, threshold):
+    '''
+    groups rows of @signatures into clusters of near-duplicates: candidate pairs from
+    lsh_candidates whose estimated similarity is at least @threshold are joined, transitively.
+    returns (clusters, similarities): a list of index lists with more than one member, and a dict
+    from each joined pair to its estimated similarity.
+    '''
+    parents = list(range(len(signatures)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    # songs too short to have shingles would all share a bucket, so are left out
+    similarities = {}
+    inds = np.nonzero(~(signatures == max_hash).all(1))[0]
+    for i, j in lsh_candidates(signatures[inds], num_bands):
+        i, j = inds[i], inds[j]
+        sim = float((signatures[i] == signatures[j]).mean())
+        if sim >= threshold:
+            similarities[(i, j)] = sim
+            parents[find(i)] = find(j)
+
+    clusters = {}
+    for i in range(len(signatures)):
+        clusters.setdefault(find(i), []).append(i)
+    return [sorted(x) for x in clusters.values() if len(x) > 1], similarities
+
+
+def cluster_split(member_ids, test_proportion, validate_proportion):
+    '''
+    the split for a whole cluster of songs, from the hash of its smallest id, so that it only
+    changes if that song leaves the cluster.
+    '''
+    return h5h.hash_split(min(member_ids), test_proportion, validate_proportion)
+
+
+def signature_cache(dset_fname, ngram, num_perm):
+    '''
+    signatures computed by earlier runs, keyed by the content hash of each song's source file.
+    '''
+    cache_fname = f'{dset_fname}.minhash-{ngram}-{num_perm}.npz'
+    if not os.path.exists(cache_fname):
+        return cache_fname, {}
+    with np.load(cache_fname) as cached:
+        return cache_fname, dict(zip(cached['hashes'].tolist(), cached['signatures']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Finds clusters of near-duplicate songs in an hdf5 file made by one of the '
+                    'make_*_hdf5.py scripts, moves every cluster into a single split, and moves '
+                    'all but one song of each cluster out of the splits. Run it again after each '
+                    'rebuild, since builders place new songs by the hash of their own id.')
+    parser.add_argument('dset_path', help='hdf5 file with a build manifest.')
+    parser.add_argument('-t', '--test_proportion', type=float, default=0.1)
+    parser.add_argument('-v', '--validate_proportion', type=float, default=0.1)
+    parser.add_argument('-n', '--ngram', type=int, default=5, help='Pitch intervals per shingle.')
+    parser.add_argument('-p', '--num_perm', type=int, default=128, help='Length of minhash signatures.')
+    parser.add_argument('-b', '--num_bands', type=int, default=16, help='Number of lsh bands.')
+    parser.add_argument('-j', '--threshold', type=float, default=0.7,
+                        help='Estimated jaccard similarity above which songs are duplicates.')
+    parser.add_argument('-c', '--pitch_col', type=int, default=3,
+                        help='Pitch column, for files written before columns were named.')
+    parser.add_argument('-w', '--num_workers', type=int, default=8)
+    parser.add_argument('-k', '--keep_duplicates', action='store_true',
+                        help='Only make splits cluster-aware, leaving duplicates in place.')
+    parser.add_argument('-d', '--dry_run', action='store_true', help='Write the report only.')
+    args = vars(parser.parse_args())
+    if args['num_perm'] % args['num_bands']:
+        raise ValueError('num_perm must be a multiple of num_bands')
+
+    start_time = time.time()
+    with h5py.File(args['dset_path'], 'r') as f:
+        manifest = h5h.read_manifest(f)
+        song_ids = sorted(x for x in manifest if manifest[x]['dset'])
+        paths = [manifest[x]['dset'] for x in song_ids]
+        names = f[paths[0]].dtype.names
+        pitch_col = names.index('pitch') if names else args['pitch_col']
+        lengths = [f[path].shape[0] for path in paths]
+
+    # only songs whose source changed since the last run need new signatures
+    perms = permutations(args['num_perm'])
+    cache_fname, cached = signature_cache(args['dset_path'], args['ngram'], args['num_perm'])
+    hashes = [manifest[x]['hash'] for x in song_ids]
+    to_compute = [i for i, h in enumerate(hashes) if h not in cached]
+    batches = [to_compute[i:i + 256] for i in range(0, len(to_compute), 256)]
+    with Pool(args['num_workers']) as pool:
+        results = pool.starmap(song_signatures, [
+            (args['dset_path'], [paths[i] for i in batch], pitch_col, args['ngram'], perms)
+            for batch in batches])
+    for batch, sigs in zip(batches, results):
+        cached.update(zip([hashes[i] for i in batch], sigs))
+    signatures = np.stack([cached[h] for h in hashes], 0)
+    np.savez(cache_fname, hashes=np.array(hashes), signatures=signatures)
+    print(f'computed {len(to_compute)} of {len(song_ids)} signatures in {time.time() - start_time:.1f} s')
+
+    clusters, similarities = find_clusters(signatures, args['num_bands'], args['threshold'])
+
+    # each song's target split, and where it should be stored: the longest song of each cluster
+    # stays in the splits, and the others go to the duplicates group
+    targets = {x: (manifest[x]['split'], f"/{manifest[x]['split']}/{x}") for x in song_ids}
+    report_clusters = []
+    cluster_of = {}
+    for members in clusters:
+        ids = [song_ids[i] for i in members]
+        cluster_of.update((i, len(report_clusters)) for i in members)
+        split = cluster_split(ids, args['test_proportion'], args['validate_proportion'])
+        kept = ids[int(np.argmax([lengths[i] for i in members]))]
+        for x in ids:
+            dup = x != kept and not args['keep_duplicates']
+            targets[x] = (split, f'/{duplicates_grp}/{split}/{x}' if dup else f'/{split}/{x}')
+        report_clusters.append({
+            'split': split,
+            'kept': kept,
+            'members': ids,
+            'similarities': []
+        })
+    for (i, j), sim in similarities.items():
+        report_clusters[cluster_of[i]]['similarities'].append([song_ids[i], song_ids[j], sim])
+
+    # songs that left a cluster go back to the split of their own id
+    for i, x in enumerate(song_ids):
+        in_cluster_grp = manifest[x]['dset'].startswith(f'/{duplicates_grp}/')
+        if manifest[x]['split'] in splits and i not in cluster_of:
+            split = h5h.hash_split(x, args['test_proportion'], args['validate_proportion'])
+            if in_cluster_grp or split != manifest[x]['split']:
+                targets[x] = (split, f'/{split}/{x}')
+
+    moves = {x: t for x, t in targets.items() if manifest[x]['split'] in splits and t[1] != manifest[x]['dset']}
+    num_cross_split = sum(1 for c in report_clusters
+                          if len(set(manifest[x]['split'] for x in c['members'])) > 1)
+    report = {
+        'dset_path': args['dset_path'],
+        'settings': {k: args[k] for k in ['ngram', 'num_perm', 'num_bands', 'threshold']},
+        'num_songs': len(song_ids),
+        'num_clusters': len(clusters),
+        'num_duplicates': sum(len(c['members']) - 1 for c in report_clusters),
+        'num_clusters_across_splits': num_cross_split,
+        'num_moved': len(moves),
+        'clusters': sorted(report_clusters, key=lambda c: -len(c['members'])),
+    }
+    with open(f"{args['dset_path']}.dedup.json", 'w') as fp:
+        json.dump(report, fp, indent=1)
+    print(f"{report['num_clusters']} clusters holding {report['num_duplicates']} duplicates, "
+          f'{num_cross_split} of them spread across splits; moving {len(moves)} songs')
+
+    if not args['dry_run']:
+        with h5py.File(args['dset_path'], 'a') as f:
+            for x, (split, dset) in moves.items():
+                f.require_group(os.path.dirname(dset))
+                f.move(manifest[x]['dset'], dset)
+                manifest[x]['split'], manifest[x]['dset'] = split, dset
+            h5h.write_manifest(f, manifest)
+            h5h.write_length_index(f)
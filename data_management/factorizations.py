@@ -8,101 +8,68 @@ def arr_to_runlength(arr, deltas, pitch_range, monophonic=False):
     takes in a processed array generated by make_hdf5.py and turns it into a run-length encoding.
     for now, it collapses all non-drum channels down into a single piano roll.
     '''
-
-    tick_deltas_mapping = {v: i for i, v in enumerate(deltas)}
-    MIDIEvent = namedtuple("MIDIEvent", "type voice note tick")
-
-    def dict_add(dict, event):
-        if event.tick in dict.keys():
-            dict[event.tick].append(event)
-        else:
-            dict[event.tick] = [event]
-
-    events = {}
-
-    for n in arr:
-        clp_pitch = int(np.clip(n[0], pitch_range[0], pitch_range[1]))
-        start_event = MIDIEvent(
-            type='start', voice=0, note=clp_pitch, tick=n[1])
-        end_event = MIDIEvent(
-            type='end', voice=0, note=clp_pitch, tick=n[2] + n[1])
-
-        dict_add(events, start_event)
-        dict_add(events, end_event)
+    arr = np.asarray(arr)
+    num_notes = pitch_range[1] - pitch_range[0]
+    pitch_start = pitch_range[0]
 
     # structure of a change point:
     # [1] absolute tick time of event in natural numbers
     # [128] onset marker in {0, 1}
     # [128] active note in {0, 1}
 
-    # alternative way is to use new arrays for each monophonic voice.
-
-    note_ons_rl = []
-    note_holds_rl = []
-    note_deltas_rl = []
-
-    num_notes = pitch_range[1] - pitch_range[0]
-    pitch_start = pitch_range[0]
-
-    sorted_events = sorted(list(events.keys()))
-
-    for i, t in enumerate(sorted_events):
-
-        note_ons = np.zeros(num_notes, dtype='int16') - 1
-        note_holds = np.zeros(num_notes, dtype='int16') - 1
-        deltas = np.zeros(len(tick_deltas_mapping))
-
-        # get length after this change point
-        try:
-            delta = sorted_events[i + 1] - t
-            delta_ind = tick_deltas_mapping[delta]
-        except IndexError:
-            # if this is at the end of the file, assign the longest possible value
-            delta_ind = -1
-        except KeyError:
-            # if this delta is uncommon, find the nearest common one
-            delta_keys = np.array(list(tick_deltas_mapping.keys()))
-            best_ind = np.argmin(np.abs(delta_keys - delta))
-            delta_ind = tick_deltas_mapping[delta_keys[best_ind]]
-
-        deltas[delta_ind] = 1
-
-        # for notes whose statuses are set directly by notes involved in the current change point,
-        # what do do is obvious:
-        for change in events[t]:
-            ind = change.note - pitch_start - 1
-            if change.type == 'start':
-                note_ons[ind] = 1
-                note_holds[ind] = 1
-            elif change.type == 'end':
-                note_ons[ind] = 0
-                note_holds[ind] = 0
-
-        # for onset-controlling indices, they're always off if not set explicitly on
-        note_ons[note_ons == -1] = 0
-
-        # for hold-controlling indices, we copy their previous state
-        try:
-            prev_note_hold = note_holds_rl[-1]
-        except IndexError:
-            prev_note_hold = np.zeros(num_notes, dtype='int16')
-
-        note_holds[note_holds == -1] = prev_note_hold[note_holds == -1]
-
-        # run_length.append(pt)
-        note_ons_rl.append(note_ons)
-        note_holds_rl.append(note_holds)
-        note_deltas_rl.append(deltas)
+    # every note makes a start event (value 1) and an end event (value 0). events are ordered as
+    # they were when added one note at a time, so that later events at the same tick win.
+    clp_pitch = np.clip(arr[:, 0], pitch_range[0], pitch_range[1]).astype('int64')
+    note_inds = np.mod(clp_pitch - pitch_start - 1, num_notes)
+    event_ticks = np.stack([arr[:, 1], arr[:, 2] + arr[:, 1]], 1).reshape(-1)
+    event_inds = np.repeat(note_inds, 2)
+    event_vals = np.tile(np.array([1, 0], dtype='int16'), arr.shape[0])
+    event_order = np.arange(len(event_ticks))
+
+    change_ticks, event_cps = np.unique(event_ticks, return_inverse=True)
+    event_cps = event_cps.reshape(-1)
+    num_cps = len(change_ticks)
+
+    # keep only the last event for each (change point, note) pair
+    srt = np.lexsort((event_order, event_cps, event_inds))
+    cps, inds, vals = event_cps[srt], event_inds[srt], event_vals[srt]
+    is_last = np.ones(len(srt), dtype='bool')
+    is_last[:-1] = (cps[1:] != cps[:-1]) | (inds[1:] != inds[:-1])
+    cps, inds, vals = cps[is_last], inds[is_last], vals[is_last]
+
+    # onsets are only on at the change point of a start event
+    note_ons_rl = np.zeros((num_cps, num_notes), dtype='int16')
+    note_ons_rl[cps, inds] = vals
+
+    # holds keep their value until the next event for that note: since events are sorted by note
+    # and then by change point, each one changes the hold by its value minus the previous one's
+    prev_vals = np.zeros(len(vals), dtype='int16')
+    prev_vals[1:] = vals[:-1]
+    prev_vals[np.concatenate([[True], inds[1:] != inds[:-1]])] = 0
+    hold_changes = np.zeros((num_cps, num_notes), dtype='int16')
+    hold_changes[cps, inds] = vals - prev_vals
+    note_holds_rl = np.cumsum(hold_changes, 0, dtype='int16')
+
+    # get length after each change point, snapping uncommon deltas to the nearest common one.
+    # the last change point is assigned the longest possible value.
+    tick_deltas_mapping = {v: i for i, v in enumerate(deltas)}
+    delta_keys = np.array(list(tick_deltas_mapping.keys()))
+    delta_vals = np.array(list(tick_deltas_mapping.values()))
+    change_deltas = np.diff(change_ticks).astype('float64')
+    nearest = np.argmin(np.abs(change_deltas[:, None] - delta_keys[None, :]), 1)
+    note_deltas_rl = np.zeros((num_cps, len(tick_deltas_mapping)))
+    note_deltas_rl[np.arange(num_cps - 1), delta_vals[nearest]] = 1
+    note_deltas_rl[-1, -1] = 1
 
     if monophonic:
-        new_note_holds = np.sum(np.stack(note_holds_rl), 1)
+        new_note_holds = np.sum(note_holds_rl, 1)
         new_note_holds = 1 - np.clip(new_note_holds, 0, 1)
         note_holds_rl = np.expand_dims(new_note_holds, 1)
 
     run_length = np.concatenate([
-        np.stack(note_holds_rl),
-        np.stack(note_ons_rl),
-        np.stack(note_deltas_rl)], 1)
+        note_holds_rl,
+        note_ons_rl,
+        note_deltas_rl], 1)
 
     if monophonic:
         assert run_length.shape[-1] == pitch_range[1] - pitch_range[0] \
@@ -147,62 +114,79 @@ def arr_to_runlength_mono(arr, deltas, pitch_range, flags, with_duration=True):
     return res
 
 
-def arr_to_note_tuple(arr):
-    sorted_notes = sorted(arr, key=lambda x: x[1])
-    res = np.zeros_like(arr)
-    last_onset_time = 0
-    for i, n in enumerate(sorted_notes):
+def arr_to_runlength_mono_indices(arr, deltas, pitch_range, with_duration=True):
+    '''
+    sparse form of arr_to_runlength_mono: instead of one-hot rows, returns an int16 array of
+    shape (num_notes, 3) holding the index of the pitch feature, the index of the duration
+    feature and the index of the flag feature that would be set in each row. features that are
+    not set are -1, so the flag column of every note is -1, as is the duration column when
+    @with_duration is false. unlike arr_to_runlength_mono, @arr is not modified.
+    '''
+    pitches = np.array(arr[:, 0] if with_duration else arr[:], dtype='int64')
+    num_notes = len(pitches)
 
-        # MIDI pitch
-        res[i, 0] = n[0]
+    # rests become index 0 and pitches in the range map to 1 and up, as in arr_to_runlength_mono
+    notes = pitches != 0
+    pitches[notes] = np.clip(pitches[notes], pitch_range[0], pitch_range[1]) - pitch_range[0] + 1
 
-        # delta
-        res[i, 1] = n[1] - last_onset_time
-        last_onset_time = n[1]
+    res = np.full((num_notes, 3), -1, dtype='int16')
+    res[:, 0] = pitches
+
+    if with_duration:
+        durs = arr[:, 2].astype('float64')
+        res[:, 1] = np.argmin(np.abs(np.asarray(deltas, dtype='float64')[:, None] - durs), 0)
 
-        # duration
-        res[i, 2] = n[2]
     return res
 
 
-def pianoroll_to_runlength(x):
+def arr_to_note_tuple(arr):
     '''
-    takes in a pypianoroll object and turns it into a run-length encoding.
-    for now, it collapses all non-drum channels down into a single piano roll,
-    and ignores note velocity values.
+    sorts notes (pitch, onset, duration) by onset, keeping the original order of notes with the
+    same onset, and replaces each onset with the time since the previous one.
+    '''
+    sorted_notes = arr[np.argsort(arr[:, 1], kind='stable')]
+    res = np.zeros_like(arr)
+    res[:, 0] = sorted_notes[:, 0]
+    res[:, 1] = np.diff(sorted_notes[:, 1], prepend=0)
+    res[:, 2] = sorted_notes[:, 2]
+    return res
+
+
+def collapse_pianoroll(x):
+    '''
+    collapses all tracks of a pypianoroll object into a single binary-summed piano roll, trimmed
+    to its minimum extent both vertically and horizontally.
     '''
     trs = [t.pianoroll for t in x.tracks if t.pianoroll.shape[0] > 0]
     stack_pr = np.stack(trs).clip(0, 1)
     reduced_pr = np.sum(stack_pr, 0)
 
-    # trim to minimum extent both vertically and horizontally
     hz_proj = np.sum(reduced_pr, 1).nonzero()[0]
     vt_proj = np.sum(reduced_pr, 0).nonzero()[0]
-    trim_pr = reduced_pr[hz_proj[0]:hz_proj[-1] + 1, vt_proj[0]:vt_proj[-1] + 1]
-
-    rl_arr = [trim_pr[0, :]]
-    deltas = []
-    sames = 0
-    last_n = 0
-    for n in range(1, trim_pr.shape[0]):
-
-        # if this timestep is the same as the last one, don't record it
-        if all(rl_arr[-1] == trim_pr[n, :]):
-            sames += 1
-            continue
-
-        # otherwise, make a new entry
-        new_entry = trim_pr[n, :]
-        rl_arr.append(new_entry)
-        deltas.append(n - last_n)
-        last_n = n
-    rl = np.stack(rl_arr)
-    deltas += [0]
-    deltas = np.expand_dims(np.array(deltas), 1)
+    return reduced_pr[hz_proj[0]:hz_proj[-1] + 1, vt_proj[0]:vt_proj[-1] + 1]
+
+
+def pianoroll_to_runlength(x):
+    '''
+    takes in a pypianoroll object and turns it into a run-length encoding.
+    for now, it collapses all non-drum channels down into a single piano roll,
+    and ignores note velocity values.
+    '''
+    trim_pr = collapse_pianoroll(x)
+
+    # keep the first timestep and every one that differs from the timestep before it
+    changed = np.any(np.diff(trim_pr, axis=0) != 0, axis=1)
+    starts = np.concatenate([[0], np.nonzero(changed)[0] + 1])
+    rl = trim_pr[starts]
+
+    # each entry records the time until the next one; the last gets 0
+    deltas = np.concatenate([np.diff(starts), [0]])
+    deltas = np.expand_dims(deltas, 1)
     rl = np.concatenate([deltas, rl], 1)
 
     return rl
 
+
 if __name__ == '__main__':
     import data_loaders as dl
     import h5py
@@ -0,0 +1,450 @@
+import os
+import hashlib
+import h5py
+import numpy as np
+
+# candidate integer types for each column, from narrowest to widest
+int_dtypes = ['uint8', 'int8', 'uint16', 'int16', 'uint32', 'int32', 'int64']
+
+
+def narrowest_dtype(values):
+    '''
+    picks the narrowest dtype able to exactly hold all of @values: the smallest integer type
+    whose range covers them if they are all integral, and float32 otherwise.
+    '''
+    values = np.asarray(values)
+    if values.size == 0:
+        return np.dtype('uint8')
+    if not np.all(np.mod(values, 1) == 0):
+        return np.dtype('float32')
+
+    lo, hi = values.min(), values.max()
+    for dt in int_dtypes:
+        info = np.iinfo(dt)
+        if info.min <= lo and hi <= info.max:
+            return np.dtype(dt)
+    return np.dtype('int64')
+
+
+def to_compact_records(arr, columns):
+    '''
+    converts a 2d array @arr, whose columns are named by @columns, into a structured array in
+    which every column is stored with its own narrowest dtype.
+    '''
+    arr = np.asarray(arr)
+    assert arr.ndim == 2 and arr.shape[1] == len(columns), \
+        f'array of shape {arr.shape} does not match columns {columns}'
+    dtype = [(name, narrowest_dtype(arr[:, i])) for i, name in enumerate(columns)]
+    records = np.empty(arr.shape[0], dtype=dtype)
+    for i, name in enumerate(columns):
+        records[name] = arr[:, i]
+    return records
+
+
+def storage_kwargs(compression='gzip', compression_level=4, chunk_rows=None, num_rows=None):
+    '''
+    keyword arguments for h5py's create_dataset for the given storage settings.
+    @compression - one of None, 'lzf' or 'gzip'
+    @compression_level - gzip level, from 0 to 9
+    @chunk_rows - number of rows per chunk (optional, default: chosen by h5py)
+    @num_rows - number of rows in the dataset being created, used to clip @chunk_rows
+    '''
+    kwargs = {}
+    if compression == 'gzip':
+        kwargs['compression'] = 'gzip'
+        kwargs['compression_opts'] = compression_level
+    elif compression == 'lzf':
+        kwargs['compression'] = 'lzf'
+    elif compression is not None:
+        raise ValueError(f'unknown compression type {compression}: must be None, lzf or gzip')
+
+    if chunk_rows:
+        kwargs['chunks'] = (max(1, min(chunk_rows, num_rows or chunk_rows)),)
+    return kwargs
+
+
+def create_note_dataset(grp, name, arr, columns, compression='gzip', compression_level=4,
+                        chunk_rows=None):
+    '''
+    stores the 2d array @arr in hdf5 group @grp as a compound dataset with one named field per
+    column, each using the narrowest dtype that holds its values.
+    '''
+    records = to_compact_records(arr, columns)
+    kwargs = storage_kwargs(compression, compression_level, chunk_rows, len(records))
+    if len(records) == 0:
+        kwargs = {}
+    return grp.create_dataset(name=name, data=records, **kwargs)
+
+
+def read_note_array(dset, rows=()):
+    '''
+    reads a dataset written by create_note_dataset back into a plain 2d array, with columns in
+    the order they were written. integer columns are widened to int64 and floating point ones to
+    float64, matching arrays written by older versions of the builders. datasets that are already
+    plain arrays are returned as-is. @rows optionally selects a slice of rows to read.
+    '''
+    arr = dset[rows]
+    names = arr.dtype.names
+    if names is None:
+        return arr
+
+    out_dtype = np.result_type(np.int64, *[arr.dtype[n] for n in names])
+    out = np.empty((arr.shape[0], len(names)), dtype=out_dtype)
+    for i, name in enumerate(names):
+        out[:, i] = arr[name]
+    return out
+
+
+# a packed group stores many songs as one flat dataset of notes, along with the row at which each
+# song starts, in place of one dataset per song. its songs are addressed as <group path>#<index>.
+packed_notes_name = 'notes'
+packed_offsets_name = 'offsets'
+
+
+def create_packed_group(grp, name, arr, offsets, columns=None, compression='gzip',
+                        compression_level=4, chunk_rows=None):
+    '''
+    stores the songs in rows offsets[i]:offsets[i + 1] of @arr as a packed group @name in hdf5
+    group @grp. if @columns are given, the notes are stored as by create_note_dataset, otherwise
+    as a plain array.
+    '''
+    packed = grp.create_group(name)
+    packed.attrs['packed'] = True
+    if columns is not None:
+        create_note_dataset(packed, packed_notes_name, arr, columns, compression, compression_level, chunk_rows)
+    else:
+        kwargs = storage_kwargs(compression, compression_level, chunk_rows, len(arr)) if len(arr) else {}
+        packed.create_dataset(packed_notes_name, data=arr, **kwargs)
+    packed.create_dataset(packed_offsets_name, data=np.asarray(offsets, dtype='int64'))
+    return packed
+
+
+def is_packed(node):
+    return isinstance(node, h5py.Group) and bool(node.attrs.get('packed', False))
+
+
+def song_keys(obj):
+    '''
+    paths, relative to hdf5 group @obj, of every song under it: each dataset other than the
+    index datasets at the root of the file, and each song of every packed group.
+    '''
+    keys = []
+    packed = []
+
+    def visitor_func(name, node):
+        if any(name.startswith(f'{p}/') for p in packed):
+            return
+        if is_packed(node):
+            packed.append(name)
+            keys.extend(f'{name}#{i}' for i in range(len(node[packed_offsets_name]) - 1))
+        elif isinstance(node, h5py.Dataset) and node.name not in index_paths:
+            keys.append(name)
+
+    if is_packed(obj):
+        return [f'#{i}' for i in range(len(obj[packed_offsets_name]) - 1)]
+    obj.visititems(visitor_func)
+    return keys
+
+
+def song_path(grp, key):
+    '''
+    the absolute path of song @key under hdf5 group @grp, which can be read from its file.
+    '''
+    return grp.name.rstrip('/') + ('' if key.startswith('#') else '/') + key
+
+
+def song_columns(grp, key):
+    '''
+    the names of the columns of song @key under hdf5 group @grp, as written by
+    create_note_dataset, or None for songs stored as plain arrays.
+    '''
+    if '#' in key:
+        path = key.rsplit('#', 1)[0]
+        dset = (grp[path] if path else grp)[packed_notes_name]
+    else:
+        dset = grp[key]
+    names = dset.dtype.names
+    return list(names) if names else None
+
+
+def read_song(grp, key, offsets_cache=None):
+    '''
+    reads song @key under hdf5 group @grp as by read_note_array, whether it is a dataset of its
+    own or part of a packed group. @offsets_cache, if given, is a dict in which the offsets of
+    each packed group are kept after their first read, so that reading many songs from the same
+    group doesn't read its offsets again for every song.
+    '''
+    if '#' not in key:
+        return read_note_array(grp[key])
+    path, i = key.rsplit('#', 1)
+    packed = grp[path] if path else grp
+    if offsets_cache is None:
+        start, end = packed[packed_offsets_name][int(i):int(i) + 2]
+    else:
+        offsets = offsets_cache.get(packed.name)
+        if offsets is None:
+            offsets = offsets_cache[packed.name] = packed[packed_offsets_name][()]
+        start, end = offsets[int(i):int(i) + 2]
+    return read_note_array(packed[packed_notes_name], slice(start, end))
+
+
+def stratified_subset(fnames, num_windows, proportion, num_length_bins=4, seed=0):
+    '''
+    deterministically selects a subset of @proportion of the songs in @fnames, in place of taking
+    a prefix of the file list. songs are stratified by corpus group (the first component of their
+    path, if they are in subgroups) and by quantile of their window count @num_windows, so the
+    subset has the same mix of corpora and song lengths as the full set. round(@proportion *
+    len(@fnames)) songs are shared out between strata by largest remainder, with at least one
+    song from every stratum (so never fewer songs than strata), and each stratum's songs are
+    drawn at random. the same @seed always gives the same subset. returns the selected fnames in
+    their original order.
+    '''
+    fnames = list(fnames)
+    num_windows = np.asarray(num_windows, dtype='int64')
+    rng = np.random.RandomState(seed)
+    if proportion <= 0 or not fnames:
+        return []
+
+    groups = np.array([x.split('/')[0] if '/' in x else '' for x in fnames])
+    edges = np.quantile(num_windows, np.linspace(0, 1, num_length_bins + 1)[1:-1])
+    length_bins = np.searchsorted(edges, num_windows, side='right')
+    strata = [inds for group in np.unique(groups) for b in range(num_length_bins)
+              for inds in [np.nonzero((groups == group) & (length_bins == b))[0]] if len(inds)]
+
+    # every stratum gets the integer part of its share of the total, and the songs left over go
+    # to the strata with the largest remainders. if the minimum of one song per stratum overshoots
+    # the total, songs are taken back from the strata furthest above their share.
+    sizes = np.array([len(x) for x in strata])
+    total = min(len(fnames), max(len(strata), int(np.round(proportion * len(fnames)))))
+    quotas = sizes * total / len(fnames)
+    counts = np.clip(np.floor(quotas).astype('int64'), 1, sizes)
+    while counts.sum() < total:
+        deficits = np.where(counts < sizes, quotas - counts, -np.inf)
+        counts[np.argmax(deficits)] += 1
+    while counts.sum() > total:
+        deficits = np.where(counts > 1, quotas - counts, np.inf)
+        counts[np.argmin(deficits)] -= 1
+
+    selected = []
+    for inds, num_take in zip(strata, counts):
+        selected.extend(inds[rng.permutation(len(inds))[:num_take]])
+    return [fnames[i] for i in sorted(selected)]
+
+
+# name of the dataset at the root of a built hdf5 file that lists the source of every song
+manifest_name = 'manifest'
+manifest_dtype = np.dtype([
+    ('id', h5py.string_dtype()),
+    ('path', h5py.string_dtype()),
+    ('dset', h5py.string_dtype()),
+    ('size', 'int64'),
+    ('mtime', 'float64'),
+    ('hash', h5py.string_dtype()),
+    ('split', h5py.string_dtype()),
+])
+
+
+def file_hash(path, block_size=2 ** 20):
+    h = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def hash_split(song_id, test_proportion, validate_proportion):
+    '''
+    assigns @song_id to 'test', 'validate' or 'train' from a hash of the id, so that songs keep
+    their split as the corpus grows or is rebuilt.
+    '''
+    u = int(hashlib.sha1(str(song_id).encode()).hexdigest()[:12], 16) / 16 ** 12
+    if u < test_proportion:
+        return 'test'
+    elif u < test_proportion + validate_proportion:
+        return 'validate'
+    return 'train'
+
+
+def source_entry(path, dset, split, content_hash=None):
+    '''
+    manifest entry for a song read from @path and stored in dataset @dset of @split. @dset is ''
+    for sources that could not be read, so that they are not retried until they change.
+    '''
+    st = os.stat(path)
+    return {'path': path, 'dset': dset, 'size': st.st_size, 'mtime': st.st_mtime,
+            'hash': content_hash or file_hash(path), 'split': split}
+
+
+def read_manifest(f):
+    '''
+    the manifest of hdf5 file @f as a dict from song id to entry, empty if it has none. where a
+    song has several rows, the last one counts.
+    '''
+    if manifest_name not in f:
+        return {}
+    manifest = {}
+    for row in f[manifest_name][()]:
+        entry = {name: row[name] for name in manifest_dtype.names}
+        for name in ['id', 'path', 'dset', 'hash', 'split']:
+            if isinstance(entry[name], bytes):
+                entry[name] = entry[name].decode()
+        manifest[entry.pop('id')] = entry
+    return manifest
+
+
+def manifest_records(entries):
+    records = np.empty(len(entries), dtype=manifest_dtype)
+    for i, (song_id, entry) in enumerate(sorted(entries.items())):
+        records[i] = (song_id, entry['path'], entry['dset'], entry['size'], entry['mtime'],
+                      entry['hash'], entry['split'])
+    return records
+
+
+def write_manifest(f, manifest):
+    '''
+    replaces the manifest of hdf5 file @f with @manifest. the dataset is resizable, so that
+    builders can add songs to it with append_manifest as they go.
+    '''
+    if manifest_name in f:
+        del f[manifest_name]
+    f.create_dataset(manifest_name, data=manifest_records(manifest), maxshape=(None,),
+                     chunks=(1024,))
+
+
+def append_manifest(f, entries):
+    '''
+    adds @entries, a dict from song id to entry, to the end of the manifest of hdf5 file @f,
+    without rewriting the rows already there. a song appended again supersedes its earlier row
+    when the manifest is read.
+    '''
+    if manifest_name not in f or f[manifest_name].maxshape != (None,):
+        write_manifest(f, {**read_manifest(f), **entries})
+        return
+    dset = f[manifest_name]
+    start = dset.shape[0]
+    dset.resize((start + len(entries),))
+    dset[start:] = manifest_records(entries)
+
+
+def update_manifest(f, sources):
+    '''
+    compares the sources of a build, a dict from song id to source path, against the manifest of
+    hdf5 file @f. songs whose source was removed or changed are deleted from the file and the
+    manifest. a source counts as unchanged if its size and modification time match, or failing
+    that its content hash. returns the remaining manifest and the ids of the songs to (re)build.
+    the length index is dropped until the build finishes and writes it again, so that an
+    interrupted build never leaves a stale one.
+    '''
+    if lengths_name in f:
+        del f[lengths_name]
+    manifest = read_manifest(f)
+    to_build = []
+    for song_id, path in sources.items():
+        entry = manifest.get(song_id)
+        if entry is not None:
+            st = os.stat(path)
+            if entry['path'] == path and entry['size'] == st.st_size and entry['mtime'] == st.st_mtime:
+                continue
+            content_hash = file_hash(path)
+            if content_hash == entry['hash']:
+                entry.update(source_entry(path, entry['dset'], entry['split'], content_hash))
+                continue
+        to_build.append(song_id)
+
+    for song_id in [x for x in manifest if x not in sources or x in to_build]:
+        dset = manifest.pop(song_id)['dset']
+        if dset and dset in f:
+            del f[dset]
+
+    write_manifest(f, manifest)
+    return manifest, to_build
+
+
+# name of the dataset at the root of a built hdf5 file that holds the number of notes of every
+# song, so that loaders can plan epochs without opening each song
+lengths_name = 'lengths'
+lengths_dtype = np.dtype([
+    ('dset', h5py.string_dtype()),
+    ('length', 'int64'),
+])
+
+# datasets at the root of a built hdf5 file that describe its songs rather than holding one
+index_paths = [f'/{manifest_name}', f'/{lengths_name}']
+
+# sequence lengths for which write_length_index counts the windows of each group
+summary_seq_lengths = [64, 128, 256, 512, 1024]
+
+
+def write_length_index(f, seq_lengths=summary_seq_lengths):
+    '''
+    writes the number of notes of every song in hdf5 file @f to the lengths table at its root,
+    and summarizes every top-level group in its attributes: num_songs, total_notes, and
+    num_windows_<n>, the number of whole windows of n notes in its songs, for each n in
+    @seq_lengths. only reads the shapes of the songs, not their notes.
+    '''
+    if lengths_name in f:
+        del f[lengths_name]
+    keys = song_keys(f)
+    lengths = dict(zip([f'/{x}' for x in keys], stored_lengths(f, keys).tolist()))
+
+    records = np.empty(len(lengths), dtype=lengths_dtype)
+    for i, (dset, length) in enumerate(sorted(lengths.items())):
+        records[i] = (dset, length)
+    f.create_dataset(lengths_name, data=records)
+
+    for grp_name, grp in f.items():
+        if not isinstance(grp, h5py.Group):
+            continue
+        grp_lengths = np.array([n for dset, n in lengths.items() if dset.startswith(f'/{grp_name}/')],
+                               dtype='int64')
+        grp.attrs['num_songs'] = len(grp_lengths)
+        grp.attrs['total_notes'] = int(grp_lengths.sum())
+        for n in seq_lengths:
+            grp.attrs[f'num_windows_{n}'] = int((grp_lengths // n).sum())
+
+
+def read_length_index(grp):
+    '''
+    the number of notes of every song under hdf5 group @grp, as a dict keyed by path relative to
+    @grp, read from the lengths table of its file. empty if the file has none.
+    '''
+    f = grp.file
+    if lengths_name not in f:
+        return {}
+    prefix = grp.name.rstrip('/') + '/'
+    records = f[lengths_name][()]
+    lengths = {}
+    for dset, length in zip(records['dset'], records['length'].tolist()):
+        dset = dset.decode() if isinstance(dset, bytes) else dset
+        if dset.startswith(prefix):
+            lengths[dset[len(prefix):]] = length
+    return lengths
+
+
+def stored_lengths(grp, fnames):
+    '''
+    the number of notes of each of the songs @fnames under hdf5 group @grp, as an array, read
+    from the shapes of their datasets or the offsets of their packed groups.
+    '''
+    offsets = {}
+    lengths = np.zeros(len(fnames), dtype='int64')
+    for j, x in enumerate(fnames):
+        if '#' not in x:
+            lengths[j] = grp[x].shape[0]
+            continue
+        path, i = x.rsplit('#', 1)
+        if path not in offsets:
+            offsets[path] = (grp[path] if path else grp)[packed_offsets_name][()]
+        lengths[j] = offsets[path][int(i) + 1] - offsets[path][int(i)]
+    return lengths
+
+
+def song_lengths(grp, fnames):
+    '''
+    the number of notes of each of the songs @fnames under hdf5 group @grp, as an array. lengths
+    come from the lengths table where it has them, and from the songs' shapes otherwise.
+    '''
+    lengths = read_length_index(grp)
+    missing = [x for x in fnames if x not in lengths]
+    lengths.update(zip(missing, stored_lengths(grp, missing).tolist()))
+    return np.array([lengths[x] for x in fnames], dtype='int64')
@@ -2,6 +2,7 @@ import json
 from torch.utils.data import IterableDataset, DataLoader
 import pretty_midi as pm
 import factorizations as fcts
+import midi_reader as mr
 from importlib import reload
 from collections import Counter
 from mido import KeySignatureError
@@ -20,29 +21,32 @@ def get_midi_from_md5(md5):
     return pm.PrettyMIDI(rf'{lmd_root}/{md5[0]}/{md5}.mid')
 
 
+def get_notes_from_md5(md5):
+    '''
+    non-drum notes of an lmd file as rows of (program, start, end, pitch, velocity), read
+    directly with midi_reader rather than through pretty_midi.
+    '''
+    notes, _ = mr.read_midi(rf'{lmd_root}/{md5[0]}/{md5}.mid')
+    return notes[:, :5]
+
+
 def load_lmd_random(num=10):
     with open(json_key) as f:
         j = json.load(f)
     md5s = list(j.keys())
 
-    pms = []
-    while len(pms) < num:
+    songs = []
+    while len(songs) < num:
         ind = np.random.randint(len(md5s))
         try:
-            mid = get_midi_from_md5(md5s[ind])
+            notes = get_notes_from_md5(md5s[ind])
         except OSError:
             continue
-        except EOFError:
-            continue
-        except KeySignatureError:
-            continue
         except ValueError:
             continue
-        except IndexError:
-            continue
-        pms.append(mid)
+        songs.append(notes)
 
-    return pms
+    return songs
 
 
 def load_lmd_runlength(num, seq_length):
@@ -85,11 +89,12 @@ def load_lmd_runlength(num, seq_length):
 
 
 def load_lmd_note_tuple(num, seq_length):
-    pms = load_lmd_random(num)
+    songs = load_lmd_random(num)
 
     all_songs = []
-    for pm in pms:
-        tuples = fcts.pm_to_note_tuple(pm)
+    for notes in songs:
+        # arr_to_note_tuple takes rows of (pitch, onset, duration)
+        tuples = fcts.arr_to_note_tuple(np.stack([notes[:, 3], notes[:, 1], notes[:, 2] - notes[:, 1]], 1))
         num_chunks = tuples.shape[0] // seq_length
         if not num_chunks:
             continue
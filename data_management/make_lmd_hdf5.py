@@ -1,86 +1,124 @@
-import pretty_midi as pm
-from collections import namedtuple
+import time
+from multiprocessing import Pool
 import numpy as np
 import h5py
 import model_params as params
+import data_management.hdf5_helpers as h5h
+import data_management.midi_reader as mr
 
 lmd_root = r"D:\Documents\datasets\lakh_midi_dataset\lmd_full"
 cleansed_ids_path = r"D:\Documents\datasets\lakh_midi_dataset\cleansed_ids.txt"
 json_key = r"D:\Documents\datasets\lakh_midi_dataset\md5_to_paths.json"
 dset_path = r"./lmd_cleansed.hdf5"
 
-with h5py.File(dset_path, 'a') as f:
-    f.attrs['beat_multiplier'] = params.beat_multiplier
-    train_grp = f.create_group('train')
-    test_grp = f.create_group('test')
-    validate_grp = f.create_group('validate')
-
+# on-disk storage: each column is stored with its narrowest dtype. compression is one of
+# None, 'lzf' or 'gzip'; chunk_rows = None lets h5py choose chunk shapes.
+columns = ['onset', 'duration', 'next_onset', 'pitch', 'velocity', 'program']
+compression = 'gzip'
+compression_level = 4
+chunk_rows = None
+
+# songs are parsed by a pool of num_workers processes. the main process is the only writer:
+# it keeps the hdf5 file open and writes parsed songs write_batch_size at a time.
+num_workers = 8
+write_batch_size = 64
 beat_multiplier = 24
-with open(cleansed_ids_path) as f:
-    rows = f.readlines()
-md5s = [x.split(' ')[0] for x in rows]
-md5s = list(set(md5s))
-np.random.shuffle(md5s)
-
-MIDINote = namedtuple('midi_note', 'program, start, end, pitch, velocity')
-
-split_test = np.round(params.test_proportion * len(md5s))
-split_validate = np.round(params.validate_proportion * len(md5s)) + split_test
-
-for i, md5 in enumerate(md5s):
 
-    if not i % 250:
-        print(f'{i} of {len(md5s)}...')
 
+def notes_to_array(programs, starts, ends, pitches, velocities):
+    '''
+    turns per-note arrays into the stored format, one row per note sorted by start time and
+    then pitch: onset, duration, time to next onset, pitch, velocity, program. times are in
+    units of 1 / beat_multiplier seconds.
+    '''
+    order = np.lexsort((pitches, starts))
+    start_beats = np.round(starts[order] * beat_multiplier)
+    end_beats = np.round(ends[order] * beat_multiplier)
+
+    arr = np.zeros([len(order), 6], dtype='int64')
+    arr[:, 0] = start_beats
+    arr[:, 1] = end_beats - start_beats
+    arr[:-1, 2] = np.diff(arr[:, 0])
+    arr[:, 3] = pitches[order]
+    arr[:, 4] = velocities[order]
+    arr[:, 5] = programs[order]
+    return arr
+
+
+def parse_song(md5):
+    '''
+    reads the non-drum notes of the lmd file with id @md5. returns (md5, arr), with arr None if
+    the file could not be parsed.
+    '''
     fname = rf'{lmd_root}/{md5[0]}/{md5}.mid'
-    mid = pm.PrettyMIDI(fname)
-
-    notes = []
-    for inst in mid.instruments:
-        if inst.is_drum:
-            continue
-        notes += [
-            MIDINote(inst.program, n.start, n.end, n.pitch, n.velocity)
-            for n
-            in inst.notes
-        ]
-
-    notes = sorted(notes, key=lambda x: (x.start, x.pitch))
-
-    starts = np.array([n.start for n in notes])
-    ends = np.array([n.end for n in notes])
-
-    # get start and end times in terms of the beat structure of the midi file
-    beats = mid.get_beats()
-    start_beats = np.interp(starts, beats, np.arange(len(beats)))
-    end_beats = np.interp(ends, beats, np.arange(len(beats)))
-    start_beats = np.round(starts * beat_multiplier)
-    end_beats = np.round(ends * beat_multiplier)
-
-    arr = np.zeros([len(notes), 6], dtype='uint16')
-    for i in range(len(notes)):
-        # onset, duration, time to next onset, pitch, velocity, program
-        n = notes[i]
-        duration = end_beats[i] - start_beats[i]
-        onset = start_beats[i]
-        pitch = n.pitch
-        velocity = n.velocity
-        program = n.program
-        arr[i] = [onset, duration, 0, pitch, velocity, program]
-
-    onset_diffs = arr[1:, 0] - arr[:-1, 0]
-    arr[:-1, 2] = onset_diffs
-
-    with h5py.File(dset_path, 'a') as f:
-        if i <= split_test:
-            selected_subgrp = f['test']
-        elif i <= split_validate:
-            selected_subgrp = f['validate']
-        else:
-            selected_subgrp = f['train']
-
-        dset = selected_subgrp.create_dataset(
-            name=md5,
-            data=arr,
-            compression='gzip'
+    try:
+        notes, _ = mr.read_midi(fname)
+    except Exception:
+        return md5, None
+
+    programs, starts, ends, pitches, velocities = notes[:, :5].T
+    return md5, notes_to_array(programs, starts, ends, pitches, velocities)
+
+
+def write_songs(f, songs, manifest):
+    written = {}
+    for md5, split, arr in songs:
+        # a song written just before an interrupted run isn't in the manifest yet
+        if md5 in f[split]:
+            del f[split][md5]
+        h5h.create_note_dataset(
+            f[split], md5, arr, columns,
+            compression=compression,
+            compression_level=compression_level,
+            chunk_rows=chunk_rows
         )
+        written[md5] = h5h.source_entry(rf'{lmd_root}/{md5[0]}/{md5}.mid', f'/{split}/{md5}', split)
+    manifest.update(written)
+    h5h.append_manifest(f, written)
+
+
+if __name__ == '__main__':
+    with open(cleansed_ids_path) as f:
+        rows = f.readlines()
+    md5s = sorted(set(x.split(' ')[0] for x in rows))
+    sources = {md5: rf'{lmd_root}/{md5[0]}/{md5}.mid' for md5 in md5s}
+
+    start_time = time.time()
+    num_failed = 0
+    with h5py.File(dset_path, 'a') as f, Pool(num_workers) as pool:
+        if f.attrs.get('beat_multiplier', params.beat_multiplier) != params.beat_multiplier:
+            raise ValueError(f'{dset_path} was built with a different beat_multiplier; '
+                             f'delete it to rebuild from scratch')
+        f.attrs['beat_multiplier'] = params.beat_multiplier
+        for split in ['train', 'test', 'validate']:
+            f.require_group(split)
+
+        # reruns only parse new and changed files, and drop songs whose files were removed
+        manifest, to_build = h5h.update_manifest(f, sources)
+        print(f'{len(md5s) - len(to_build)} of {len(md5s)} files unchanged since the last build')
+
+        pending = []
+        for i, (md5, arr) in enumerate(pool.imap_unordered(parse_song, to_build, chunksize=16)):
+            if arr is None:
+                num_failed += 1
+                manifest[md5] = h5h.source_entry(sources[md5], '', '')
+                h5h.append_manifest(f, {md5: manifest[md5]})
+            else:
+                split = h5h.hash_split(md5, params.test_proportion, params.validate_proportion)
+                pending.append((md5, split, arr))
+
+            if len(pending) >= write_batch_size:
+                write_songs(f, pending, manifest)
+                pending = []
+
+            if not i % 250:
+                elapsed = time.time() - start_time
+                print(f'{i} of {len(to_build)}, {(i + 1) / elapsed:.1f} files/s with {num_workers} workers, '
+                      f'{num_failed} failed...')
+
+        write_songs(f, pending, manifest)
+        h5h.write_length_index(f)
+
+    elapsed = time.time() - start_time
+    print(f'ingested {len(to_build) - num_failed} of {len(to_build)} files in {elapsed:.1f} s '
+          f'({len(to_build) / elapsed:.1f} files/s with {num_workers} workers, {num_failed} failed)')
@@ -2,64 +2,121 @@ import h5py
 import numpy as np
 import music21 as m21
 import os
+from fractions import Fraction
 import model_params as params
+import data_management.hdf5_helpers as h5h
+import data_management.parse_cache as pc
 
-paths = params.raw_data_paths
-f = h5py.File(params.dset_path, 'a')
-f.attrs['beat_multiplier'] = params.beat_multiplier
-
-train_grp = f.create_group('train')
-test_grp = f.create_group('test')
-validate_grp = f.create_group('validate')
-
-# iterate over all datasets
-for p in paths.keys():
-
-    train_subgrp = train_grp.create_group(p)
-    test_subgrp = test_grp.create_group(p)
-    validate_subgrp = validate_grp.create_group(p)
-
-    all_krns = []
-    for root, dirs, files in os.walk(paths[p]):
-        for name in files:
-            if '.krn' in name:
-                all_krns.append(os.path.join(root, name))
-    np.random.shuffle(all_krns)
-
-    split_test = np.round(params.test_proportion * len(all_krns))
-    split_validate = np.round(params.validate_proportion * len(all_krns)) + split_test
-
-    # iterate over all krn files in the current dataset
-    for i, krn_fname in enumerate(all_krns):
-
-        print(f'processing {krn_fname} | {i} of {len(all_krns)} in {p}')
-        krn = m21.converter.parse(krn_fname)
-        arr = np.array([[
-            n.pitch.midi if n.isNote else 0,
-            int(n.offset * params.beat_multiplier),
-            int(n.duration.quarterLength * params.beat_multiplier)
-        ] for n in krn.flat.notesAndRests])
-
-        if i <= split_test:
-            selected_subgrp = test_subgrp
-        elif i <= split_validate:
-            selected_subgrp = validate_subgrp
-        else:
-            selected_subgrp = train_subgrp
-
-        dset = selected_subgrp.create_dataset(
-            name=krn_fname.split('\\')[-1],
-            data=arr
+# on-disk storage: each column is stored with its narrowest dtype. compression is one of
+# None, 'lzf' or 'gzip'; chunk_rows = None lets h5py choose chunk shapes.
+columns = ['pitch', 'onset', 'duration']
+compression = 'gzip'
+compression_level = 4
+chunk_rows = None
+
+# parsed files are cached in parse_cache_dir, keyed by the hash of each file, so that the hdf5
+# file can be rebuilt with a different beat_multiplier without parsing again. parsing runs in a
+# pool of num_workers processes.
+parse_cache_dir = r'./parse_cache'
+num_workers = 8
+
+
+def extract_krn(fpath):
+    '''
+    parses the krn file at @fpath into an array with one row per note or rest: midi pitch (0 for
+    rests), then offset and duration as exact fractions of a quarter note (numerator and
+    denominator of each), so that it doesn't depend on the beat multiplier. also keeps the first
+    time signature and key, if there are any.
+    '''
+    krn = m21.converter.parse(fpath)
+    rows = []
+    for n in krn.flat.notesAndRests:
+        offset = Fraction(n.offset)
+        length = Fraction(n.duration.quarterLength)
+        rows.append((n.pitch.midi if n.isNote else 0,
+                     offset.numerator, offset.denominator, length.numerator, length.denominator))
+
+    try:
+        time_sig = list(krn.flat.getElementsByClass('TimeSignature'))[0]
+        time_sig = (time_sig.numerator, time_sig.denominator)
+    except IndexError:
+        time_sig = (-1, -1)
+
+    try:
+        key = list(krn.flat.getElementsByClass('Key'))[0].tonicPitchNameWithCase
+    except IndexError:
+        key = ''
+
+    return {'notes': np.array(rows, dtype='int64').reshape(-1, 5),
+            'time_signature': np.array(time_sig), 'key': np.array(key)}
+
+
+def krn_to_array(parsed):
+    pitch, off_num, off_den, len_num, len_den = parsed['notes'].T
+    return np.stack([
+        pitch,
+        off_num * params.beat_multiplier // off_den,
+        len_num * params.beat_multiplier // len_den
+    ], 1)
+
+
+if __name__ == '__main__':
+    paths = params.raw_data_paths
+    f = h5py.File(params.dset_path, 'a')
+    if f.attrs.get('beat_multiplier', params.beat_multiplier) != params.beat_multiplier:
+        raise ValueError(f'{params.dset_path} was built with a different beat_multiplier; '
+                         f'delete it to rebuild from scratch')
+    f.attrs['beat_multiplier'] = params.beat_multiplier
+
+    train_grp = f.require_group('train')
+    test_grp = f.require_group('test')
+    validate_grp = f.require_group('validate')
+
+    # every krn file is identified by its dataset and file name
+    sources = {}
+    for p in paths.keys():
+        for root, dirs, files in os.walk(paths[p]):
+            for name in files:
+                if '.krn' in name:
+                    sources[f'{p}/{name}'] = os.path.join(root, name)
+
+    # reruns only parse new and changed files, and drop songs whose files were removed
+    manifest, to_build = h5h.update_manifest(f, sources)
+    print(f'{len(sources) - len(to_build)} of {len(sources)} files unchanged since the last build')
+
+    # iterate over all new or changed krn files
+    fpaths = [sources[song_id] for song_id in to_build]
+    parsed_files = pc.parse_all(fpaths, extract_krn, parse_cache_dir, num_workers)
+    for i, (song_id, (krn_fname, parsed)) in enumerate(zip(to_build, parsed_files)):
+        p, name = song_id.split('/', 1)
+
+        print(f'processing {krn_fname} | {i} of {len(to_build)}')
+        if parsed is None:
+            print(f'parsing {krn_fname} failed, skipping file')
+            manifest[song_id] = h5h.source_entry(krn_fname, '', '')
+            h5h.append_manifest(f, {song_id: manifest[song_id]})
+            continue
+        arr = krn_to_array(parsed)
+
+        split = h5h.hash_split(song_id, params.test_proportion, params.validate_proportion)
+        selected_subgrp = f[split].require_group(p)
+
+        # a song written just before an interrupted run isn't in the manifest yet
+        if name in selected_subgrp:
+            del selected_subgrp[name]
+        dset = h5h.create_note_dataset(
+            selected_subgrp, name, arr, columns,
+            compression=compression,
+            compression_level=compression_level,
+            chunk_rows=chunk_rows
         )
 
-        try:
-            time_sig = list(krn.flat.getElementsByClass('TimeSignature'))[0]
-            dset.attrs['time_signature'] = (time_sig.numerator, time_sig.denominator)
-        except IndexError:
-            dset.attrs['time_signature'] = (-1, -1)
-
-        try:
-            key = list(krn.flat.getElementsByClass('Key'))[0]
-            dset.attrs['key'] = key.tonicPitchNameWithCase
-        except IndexError:
-            dset.attrs['key'] = -1
+        dset.attrs['time_signature'] = tuple(parsed['time_signature'])
+        key = str(parsed['key'])
+        dset.attrs['key'] = key if key else -1
+
+        manifest[song_id] = h5h.source_entry(krn_fname, dset.name, split)
+        h5h.append_manifest(f, {song_id: manifest[song_id]})
+
+    h5h.write_length_index(f)
+    f.close()
@@ -1,8 +1,10 @@
 import music21 as m21
 import os
-from collections import namedtuple
+from fractions import Fraction
 import numpy as np
 import h5py
+import data_management.hdf5_helpers as h5h
+import data_management.parse_cache as pc
 
 test_proportion = 0.1
 validate_proportion = 0.1
@@ -12,100 +14,129 @@ beat_multiplier = 48
 quartets_root = r"D:\Documents\datasets\just_quartets"
 train_val_test_split = True
 
+# on-disk storage: each column is stored with its narrowest dtype. compression is one of
+# None, 'lzf' or 'gzip'; chunk_rows = None lets h5py choose chunk shapes.
+columns = ['voice', 'onset', 'next_onset', 'duration', 'pitch', 'diatonic_pitch', 'accidental']
+compression = 'gzip'
+compression_level = 4
+chunk_rows = None
+
 keys = ['ABC', 'kernscores', 'felix']
-c = m21.converter.Converter()
 
-with h5py.File(dset_path, 'a') as f:
-    f.attrs['beat_multiplier'] = beat_multiplier
-    if train_val_test_split:
-        train_grp = f.create_group('train')
-        test_grp = f.create_group('test')
-        validate_grp = f.create_group('validate')
+# parsed scores are cached in parse_cache_dir, keyed by the hash of each file, so that the hdf5
+# file can be rebuilt with a different beat_multiplier without parsing again. parsing runs in a
+# pool of num_workers processes.
+parse_cache_dir = r'./parse_cache'
+num_workers = 8
 
 # voice, start, time_to_next_offset, duration, midi_pitch, notated_pitch, accidental
 
-def m21_note_to_tuple(x, voice_num, previous_offset):
-
-    pitches = x.pitches if not x.isRest else (m21.pitch.Pitch(midi=0),)
-
-    n = [(
-        # voice number
-        voice_num, 
-        # start beat in quarter notes
-        int(x.offset * beat_multiplier),
-        # time since previous offset, in quarter notes
-        max(0, int(x.offset * beat_multiplier - previous_offset)),
-        # duration in quarter notes
-        int(x.duration.quarterLength * beat_multiplier),
-        # MIDI pitch
-        p.midi if not x.isRest else 0,
-        # diatonic pitch
-        p.diatonicNoteNum if not x.isRest else 0,
-        # accidental
-        p.accidental.alter if (not x.isRest and p.accidental) else 0
-    ) for p in pitches]
-
-    return n
-
-
-for k in keys:
-    files = os.listdir(os.path.join(quartets_root, k))
-    np.random.shuffle(files)
-
-    split_test = int(np.round(test_proportion * len(files)))
-    split_validate = int(np.round(validate_proportion * len(files)) + split_test)
-
-    for i, fname in enumerate(files):
-
-        print(f'parsing {k}/{fname}...')
-
-        fpath = os.path.join(quartets_root, k, fname)
-        try:
-            parsed_file = m21.converter.parse(fpath)
-        except Exception:
-            print(f'parsing {k}/{fname} failed, skipping file')
-            continue
-        parts = list(parsed_file.getElementsByClass(m21.stream.Part))
-
-
-        prev_note_offset = 0
-        all_notes = []
-        for j, p in enumerate(parts):
-            all_notes.extend([(n, j) for n in p.flat.notesAndRests if
-            n.isNote or (n.isChord and len(n.pitches) > 0) or n.isRest])
-        # sort notes by offset, then voice number, then pitch
-        all_notes = sorted(all_notes, key=lambda x: (
-           x[1], x[0].offset, 0 if x[0].isRest else x[0].pitches[0].midi, 
-        ))
-
-        notes = []
-        for item in all_notes:
-            notes.extend(m21_note_to_tuple(item[0], item[1], prev_note_offset))
-            prev_note_offset = notes[-1][1]
-
-        # for i, p in enumerate(parts):
-        #     for item in p.flat.notesAndRests:
-        #         notes.extend(m21_note_to_tuple(item, i, prev_note_offset))
-        #         prev_note_offset = notes[-1][1]
-
-        # we want each note to have "time to NEXT onset" in index 2. this is a pain to calculate on the fly.
-        # so we calculate "time since previous onset" and just shift all these indices one step back.
-        arr = np.array(notes)
-        arr[:, 2] = np.roll(arr[:, 2], -1)
-
-        with h5py.File(dset_path, 'a') as f:
-            if not train_val_test_split:
-                selected_subgrp = f
-            elif i <= split_test:
-                selected_subgrp = f['test']
-            elif i <= split_validate:
-                selected_subgrp = f['validate']
-            else:
-                selected_subgrp = f['train']
-
-            name = rf'{k}-{fname}'
-            dset = selected_subgrp.create_dataset(
-                name=name,
-                data=arr,
-                compression='gzip'
+
+def extract_quartet(fpath):
+    '''
+    parses the score at @fpath into arrays with one row per pitch of each note, chord or rest,
+    sorted by voice, then offset, then pitch. offsets and durations are kept as exact fractions of
+    a quarter note, so that the arrays don't depend on the beat multiplier. returns None if the
+    score has no notes.
+    '''
+    parsed_file = m21.converter.parse(fpath)
+    parts = list(parsed_file.getElementsByClass(m21.stream.Part))
+
+    all_notes = []
+    for j, p in enumerate(parts):
+        all_notes.extend([(n, j) for n in p.flat.notesAndRests if
+        n.isNote or (n.isChord and len(n.pitches) > 0) or n.isRest])
+    # sort notes by offset, then voice number, then pitch
+    all_notes = sorted(all_notes, key=lambda x: (
+       x[1], x[0].offset, 0 if x[0].isRest else x[0].pitches[0].midi, 
+    ))
+    if not all_notes:
+        return None
+
+    rows = []
+    alters = []
+    for i, (x, voice_num) in enumerate(all_notes):
+        offset = Fraction(x.offset)
+        length = Fraction(x.duration.quarterLength)
+        pitches = x.pitches if not x.isRest else (None,)
+        for p in pitches:
+            rows.append((
+                i, voice_num, offset.numerator, offset.denominator, length.numerator, length.denominator,
+                p.midi if p is not None else 0,
+                p.diatonicNoteNum if p is not None else 0))
+            alters.append(p.accidental.alter if (p is not None and p.accidental) else 0)
+
+    return {'notes': np.array(rows, dtype='int64'), 'alters': np.array(alters, dtype='float64')}
+
+
+def quartet_to_array(parsed):
+    '''
+    turns the arrays made by extract_quartet into the stored format, one row per note.
+    '''
+    element, voice, off_num, off_den, len_num, len_den, midi, diatonic = parsed['notes'].T
+    onsets = off_num * beat_multiplier // off_den
+    durations = len_num * beat_multiplier // len_den
+
+    # time since the onset of the previous note, rest or chord, or 0 when moving to a new voice
+    first_rows = np.concatenate([[True], element[1:] != element[:-1]])
+    element_onsets = onsets[first_rows]
+    prev_onsets = np.concatenate([[0], element_onsets[:-1]])[element]
+    since_prev = np.maximum(0, onsets - prev_onsets)
+
+    # we want each note to have "time to NEXT onset" in index 2. this is a pain to calculate on the fly.
+    # so we calculate "time since previous onset" and just shift all these indices one step back.
+    arr = np.stack([voice, onsets, np.roll(since_prev, -1), durations, midi, diatonic, parsed['alters']], 1)
+    if not np.any(parsed['alters'] % 1):
+        arr = arr.astype('int64')
+    return arr
+
+
+if __name__ == '__main__':
+    # every file is identified by its folder and name
+    sources = {}
+    for k in keys:
+        for fname in sorted(os.listdir(os.path.join(quartets_root, k))):
+            sources[rf'{k}-{fname}'] = os.path.join(quartets_root, k, fname)
+
+    with h5py.File(dset_path, 'a') as f:
+        if f.attrs.get('beat_multiplier', beat_multiplier) != beat_multiplier:
+            raise ValueError(f'{dset_path} was built with a different beat_multiplier; '
+                             f'delete it to rebuild from scratch')
+        f.attrs['beat_multiplier'] = beat_multiplier
+        if train_val_test_split:
+            train_grp = f.require_group('train')
+            test_grp = f.require_group('test')
+            validate_grp = f.require_group('validate')
+
+        # reruns only parse new and changed files, and drop songs whose files were removed
+        manifest, to_build = h5h.update_manifest(f, sources)
+        print(f'{len(sources) - len(to_build)} of {len(sources)} files unchanged since the last build')
+
+        fpaths = [sources[name] for name in to_build]
+        parsed_files = pc.parse_all(fpaths, extract_quartet, parse_cache_dir, num_workers)
+        for name, (fpath, parsed) in zip(to_build, parsed_files):
+
+            print(f'parsed {name}')
+            if parsed is None:
+                print(f'parsing {name} failed, skipping file')
+                manifest[name] = h5h.source_entry(fpath, '', '')
+                h5h.append_manifest(f, {name: manifest[name]})
+                continue
+            arr = quartet_to_array(parsed)
+
+            split = h5h.hash_split(name, test_proportion, validate_proportion) if train_val_test_split else ''
+            selected_subgrp = f[split] if split else f
+
+            # a song written just before an interrupted run isn't in the manifest yet
+            if name in selected_subgrp:
+                del selected_subgrp[name]
+            dset = h5h.create_note_dataset(
+                selected_subgrp, name, arr, columns,
+                compression=compression,
+                compression_level=compression_level,
+                chunk_rows=chunk_rows
             )
+            manifest[name] = h5h.source_entry(fpath, dset.name, split)
+            h5h.append_manifest(f, {name: manifest[name]})
+
+        h5h.write_length_index(f)
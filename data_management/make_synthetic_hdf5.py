@@ -1,46 +1,147 @@
+import time
+import argparse
 import h5py
 import numpy as np
-import model_params as params
+import data_management.hdf5_helpers as h5h
 
-f = h5py.File('synthetic_repetition_dset.hdf5', 'a')
-num_sequences = 20000
+# every split is written as packed groups of at most songs_per_block songs each: one flat array
+# of notes along with the offset at which each song starts, rather than one dataset per song.
+# the loaders address the songs of a packed group as <group>#<index>.
+songs_per_block = 10000
+
+# repetition mode: each sequence is a random substring of values repeated a few times
 val_range = 50
 len_range = (5, 15)
 repeat_range = (3, 6)
 
-train_grp = f.create_group('train')
-test_grp = f.create_group('test')
-validate_grp = f.create_group('validate')
+# note tuple mode: songs have the columns of make_lmd_hdf5.py, with times in units of
+# 1 / beat_multiplier seconds
+note_columns = ['onset', 'duration', 'next_onset', 'pitch', 'velocity', 'program']
+beat_multiplier = 24
+onset_deltas = np.array([0, 0, 3, 6, 6, 12, 12, 24])
+durations = np.array([3, 6, 12, 24, 48])
+pitch_range = (21, 108)
+max_pitch_step = 7
+
+
+def segment_ids(offsets):
+    '''
+    the index of the song each row belongs to, for songs in rows offsets[i]:offsets[i + 1].
+    '''
+    return np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+
+
+def segment_cumsum(x, offsets):
+    '''
+    cumulative sums of @x restarting at each song, for songs in rows offsets[i]:offsets[i + 1].
+    '''
+    totals = np.cumsum(x)
+    starts = np.concatenate([[0], totals])[offsets[:-1]]
+    return totals - np.repeat(starts, np.diff(offsets))
+
+
+def make_repetition_block(rng, num_sequences):
+    '''
+    sequences of a random substring of values in [1, val_range) repeated a random number of
+    times, as a flat 1d array and the offsets of each sequence.
+    '''
+    subs_lens = rng.randint(len_range[0], len_range[1], num_sequences)
+    subs_rpts = rng.randint(repeat_range[0], repeat_range[1], num_sequences)
+    subs_offsets = np.concatenate([[0], np.cumsum(subs_lens)])
+    offsets = np.concatenate([[0], np.cumsum(subs_lens * subs_rpts)])
+    values = rng.randint(1, val_range, subs_offsets[-1])
+
+    # the j-th value of a sequence is the (j mod substring length)-th value of its substring
+    seq_ids = segment_ids(offsets)
+    pos = np.arange(offsets[-1]) - offsets[seq_ids]
+    return values[subs_offsets[seq_ids] + pos % subs_lens[seq_ids]], offsets
+
+
+def make_notetuple_block(rng, num_songs, song_len_range):
+    '''
+    random songs in the format of make_lmd_hdf5.py, as a flat 2d array and the offsets of each
+    song. onsets advance by random steps, and pitches take a random walk within pitch_range from
+    a random start, under a single random program per song.
+    '''
+    song_lens = rng.randint(song_len_range[0], song_len_range[1], num_songs)
+    offsets = np.concatenate([[0], np.cumsum(song_lens)])
+    song_ids = segment_ids(offsets)
+    num_notes = offsets[-1]
+
+    deltas = onset_deltas[rng.randint(len(onset_deltas), size=num_notes)]
+    deltas[offsets[:-1]] = 0
+    steps = rng.randint(-max_pitch_step, max_pitch_step + 1, num_notes)
+    steps[offsets[:-1]] = rng.randint(pitch_range[0], pitch_range[1] + 1, num_songs)
 
-# iterate over all datasets
-train_subgrp = train_grp.create_group('syn')
-test_subgrp = test_grp.create_group('syn')
-validate_subgrp = validate_grp.create_group('syn')
+    arr = np.zeros([num_notes, len(note_columns)], dtype='int64')
+    arr[:, 0] = segment_cumsum(deltas, offsets)
+    arr[:, 1] = durations[rng.randint(len(durations), size=num_notes)]
+    arr[:-1, 2] = deltas[1:]
+    arr[offsets[1:] - 1, 2] = 0
 
-split_test = np.round(params.test_proportion * num_sequences)
-split_validate = np.round(params.validate_proportion * num_sequences) + split_test
+    # the walk is reflected back into pitch_range at its ends
+    span = pitch_range[1] - pitch_range[0]
+    walk = np.mod(segment_cumsum(steps, offsets) - pitch_range[0], 2 * span)
+    arr[:, 3] = pitch_range[0] + span - np.abs(walk - span)
+    arr[:, 4] = rng.randint(40, 110, num_notes)
+    arr[:, 5] = rng.randint(0, 128, num_songs)[song_ids]
+    return arr, offsets
 
-# iterate over all krn files in the current dataset
-for i in range(num_sequences):
 
-    if not i % 100:
-        print(f'creating sequence {i} of {num_sequences}...')
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Writes a synthetic hdf5 dataset, for testing models and benchmarking loaders '
+                    'without the real corpora.')
+    parser.add_argument('-m', '--mode', choices=['repetition', 'notetuple'], default='repetition',
+                        help='repetition: 1d sequences of repeated substrings. notetuple: songs '
+                             'that MidiNoteTupleDataset can read, like those of make_lmd_hdf5.py.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='File to write (default: synthetic_<mode>_dset.hdf5). Overwritten.')
+    parser.add_argument('-n', '--num_sequences', type=int, default=20000, help='Number of songs.')
+    parser.add_argument('-l', '--song_length', type=int, nargs=2, default=[200, 2000],
+                        help='Range of song lengths, in notes, in notetuple mode.')
+    parser.add_argument('-t', '--test_proportion', type=float, default=0.1)
+    parser.add_argument('-v', '--validate_proportion', type=float, default=0.1)
+    parser.add_argument('-c', '--compression', choices=['none', 'lzf', 'gzip'], default='lzf')
+    parser.add_argument('-k', '--chunk_rows', type=int, default=None,
+                        help='Rows per compressed chunk (default: the median song length of each '
+                             'block). Reading one song decompresses every chunk it touches, so '
+                             'chunks much longer than a song make reads slow.')
+    parser.add_argument('-s', '--seed', type=int, default=0)
+    args = vars(parser.parse_args())
 
-    subs_len = np.random.randint(len_range[0], len_range[1])
-    subs_rpt = np.random.randint(repeat_range[0], repeat_range[1])
-    subs = np.random.randint(1, val_range, subs_len)
-    arr = np.concatenate([subs for _ in range(subs_rpt)])
+    dset_path = args['output'] or f"synthetic_{args['mode']}_dset.hdf5"
+    compression = None if args['compression'] == 'none' else args['compression']
+    rng = np.random.RandomState(args['seed'])
 
-    if i <= split_test:
-        selected_subgrp = test_subgrp
-    elif i <= split_validate:
-        selected_subgrp = validate_subgrp
-    else:
-        selected_subgrp = train_subgrp
+    # the first songs go to the test split, then to the validate split, and the rest to train
+    num_test = int(np.round(args['test_proportion'] * args['num_sequences']))
+    num_validate = int(np.round(args['validate_proportion'] * args['num_sequences']))
+    split_sizes = {'test': num_test, 'validate': num_validate,
+                   'train': args['num_sequences'] - num_test - num_validate}
 
-    dset = selected_subgrp.create_dataset(
-        name=f'syn_{i}',
-        data=arr
-    )
+    start_time = time.time()
+    num_rows = 0
+    with h5py.File(dset_path, 'w') as f:
+        if args['mode'] == 'notetuple':
+            f.attrs['beat_multiplier'] = beat_multiplier
+        for split, split_size in split_sizes.items():
+            grp = f.create_group(split).create_group('syn')
+            for block, start in enumerate(range(0, split_size, songs_per_block)):
+                num_songs = min(songs_per_block, split_size - start)
+                if args['mode'] == 'notetuple':
+                    arr, offsets = make_notetuple_block(rng, num_songs, args['song_length'])
+                    columns = note_columns
+                else:
+                    arr, offsets = make_repetition_block(rng, num_songs)
+                    columns = None
+                chunk_rows = args['chunk_rows'] or max(1, int(np.median(np.diff(offsets))))
+                h5h.create_packed_group(grp, f'syn_{block}', arr, offsets, columns,
+                                        compression=compression, chunk_rows=chunk_rows)
+                num_rows += len(arr)
+                print(f'wrote {start + num_songs} of {split_size} {split} songs '
+                      f'({num_rows} rows, {time.time() - start_time:.1f} s)')
+        h5h.write_length_index(f)
 
-f.close()
+    print(f"wrote {args['num_sequences']} songs with {num_rows} rows to {dset_path} "
+          f'in {time.time() - start_time:.1f} s')
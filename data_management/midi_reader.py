@@ -0,0 +1,282 @@
+import numpy as np
+
+# number of data bytes following each channel message status, by the status' upper nibble
+channel_data_bytes = {0x8: 2, 0x9: 2, 0xA: 2, 0xB: 2, 0xC: 1, 0xD: 1, 0xE: 2}
+
+# columns of the note arrays returned by read_midi
+note_columns = ['program', 'start', 'end', 'pitch', 'velocity', 'is_drum']
+
+
+def read_vlq(data, pos):
+    '''
+    reads a variable-length quantity from @data starting at @pos. returns (value, next position).
+    '''
+    value = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value = (value << 7) | (b & 0x7F)
+        if b < 0x80:
+            return value, pos
+
+
+def read_chunks(data):
+    '''
+    splits a standard midi file into its header fields (format, number of tracks, division) and
+    the raw bytes of each track chunk.
+    '''
+    if data[:4] != b'MThd':
+        raise ValueError('not a standard midi file')
+    header_len = int.from_bytes(data[4:8], 'big')
+    fmt = int.from_bytes(data[8:10], 'big')
+    num_tracks = int.from_bytes(data[10:12], 'big')
+    division = int.from_bytes(data[12:14], 'big')
+
+    tracks = []
+    pos = 8 + header_len
+    while pos + 8 <= len(data) and len(tracks) < num_tracks:
+        chunk_type = data[pos:pos + 4]
+        chunk_len = int.from_bytes(data[pos + 4:pos + 8], 'big')
+        if chunk_type == b'MTrk':
+            tracks.append(data[pos + 8:pos + 8 + chunk_len])
+        pos += 8 + chunk_len
+    return fmt, num_tracks, division, tracks
+
+
+def read_track(track, track_idx, events):
+    '''
+    decodes the events of one track chunk into the lists in the dict @events:
+    'notes' - finished notes as (start tick, end tick, pitch, velocity, program, channel, track),
+        in the order notes are closed
+    'tempos' - tempo changes as (tick, microseconds per quarter)
+    'time_sigs' - time signature changes as (tick, numerator, denominator)
+    'key_sigs', 'texts' - ticks of key signatures and of text and lyric events
+    'controls' - control changes and pitch bends as (tick, channel, track)
+
+    notes are paired as pretty_midi pairs them: a note off (or note on with velocity 0) closes
+    every open note of the same pitch and channel that didn't start on the same tick, and takes
+    the program that is current on its channel when it is closed. notes that started on the same
+    tick stay open only if some other note was closed, and are dropped otherwise.
+    '''
+    notes = events['notes']
+    pos = 0
+    tick = 0
+    status = None
+    programs = [0] * 16
+    open_notes = {}
+
+    while pos < len(track):
+        # most deltas fit in one byte
+        if track[pos] < 0x80:
+            tick += track[pos]
+            pos += 1
+        else:
+            delta, pos = read_vlq(track, pos)
+            tick += delta
+
+        b = track[pos]
+        if b >= 0x80:
+            pos += 1
+            if b != 0xFF:
+                status = b
+        elif status is None:
+            raise ValueError(f'running status without a previous status in track {track_idx}')
+        else:
+            b = status
+
+        if b == 0xFF:
+            meta_type = track[pos]
+            length, pos = read_vlq(track, pos + 1)
+            meta = track[pos:pos + length]
+            pos += length
+            if meta_type == 0x51 and length == 3:
+                events['tempos'].append((tick, int.from_bytes(meta, 'big')))
+            elif meta_type == 0x58 and length >= 2:
+                events['time_sigs'].append((tick, meta[0], 2 ** meta[1]))
+            elif meta_type == 0x59:
+                events['key_sigs'].append(tick)
+            elif meta_type in (0x01, 0x05):
+                events['texts'].append(tick)
+            elif meta_type == 0x2F:
+                break
+            continue
+        elif b in (0xF0, 0xF7):
+            length, pos = read_vlq(track, pos)
+            pos += length
+            continue
+        elif b >= 0xF0:
+            pos += {0xF1: 1, 0xF2: 2, 0xF3: 1}.get(b, 0)
+            continue
+
+        kind, channel = b >> 4, b & 0x0F
+        msg = track[pos:pos + channel_data_bytes[kind]]
+        pos += channel_data_bytes[kind]
+        if len(msg) < channel_data_bytes[kind]:
+            raise ValueError(f'track {track_idx} ends in the middle of an event')
+
+        if kind == 0xC:
+            programs[channel] = msg[0]
+        elif kind == 0xB or kind == 0xE:
+            events['controls'].append((tick, channel, track_idx))
+        elif kind == 0x9 and msg[1] > 0:
+            open_notes.setdefault((channel, msg[0]), []).append((tick, msg[1]))
+        elif kind == 0x8 or kind == 0x9:
+            key = (channel, msg[0])
+            if key not in open_notes:
+                continue
+            to_keep = []
+            num_closed = 0
+            for start, velocity in open_notes[key]:
+                if start == tick:
+                    to_keep.append((start, velocity))
+                else:
+                    notes.append((start, tick, msg[0], velocity, programs[channel], channel, track_idx))
+                    num_closed += 1
+            if to_keep and num_closed:
+                open_notes[key] = to_keep
+            else:
+                del open_notes[key]
+
+
+def ticks_to_seconds(ticks, tempos, resolution):
+    '''
+    converts @ticks to seconds under the tempo map @tempos, a list of (tick, microseconds per
+    quarter) starting at tick 0.
+    '''
+    change_ticks = np.array([t for t, _ in tempos], dtype='float64')
+    secs_per_tick = np.array([us / 1e6 / resolution for _, us in tempos])
+    change_secs = np.concatenate([[0], np.cumsum(np.diff(change_ticks) * secs_per_tick[:-1])])
+
+    ticks = np.asarray(ticks, dtype='float64')
+    inds = np.searchsorted(change_ticks, ticks, side='right') - 1
+    return change_secs[inds] + (ticks - change_ticks[inds]) * secs_per_tick[inds]
+
+
+def beats_per_minute(qpm, time_sig):
+    '''
+    beats per minute for a tempo of @qpm quarter notes per minute in @time_sig, a (numerator,
+    denominator) pair or None: compound meters count three of the denominator's note per beat.
+    '''
+    if time_sig is None or time_sig[1] not in [1, 2, 4, 8, 16, 32]:
+        return qpm
+    num, den = time_sig
+    if num % 3 == 0 and num != 3:
+        return qpm / 3.0 * den / 4.0
+    return qpm * den / 4.0
+
+
+def get_beats(tempo_times, tempi, time_sigs, end_time):
+    '''
+    times of every beat before @end_time, as computed by pretty_midi's get_beats, given the times
+    and quarter note tempos of the tempo changes and the time signature changes as (time,
+    numerator, denominator), all in seconds. beats are stepped one at a time so that where a beat
+    crosses a tempo or time signature change, the result is the same as pretty_midi's.
+    '''
+    time_sigs = sorted(time_sigs, key=lambda x: x[0])
+    beats = [0.]
+    tempo_idx = 0
+    ts_idx = 0
+    while ts_idx < len(time_sigs) - 1 and beats[-1] >= time_sigs[ts_idx + 1][0]:
+        ts_idx += 1
+
+    def current_bpm():
+        return beats_per_minute(tempi[tempo_idx], time_sigs[ts_idx][1:] if time_sigs else None)
+
+    def gt_or_close(a, b):
+        return a > b or np.isclose(a, b)
+
+    while beats[-1] < end_time:
+        bpm = current_bpm()
+        next_beat = beats[-1] + 60.0 / bpm
+        if tempo_idx < len(tempo_times) - 1 and next_beat > tempo_times[tempo_idx + 1]:
+            # step through each tempo change the beat crosses
+            next_beat = beats[-1]
+            beat_remaining = 1.0
+            while (tempo_idx < len(tempo_times) - 1 and
+                   next_beat + beat_remaining * 60.0 / bpm >= tempo_times[tempo_idx + 1]):
+                overshot_ratio = (tempo_times[tempo_idx + 1] - next_beat) / (60.0 / bpm)
+                next_beat += overshot_ratio * 60.0 / bpm
+                beat_remaining -= overshot_ratio
+                tempo_idx += 1
+                bpm = current_bpm()
+            next_beat += beat_remaining * 60.0 / bpm
+        if time_sigs and ts_idx == 0:
+            if time_sigs[0][0] > beats[-1] and gt_or_close(next_beat, time_sigs[0][0]):
+                next_beat = time_sigs[0][0]
+        if ts_idx < len(time_sigs) - 1 and gt_or_close(next_beat, time_sigs[ts_idx + 1][0]):
+            next_beat = time_sigs[ts_idx + 1][0]
+            ts_idx += 1
+        beats.append(next_beat)
+    return np.array(beats[:-1])
+
+
+def read_midi(fname, with_drums=False):
+    '''
+    reads the notes of a standard midi file without building per-event objects. returns
+    (notes, beats): notes is a float64 array with one row per note and columns as in
+    note_columns, with start and end in seconds, and beats holds the time of every beat in
+    seconds. notes are ordered as they would be by listing the notes of each of pretty_midi's
+    instruments in turn. as in pretty_midi, tempo and time signature changes are only read from
+    the first track. drum notes are dropped unless @with_drums.
+    '''
+    with open(fname, 'rb') as f:
+        data = f.read()
+    fmt, num_tracks, resolution, tracks = read_chunks(data)
+    if resolution & 0x8000:
+        raise ValueError(f'{fname} uses SMPTE time division, which is not supported')
+
+    # files without tracks have no notes and keep the default tempo and time signature
+    notes, texts, controls = [], [], []
+    tempos, time_sigs, key_sigs = [], [], []
+    for track_idx, track in enumerate(tracks):
+        events = {'notes': notes, 'texts': texts, 'controls': controls,
+                  'tempos': [], 'time_sigs': [], 'key_sigs': []}
+        try:
+            read_track(track, track_idx, events)
+        except IndexError:
+            raise ValueError(f'{fname} has a truncated event in track {track_idx}')
+        if track_idx == 0:
+            tempos, time_sigs, key_sigs = events['tempos'], events['time_sigs'], events['key_sigs']
+
+    # the tempo map starts at 120 bpm, and repeated tempos are dropped
+    tempo_map = [(0, 500000)]
+    for tick, us in tempos:
+        if tick == 0:
+            tempo_map[0] = (0, us)
+        elif us != tempo_map[-1][1]:
+            tempo_map.append((tick, us))
+
+    arr = np.array(notes, dtype='int64').reshape(-1, 7)
+
+    # the end of the file is its last note end or meta event, or the last control change or pitch
+    # bend on a channel and track that has notes
+    with_notes = set(zip(arr[:, 5].tolist(), arr[:, 6].tolist()))
+    end_tick = max([arr[:, 1].max() if len(arr) else 0] +
+                   [t for t, _ in tempo_map] + [t for t, _, _ in time_sigs] + key_sigs + texts +
+                   [t for t, c, tr in controls if (c, tr) in with_notes])
+
+    # order notes by pretty_midi instrument, in order of creation, then by when they were closed
+    instruments = {}
+    inst_inds = np.array([instruments.setdefault((p, c, t), len(instruments))
+                          for p, c, t in arr[:, 4:7].tolist()], dtype='int64')
+    arr = arr[np.argsort(inst_inds, kind='stable')]
+
+    is_drum = arr[:, 5] == 9
+    notes = np.stack([
+        arr[:, 4],
+        ticks_to_seconds(arr[:, 0], tempo_map, resolution),
+        ticks_to_seconds(arr[:, 1], tempo_map, resolution),
+        arr[:, 2],
+        arr[:, 3],
+        is_drum], 1).astype('float64')
+    if not with_drums:
+        notes = notes[~is_drum]
+
+    tempo_ticks = [t for t, _ in tempo_map]
+    sig_times = ticks_to_seconds([t for t, _, _ in time_sigs], tempo_map, resolution)
+    beats = get_beats(
+        ticks_to_seconds(tempo_ticks, tempo_map, resolution),
+        [6e7 / us for _, us in tempo_map],
+        [(t, num, den) for t, (_, num, den) in zip(sig_times, time_sigs)],
+        ticks_to_seconds(end_tick, tempo_map, resolution))
+    return notes, beats
@@ -0,0 +1,57 @@
+import os
+from functools import partial
+from multiprocessing import Pool
+import numpy as np
+import data_management.hdf5_helpers as h5h
+
+
+def cache_fname(fpath, extract, cache_dir, version=1):
+    '''
+    path of the cached output of @extract for the file at @fpath, keyed by the extractor's name,
+    its @version, and a hash of the file's contents.
+    '''
+    return os.path.join(cache_dir, f'{extract.__name__}-v{version}-{h5h.file_hash(fpath)}.npz')
+
+
+def cached_parse(fpath, extract, cache_dir, version=1):
+    '''
+    runs @extract on the file at @fpath, or reads its output from @cache_dir if the same file was
+    extracted before. @extract should return a dict of numpy arrays that don't depend on any
+    encoding parameters, so that the cache stays valid when those change. returns None if the
+    file can't be parsed; failures are cached too, so that they aren't retried until the file
+    changes.
+    '''
+    cache_path = cache_fname(fpath, extract, cache_dir, version)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            arrays = dict(cached)
+        return None if 'failed' in arrays else arrays
+
+    try:
+        arrays = extract(fpath)
+    except Exception:
+        arrays = None
+
+    # write to a temporary file first, so an interrupted worker never leaves a partial entry
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f'{cache_path}.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, **(arrays if arrays is not None else {'failed': np.zeros(0)}))
+    os.replace(tmp_path, cache_path)
+    return arrays
+
+
+def parse_all(fpaths, extract, cache_dir, num_workers=8, version=1):
+    '''
+    yields (fpath, arrays) for every file in @fpaths, in order, running cached_parse over a pool
+    of @num_workers processes. @extract must be a module-level function so that it can be sent
+    to the workers.
+    '''
+    parse = partial(cached_parse, extract=extract, cache_dir=cache_dir, version=version)
+    if num_workers <= 1:
+        for fpath in fpaths:
+            yield fpath, parse(fpath)
+        return
+
+    with Pool(num_workers) as pool:
+        for fpath, arrays in zip(fpaths, pool.imap(parse, fpaths, chunksize=4)):
+            yield fpath, arrays
@@ -0,0 +1,74 @@
+import os
+import time
+import argparse
+import numpy as np
+import pretty_midi as pm
+import data_management.midi_reader as mr
+
+parser = argparse.ArgumentParser(
+    description='Checks midi_reader against pretty_midi on a random sample of midi files, and '
+                'times both.')
+parser.add_argument('midi_root', help='Folder to search for .mid files, e.g. the root of lmd_full.')
+parser.add_argument('-n', '--num_files', type=int, default=200, help='Number of files to check.')
+parser.add_argument('-s', '--seed', type=int, default=0, help='Seed for choosing files.')
+args = vars(parser.parse_args())
+
+fpaths = []
+for root, dirs, files in os.walk(args['midi_root']):
+    fpaths.extend(os.path.join(root, x) for x in files if x.lower().endswith(('.mid', '.midi')))
+fpaths = sorted(fpaths)
+rng = np.random.RandomState(args['seed'])
+fpaths = [fpaths[i] for i in rng.choice(len(fpaths), min(args['num_files'], len(fpaths)), replace=False)]
+
+
+def pretty_midi_notes(mid):
+    notes = [(inst.program, n.start, n.end, n.pitch, n.velocity, inst.is_drum)
+             for inst in mid.instruments for n in inst.notes]
+    return np.array(notes, dtype='float64').reshape(-1, len(mr.note_columns))
+
+
+pm_time = 0
+mr_time = 0
+num_checked = 0
+both_failed = 0
+notes_match = 0
+beats_match = 0
+mismatches = []
+for fpath in fpaths:
+    start_time = time.time()
+    try:
+        mid = pm.PrettyMIDI(fpath)
+        ref_notes, ref_beats = pretty_midi_notes(mid), mid.get_beats()
+    except Exception:
+        mid = None
+    pm_time += time.time() - start_time
+
+    start_time = time.time()
+    try:
+        notes, beats = mr.read_midi(fpath, with_drums=True)
+    except Exception:
+        notes = None
+    mr_time += time.time() - start_time
+
+    if mid is None or notes is None:
+        both_failed += (mid is None and notes is None)
+        if (mid is None) != (notes is None):
+            mismatches.append((fpath, 'only pretty_midi failed' if mid is None else 'only midi_reader failed'))
+        continue
+
+    num_checked += 1
+    same_notes = notes.shape == ref_notes.shape and np.allclose(notes, ref_notes, atol=1e-6)
+    same_beats = beats.shape == ref_beats.shape and np.allclose(beats, ref_beats, atol=1e-6)
+    notes_match += same_notes
+    beats_match += same_beats
+    if not same_notes:
+        mismatches.append((fpath, f'notes differ: {notes.shape[0]} vs {ref_notes.shape[0]} notes'))
+    if not same_beats:
+        mismatches.append((fpath, f'beats differ: {beats.shape[0]} vs {ref_beats.shape[0]} beats'))
+
+for fpath, reason in mismatches:
+    print(f'{fpath}: {reason}')
+print(f'{len(fpaths)} files, {both_failed} unreadable by both, {num_checked} readable by both')
+print(f'notes identical in {notes_match} of {num_checked}, beats identical in {beats_match} of {num_checked}')
+print(f'pretty_midi {pm_time / len(fpaths) * 1000:8.2f} ms/file | midi_reader {mr_time / len(fpaths) * 1000:8.2f} ms/file'
+      f' | speedup {pm_time / mr_time:5.1f}x')
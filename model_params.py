@@ -1,5 +1,9 @@
 import json
+import time
+import queue
+import atexit
 import logging, datetime
+from logging.handlers import QueueHandler, QueueListener
 
 
 class Params(object):
@@ -23,6 +27,10 @@ class Params(object):
         self.params_id_str = f'{self.params_name}_{mod_num}_{start_training_time}_{self.model_summary}'
         self.log_fname = f'./logs/training_{self.params_id_str}.log'
         self.results_fname = f'./logs/test_results_{self.params_id_str}.log'
+        self.metrics_fname = f'./logs/metrics_{self.params_id_str}.jsonl'
+        self.metrics_logger = logging.getLogger(f'metrics.{self.params_id_str}')
+        self.metrics_logger.propagate = False
+        self.metrics_listener = None
         if self.log_training:
             logging.basicConfig(filename=self.log_fname, filemode='w', level=logging.INFO,
                                 format='%(asctime)s %(message)s', datefmt='%m/%d/%Y %H:%M:%S')
@@ -41,6 +49,44 @@ class Params(object):
             logging.info(f'applying modification {m} to parameters.')
             self.apply_mod(m)
 
+        if self.log_training:
+            self.start_metrics_log()
+            self.log_metrics('run', params={k: self.__dict__[k] for k in params.keys()},
+                             modification=self.modifications[mod_num - 1] if mod_num > 0 else None)
+
+    def start_metrics_log(self):
+        '''
+        makes log_metrics write to metrics_fname. records are put on a queue and written to the
+        file by a background thread, so that training never waits on the disk.
+        '''
+        records = queue.Queue()
+        handler = logging.FileHandler(self.metrics_fname, mode='w')
+        handler.setFormatter(logging.Formatter('%(message)s'))
+        self.metrics_listener = QueueListener(records, handler)
+        self.metrics_logger.addHandler(QueueHandler(records))
+        self.metrics_logger.setLevel(logging.INFO)
+        self.metrics_listener.start()
+        atexit.register(self.stop_metrics_log)
+
+    def stop_metrics_log(self):
+        '''
+        writes out any records still queued for the metrics log. called on exit.
+        '''
+        if self.metrics_listener is not None:
+            self.metrics_listener.stop()
+            self.metrics_listener = None
+
+    def log_metrics(self, kind, **values):
+        '''
+        writes @values to the metrics log as one line of json, tagged with the @kind of record
+        ('run', 'epoch' or 'step'), the id of this run and the time. does nothing unless logging
+        training.
+        '''
+        if not self.metrics_logger.handlers:
+            return
+        record = {'kind': kind, 'run': self.params_id_str, 'time': time.time(), **values}
+        self.metrics_logger.info(json.dumps(record, default=float))
+
     def apply_mod(self, mod):
         name, val = mod
         if not name:
@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+from torch.nn.utils.rnn import pack_padded_sequence, pad_packed_sequence
 from fast_transformers.builders import TransformerEncoderBuilder
 from fast_transformers.attention.attention_layer import AttentionLayer
 from fast_transformers.attention.linear_attention import LinearAttention
@@ -40,18 +41,38 @@ class LSTUT(nn.Module):
         self.lstm2 = nn.LSTM(self.d_model, self.d_model // 2, self.lstm_layers, batch_first=True, bidirectional=True)
         self.final_ff = nn.Linear(self.d_model, self.output_feats)
 
-    def forward(self, src):
+    def run_lstm(self, lstm, x, lengths=None):
+        lstm.flatten_parameters()
+        if lengths is None:
+            x, _ = lstm(x)
+            return x
+
+        # pack sequences so that the lstm skips padded positions entirely
+        seq_len = x.shape[1]
+        packed = pack_padded_sequence(x, lengths.cpu(), batch_first=True, enforce_sorted=False)
+        x, _ = lstm(packed)
+        x, _ = pad_packed_sequence(x, batch_first=True, total_length=seq_len)
+        return x
+
+    def forward(self, src, lengths=None):
+        '''
+        @src - batch of shape (batch, seq_len, num_feats)
+        @lengths - true length of each sequence in @src (optional). if given, positions past
+            each sequence's length are masked out of attention and skipped by the lstms.
+        '''
 
         x = self.initial_ff(src)
 
-        self.lstm1.flatten_parameters()
-        x, _ = self.lstm1(x)
+        x = self.run_lstm(self.lstm1, x, lengths)
+
+        length_mask = None
+        if lengths is not None:
+            length_mask = LengthMask(lengths, max_len=x.shape[1], device=x.device)
 
         for i in range(self.tf_depth):
-            x = self.encoder(x)
+            x = self.encoder(x, length_mask=length_mask)
 
-        self.lstm2.flatten_parameters()
-        x, _ = self.lstm2(x)
+        x = self.run_lstm(self.lstm2, x, lengths)
 
         x = self.final_ff(x)
 
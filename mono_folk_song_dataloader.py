@@ -1,53 +1,118 @@
 from torch.utils.data import IterableDataset, DataLoader
 import factorizations as fcts
 from importlib import reload
-from collections import Counter
+from multiprocessing import Pool
+import os
+import json
+import hashlib
 import torch
 import numpy as np
 import h5py
 import logging
 import model_params as params
+import data_management.hdf5_helpers as h5h
+import data_augmentation.batch_augmentation as bat_aug
+from functools import partial
 reload(fcts)
 
 
 def all_hdf5_keys(obj):
     '''
-    Recursively find all hdf5 keys subordinate to the given object @obj, corresponding to datasets.
+    Recursively find all hdf5 keys subordinate to the given object @obj, corresponding to songs:
+    datasets, apart from the build manifest and length index at the root of the file, and the
+    songs of packed groups, as <group>#<index>.
     '''
-    name_list = []
+    return h5h.song_keys(obj)
 
-    def visitor_func(name, node):
-        if isinstance(node, h5py.Dataset):
-            name_list.append(name)
-        else:
-            pass
-
-    obj.visititems(visitor_func)
-    return name_list
-
-
-def get_tick_deltas_for_runlength(f, fnames, num_dur_vals=16, proportion=0.5):
-
-    num_choice = int(proportion * len(fnames))
-    fnames = np.random.choice(fnames, num_choice, replace=False)
-
-    c = Counter()
-    pitch_c = Counter()
-
-    for i, fname in enumerate(fnames):
-        arr = f[fname]
-        all_starts = arr[:, 1]
-        all_pitches = [x for x in arr[:, 0] if x > 0]
-        pitch_c.update(all_pitches)
 
-        diffs = np.diff(all_starts)
-        c.update(diffs)
+def count_values(dset_fname, paths, with_duration):
+    '''
+    counts of each nonzero pitch and, if @with_duration, each onset delta over the songs at
+    @paths in the hdf5 file @dset_fname, as (values, counts) pairs from np.unique. opens its own
+    handle to the file so that it can run in a worker process.
+    '''
+    pitches = [np.zeros(0, dtype='int64')]
+    deltas = [np.zeros(0, dtype='int64')]
+    offsets_cache = {}
+    with h5py.File(dset_fname, 'r') as f:
+        for path in paths:
+            arr = h5h.read_song(f, path, offsets_cache)
+            song_pitches = arr[:, 0] if with_duration else arr
+            pitches.append(song_pitches[song_pitches > 0])
+            if with_duration:
+                deltas.append(np.diff(arr[:, 1]))
+    return (np.unique(np.concatenate(pitches), return_counts=True),
+            np.unique(np.concatenate(deltas), return_counts=True))
+
+
+def merge_counts(counts):
+    '''
+    sums a list of (values, counts) pairs from np.unique into a single pair.
+    '''
+    vals, inv = np.unique(np.concatenate([c[0] for c in counts]), return_inverse=True)
+    return vals, np.bincount(inv, weights=np.concatenate([c[1] for c in counts])).astype('int64')
 
-        if not i % 2000:
-            logging.info(f"processing tick deltas: {i} of {len(fnames)}")
 
-    top_durs = c.most_common(num_dur_vals)
-    most = np.sort([x[0] for x in top_durs])
+def get_vocab_counts(f, fnames, with_duration=True, proportion=0.5, num_workers=1):
+    '''
+    counts of pitches and onset deltas over a fixed random @proportion of @fnames, reduced over
+    chunks of songs in parallel. counts are stored in a json file next to the hdf5 file, keyed by
+    the hdf5 file's size and modification time and by the songs counted, and read from there
+    when available.
+    '''
+    num_choice = max(1, int(proportion * len(fnames)))
+    fnames = np.random.RandomState(0).choice(sorted(fnames), num_choice, replace=False)
+    paths = sorted(h5h.song_path(f, fname) for fname in fnames)
+
+    dset_fname = f.file.filename
+    st = os.stat(dset_fname)
+    h = hashlib.sha1(f'{st.st_size}-{st.st_mtime_ns}-{with_duration}'.encode())
+    h.update('\n'.join(paths).encode())
+    key = h.hexdigest()
+    cache_fname = f'{dset_fname}.vocab.json'
+
+    try:
+        with open(cache_fname, 'r') as cf:
+            entry = json.load(cf)[key]
+        return tuple((np.array(entry[k][0], dtype='int64'), np.array(entry[k][1], dtype='int64'))
+                     for k in ['pitches', 'deltas'])
+    except (OSError, ValueError, KeyError):
+        pass
+
+    chunks = [paths[i::num_workers] for i in range(num_workers)]
+    args = [(dset_fname, c, with_duration) for c in chunks]
+    logging.info(f'counting pitches and tick deltas over {len(paths)} songs')
+    if num_workers > 1:
+        with Pool(num_workers) as pool:
+            counts = pool.starmap(count_values, args)
+    else:
+        counts = [count_values(*a) for a in args]
+    pitch_counts = merge_counts([c[0] for c in counts])
+    delta_counts = merge_counts([c[1] for c in counts])
+
+    try:
+        with open(cache_fname, 'r') as cf:
+            cache = json.load(cf)
+    except (OSError, ValueError):
+        cache = {}
+    cache[key] = {'pitches': [x.tolist() for x in pitch_counts], 'deltas': [x.tolist() for x in delta_counts]}
+    try:
+        with open(cache_fname, 'w') as cf:
+            json.dump(cache, cf)
+    except OSError:
+        logging.warning(f'could not write vocabulary cache to {cache_fname}')
+
+    return pitch_counts, delta_counts
+
+
+def get_tick_deltas_for_runlength(f, fnames, num_dur_vals=16, proportion=0.5, num_workers=1):
+
+    (pitch_vals, _), (delta_vals, delta_counts) = get_vocab_counts(
+        f, fnames, True, proportion, num_workers)
+
+    # most common deltas first, breaking ties by the smaller delta
+    top_durs = delta_vals[np.lexsort((delta_vals, -delta_counts))][:num_dur_vals]
+    most = np.sort(top_durs)
 
     if len(most) < num_dur_vals:
         logging.warn(f'requested number of duration values {num_dur_vals} is too large for actual '
@@ -59,23 +124,40 @@ def get_tick_deltas_for_runlength(f, fnames, num_dur_vals=16, proportion=0.5):
     # deltas = {v: i for i, v in enumerate(most)}
     deltas = most
 
-    pitch_range = (min(pitch_c.keys()), max(pitch_c.keys()))
+    pitch_range = (int(pitch_vals.min()), int(pitch_vals.max()))
 
     return deltas, pitch_range
 
 
-def get_pitch_range_no_duration(f, fnames, proportion=0.5):
-    num_choice = int(proportion * len(fnames))
-    fnames = np.random.choice(fnames, num_choice, replace=False)
-    pitch_c = Counter()
+def get_pitch_range_no_duration(f, fnames, proportion=0.5, num_workers=1):
+    (pitch_vals, _), _ = get_vocab_counts(f, fnames, False, proportion, num_workers)
+    pitch_range = (int(pitch_vals.min()), int(pitch_vals.max()))
+    return pitch_range
 
-    for i, fname in enumerate(fnames):
-        arr = f[fname]
-        all_pitches = [x for x in arr if x > 0]
-        pitch_c.update(all_pitches)
 
-    pitch_range = (min(pitch_c.keys()), max(pitch_c.keys()))
-    return pitch_range
+def encode_songs(dset_fname, paths, deltas, pitch_range, with_duration):
+    '''
+    sparse runlength encodings of the songs at @paths in the hdf5 file @dset_fname. opens its own
+    handle to the file so that it can run in a worker process.
+    '''
+    offsets_cache = {}
+    with h5py.File(dset_fname, 'r') as f:
+        return [fcts.arr_to_runlength_mono_indices(
+            h5h.read_song(f, path, offsets_cache), deltas, pitch_range, with_duration) for path in paths]
+
+
+def sparse_to_one_hot(batch, offsets, num_feats, dtype=torch.float32):
+    '''
+    expands a tensor of (pitch index, duration index, flag index) triples, as yielded by
+    MonoFolkSongDataset in sparse mode, into one-hot rows of length @num_feats. @offsets are the
+    columns at which the pitch, duration and flag subvectors start. indices of -1 set nothing.
+    the result is made on the same device as @batch.
+    '''
+    inds = batch.long()
+    is_set = inds >= 0
+    cols = torch.where(is_set, inds + torch.tensor(offsets, device=inds.device), torch.zeros_like(inds))
+    out = torch.zeros(*inds.shape[:-1], num_feats, dtype=dtype, device=inds.device)
+    return out.scatter_add_(-1, cols, is_set.to(dtype))
 
 
 class MonoFolkSongDataset(IterableDataset):
@@ -83,7 +165,8 @@ class MonoFolkSongDataset(IterableDataset):
 
     def __init__(self, dset_fname, seq_length, num_dur_vals, base=None, use_stats=None,
                  proportion_for_stats=0.5, shuffle_files=True, padding_amt=None,
-                 random_offsets=True, random_transpose=6, dataset_proportion=False):
+                 random_offsets=True, random_transpose=6, dataset_proportion=False, subset_seed=0,
+                 sparse=False, encoding_cache=False, cache_workers=1):
         """
         @dset_fname - path to hdf5 file created by make_hdf5.py
         @seq_length - number of units to chop sequences into
@@ -91,13 +174,27 @@ class MonoFolkSongDataset(IterableDataset):
         @num_dur_vals - the number of most common duration values to calculate (optional)
         @use_stats - input another MonoFolkSongDataset's get_stats() into this argument to use its
             calculated stats for generating training batches (optional)
-        @proportion_for_stats - in (0, 1]. calculates stats on a random subset of the dataset
-            in the hdf5 file (optional)
+        @proportion_for_stats - in (0, 1]. calculates stats on a fixed random subset of the
+            dataset in the hdf5 file. the counts are kept next to the hdf5 file (optional)
         @shuffle_files - randomizes order of loading songs from hdf5 file (optional)
         @padding_amt - amount of padding to add to beginning and end of each song (optional,
             default: @seq_length // 2)
         @random_offsets - randomize start position of sequences (optional, default: true)
-        @dataset_proportion - set to true to dramatically reduce size of dataset
+        @dataset_proportion - proportion of songs to keep, to dramatically reduce size of
+            dataset. songs are chosen by a seeded sample stratified by song length and corpus,
+            with at least one song from each stratum.
+            if set to true, keeps about 100 songs.
+        @subset_seed - seed for choosing the subset of songs used when @dataset_proportion is set
+        @sparse - yield int16 (pitch index, duration index, flag index) triples instead of dense
+            one-hot rows; use to_one_hot to expand batches once they are on the device (optional)
+        @encoding_cache - keep the runlength encoding of every song in the hdf5 file in a file
+            next to it, keyed by the source file and the pitch range and duration values, and read
+            encodings from it instead of recomputing them every epoch. datasets on other groups of
+            the same file that share these stats reuse it (optional)
+        @cache_workers - number of processes to use when counting pitches and durations for
+            the stats and when building the encoding cache (optional, default: 1). where child
+            processes are spawned rather than forked (windows, macos), more than one requires the
+            dataset to be made under an if __name__ == '__main__' guard.
         """
         super(MonoFolkSongDataset).__init__()
         self.dset_fname = dset_fname
@@ -106,6 +203,7 @@ class MonoFolkSongDataset(IterableDataset):
         self.shuffle_files = shuffle_files
         self.dataset_proportion = dataset_proportion
         self.random_transpose = random_transpose
+        self.sparse = sparse
 
         self.flags = params.flags
 
@@ -113,15 +211,22 @@ class MonoFolkSongDataset(IterableDataset):
         if base is not None:
             self.f = self.f[base]
         self.fnames = all_hdf5_keys(self.f)
+        self.offsets_cache = {}
         if dataset_proportion:
-            self.fnames = self.fnames[:100]
+            # each song is padded on both sides and gets sos and eos elements
+            pad = padding_amt if padding_amt else self.seq_length // 2
+            lengths = h5h.song_lengths(self.f, self.fnames)
+            num_windows = np.maximum(1, (lengths + 2 * pad + 2) // self.seq_length)
+            if dataset_proportion is True:
+                dataset_proportion = min(1, 100 / len(self.fnames))
+            self.fnames = h5h.stratified_subset(self.fnames, num_windows, dataset_proportion, seed=subset_seed)
 
         self.num_dur_vals = num_dur_vals
         self.use_duration = (num_dur_vals > 0)
 
         # make sure shape of data makes sense with parameters:
         expected_shape = 2 if self.use_duration else 1
-        real_shape = len(self.f[self.fnames[0]].shape)
+        real_shape = h5h.read_song(self.f, self.fnames[0]).ndim
         assert real_shape == expected_shape, \
             f"num_dur_vals = {num_dur_vals} but dimensionality of data is {real_shape}, not {expected_shape}"
 
@@ -130,11 +235,12 @@ class MonoFolkSongDataset(IterableDataset):
             self.delta_mapping = use_stats[1]
         elif self.use_duration:
             dmap, prange = get_tick_deltas_for_runlength(
-                self.f, self.fnames, num_dur_vals, proportion_for_stats)
+                self.f, self.fnames, num_dur_vals, proportion_for_stats, cache_workers)
             self.delta_mapping = dmap
             self.pitch_range = prange
         else:
-            self.pitch_range = get_pitch_range_no_duration(self.f, self.fnames, proportion_for_stats)
+            self.pitch_range = get_pitch_range_no_duration(
+                self.f, self.fnames, proportion_for_stats, cache_workers)
             self.delta_mapping = None
 
         if self.use_duration:
@@ -161,8 +267,107 @@ class MonoFolkSongDataset(IterableDataset):
         self.eos_element = np.zeros([1, self.num_feats])
         self.eos_element[0][self.flags['eos']] = 1
 
+        # in sparse mode each row holds the index of its set feature within the pitch, duration
+        # and flag subvectors, which start at these columns of the dense encoding
+        self.sparse_offsets = (0, self.pitch_subvector_len, self.num_feats - len(self.flags))
+        if self.sparse:
+            self.padding_seq = np.stack(
+                [self.sparse_flag_element('pad')[0] for _ in range(self.padding_amt)], 0)
+            self.sos_element = self.sparse_flag_element('sos')
+            self.eos_element = self.sparse_flag_element('eos')
+
+        self.encodings = self.load_encoding_cache(cache_workers) if encoding_cache else None
+
         # self.pitch_weights, self.dur_weights = self.get_weights(proportion_for_stats)
 
+    def sparse_flag_element(self, flag):
+        '''
+        the sparse (pitch index, duration index, flag index) row with only @flag set.
+        '''
+        flag_col = self.num_feats + self.flags[flag][0]
+        return np.array([[-1, -1, flag_col - self.sparse_offsets[2]]], dtype='int16')
+
+    def encoding_cache_fname(self):
+        '''
+        path of the encoding cache for the current stats, next to the hdf5 file. the key covers
+        the size and modification time of the hdf5 file and every parameter of the encoding.
+        '''
+        st = os.stat(self.dset_fname)
+        h = hashlib.sha1()
+        h.update(f'{st.st_size}-{st.st_mtime_ns}-{self.use_duration}-{tuple(self.pitch_range)}'.encode())
+        if self.use_duration:
+            h.update(np.asarray(self.delta_mapping, dtype='float64').tobytes())
+        return f'{self.dset_fname}.enc-{h.hexdigest()[:16]}.hdf5'
+
+    def load_encoding_cache(self, num_workers=1):
+        '''
+        reads the sparse encodings of this dataset's songs from the encoding cache into memory,
+        first building the cache for every song in the hdf5 file if it doesn't exist yet.
+        '''
+        cache_fname = self.encoding_cache_fname()
+        if not os.path.exists(cache_fname):
+            self.build_encoding_cache(cache_fname, num_workers)
+
+        with h5py.File(cache_fname, 'r') as f:
+            return {fname: f[h5h.song_path(self.f, fname)][()] for fname in self.fnames}
+
+    def build_encoding_cache(self, cache_fname, num_workers=1):
+        paths = all_hdf5_keys(self.f.file)
+        chunks = [paths[i::num_workers] for i in range(num_workers)]
+        args = [(self.dset_fname, c, self.delta_mapping, self.pitch_range, self.use_duration) for c in chunks]
+        logging.info(f'building encoding cache {cache_fname} for {len(paths)} songs')
+        if num_workers > 1:
+            with Pool(num_workers) as pool:
+                encoded = pool.starmap(encode_songs, args)
+        else:
+            encoded = [encode_songs(*a) for a in args]
+
+        # write to a temporary file first so an interrupted build never leaves a partial cache
+        tmp_fname = f'{cache_fname}.{os.getpid()}.tmp'
+        with h5py.File(tmp_fname, 'w') as f:
+            for chunk, arrs in zip(chunks, encoded):
+                for path, arr in zip(chunk, arrs):
+                    f.create_dataset(path, data=arr)
+        os.replace(tmp_fname, cache_fname)
+
+    def get_runlength(self, fname):
+        '''
+        the runlength encoding of song @fname, dense or sparse according to the dataset's mode.
+        '''
+        if self.encodings is None:
+            x = h5h.read_song(self.f, fname, self.offsets_cache)
+            # x = self.apply_transposition(x)
+            if self.sparse:
+                return fcts.arr_to_runlength_mono_indices(
+                    x, self.delta_mapping, self.pitch_range, self.use_duration)
+            return fcts.arr_to_runlength_mono(
+                x, self.delta_mapping, self.pitch_range, self.flags, self.use_duration)
+
+        inds = self.encodings[fname]
+        if self.sparse:
+            return inds
+        return self.to_one_hot(torch.from_numpy(inds), torch.float64).numpy()
+
+    def to_one_hot(self, batch, dtype=torch.float32):
+        '''
+        expands a batch yielded in sparse mode into the dense encoding the models take.
+        '''
+        return sparse_to_one_hot(batch, self.sparse_offsets, self.num_feats, dtype)
+
+    def make_augmentation(self, max_transpose=0):
+        '''
+        a batch augmentation that transposes each sequence by up to @max_transpose steps within
+        the pitch range, working on the pitch indices of batches yielded in sparse mode. returns
+        None if disabled.
+        '''
+        if not max_transpose:
+            return None
+        if not self.sparse:
+            raise ValueError('batch augmentation works on pitch indices, so needs sparse=True')
+        num_pitches = self.pitch_range[1] - self.pitch_range[0] + 1
+        return partial(bat_aug.transpose_batch, pitch_col=0, max_shift=max_transpose,
+                       pitch_range=(1, num_pitches))
+
     def get_stats(self):
         return (self.pitch_range, self.delta_mapping)
 
@@ -189,11 +394,7 @@ class MonoFolkSongDataset(IterableDataset):
 
         # iterate through all given fnames, breaking them into chunks of seq_length...
         for fname in self.fnames:
-            x = self.f[fname]
-
-            # x = self.apply_transposition(x)
-            runlength = fcts.arr_to_runlength_mono(
-                x, self.delta_mapping, self.pitch_range, self.flags, self.use_duration)
+            runlength = self.get_runlength(fname)
 
             # pad runlength encoding on both sides
             padded_rl = np.concatenate([
@@ -1,62 +1,170 @@
+import matplotlib
+matplotlib.use('Agg')
 import matplotlib.pyplot as plt
 import numpy as np
 import argparse
+import json
+import time
 import re
 import os
 
-parser = argparse.ArgumentParser(description='Prints nice graphs of training and validation progress from al')
-parser.add_argument('logfile', default='', help='Log file to print training data from.')
-args = vars(parser.parse_args())
 
-loc = args['logfile']
-if loc[-4:] == '.log':
-    logs = [loc]
-else:
-    logs = [os.path.join(loc, x) for x in os.listdir(loc) if x[-4:] == '.log']
+def parse_log_line(line):
+    '''
+    turns an epoch line of an older free-text training log, like
+    'epoch   3 | s/epoch 1.2 | train_loss 0.1 | ...', into an epoch record, or returns None.
+    '''
+    if 'train_loss' not in line or 's/epoch' not in line:
+        return None
+    record = {'kind': 'epoch'}
+    for entry in line.split('|')[1:]:
+        spl = [x for x in re.split(r'\s+', entry) if x]
+        if len(spl) >= 2:
+            record[spl[0].replace('/', '_per_')] = float(spl[1])
+    record['epoch'] = int(re.search(r'epoch\s+(\d+)', line).group(1))
+    return record
 
-for log_file in logs:
 
-    with open(log_file) as f:
-        logs = f.readlines()
+class RunReader(object):
+    '''
+    Reads the records of one metrics log incrementally: each call to read_new returns only the
+    records appended since the last call, keeping a trailing partial line for the next one.
+    .jsonl files hold one json record per line; .log files are older free-text training logs.
+    '''
 
-    logs = [x.strip() for x in logs if ('train_loss' in x) and ('s/epoch' in x)]
+    def __init__(self, fname):
+        self.fname = fname
+        self.is_json = fname.endswith('.jsonl')
+        self.run = os.path.splitext(os.path.basename(fname))[0]
+        self.offset = 0
+        self.partial = ''
+        self.epochs = {}
+        self.steps = []
 
-    # make empty dictionary to hold all entries
-    keys = logs[0].split('|')[1:]
-    keys = [re.split(r'\s+', k)[1] for k in keys if k]
-    dats = {k: [] for k in keys if k}
+    def read_new(self):
+        with open(self.fname, 'r') as f:
+            f.seek(self.offset)
+            text = f.read()
+            self.offset = f.tell()
+        lines = (self.partial + text).split('\n')
+        self.partial = lines.pop()
 
-    for line in logs:
-        entries = line.split('|')[1:]
-        for e in entries:
-            spl = re.split(r'\s+', e)
-            spl = [x for x in spl if x]
-            if not spl:
+        num_new = 0
+        for line in lines:
+            if self.is_json:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue
+            else:
+                record = parse_log_line(line)
+            if record is None:
                 continue
-            dats[spl[0]].append(float(spl[1]))
 
+            if record['kind'] == 'run':
+                self.run = record['run']
+            elif record['kind'] == 'epoch':
+                self.epochs[record['epoch']] = record
+            elif record['kind'] == 'step':
+                self.steps.append(record)
+            num_new += 1
+        return num_new
+
+    def series(self, key):
+        epochs = sorted(x for x in self.epochs if self.epochs[x].get(key) is not None)
+        return np.array(epochs), np.array([self.epochs[x][key] for x in epochs])
+
+
+def run_id(fname):
+    '''
+    the id of the run that wrote log @fname, shared by its metrics_<id>.jsonl and training_<id>.log.
+    '''
+    name = os.path.splitext(os.path.basename(fname))[0]
+    for prefix in ['metrics_', 'training_']:
+        if name.startswith(prefix):
+            return name[len(prefix):]
+    return name
+
+
+def find_logs(loc):
+    '''
+    the log to read for each run in @loc, as a dict from run id to file name: its .jsonl metrics
+    log, or for older runs without one, its free-text training log. test results are skipped.
+    '''
+    if os.path.isfile(loc):
+        return {run_id(loc): loc}
+    logs = {}
+    for name in sorted(os.listdir(loc)):
+        if name.startswith('test_results_') or not name.endswith(('.jsonl', '.log')):
+            continue
+        run = run_id(name)
+        if run not in logs or name.endswith('.jsonl'):
+            logs[run] = os.path.join(loc, name)
+    return logs
+
+
+def plot_runs(readers, out_fname):
+    '''
+    plots the losses and f1 scores of every run in @readers, training as solid lines and
+    validation as dashed lines of the same color, and saves the figure to @out_fname.
+    '''
     fig, axs = plt.subplots(2, 1, figsize=(12, 6))
-    epochs = np.arange(len(dats[keys[0]]))
-
-    axs[0].set_title('Training and Validation Loss')
-    axs[0].plot(epochs, dats['train_loss'], c='black', label='Training')
-    axs[0].plot(epochs, dats['val_loss'], c='red', label='Validation')
-    axs[0].set_xlim([-0.02, max(epochs)])
-    axs[0].set_ylim([-0.02, max(dats['val_loss'])])
-    axs[0].set_ylabel('Loss')
-    axs[0].set_xlabel('Epoch')
-    axs[0].legend()
-
-    axs[1].set_title('F1 Score')
-    axs[1].plot(epochs, dats['tr_f1'], c='black', label='Training')
-    axs[1].plot(epochs, dats['val_f1'], c='red', label='Validation')
-    axs[1].set_xlim([0, max(epochs)])
+    colors = plt.cm.tab10(np.arange(len(readers)) % 10)
+
+    for ax, (title, tr_key, val_key, ylabel) in zip(axs, [
+            ('Training and Validation Loss', 'train_loss', 'val_loss', 'Loss'),
+            ('F1 Score', 'tr_f1', 'val_f1', 'F1 Score')]):
+        ax.set_title(title)
+        for reader, c in zip(readers, colors):
+            label = reader.run if len(readers) > 1 else 'Training'
+            ax.plot(*reader.series(tr_key), c=c, label=label)
+            ax.plot(*reader.series(val_key), c=c, ls='--', label=None if len(readers) > 1 else 'Validation')
+        ax.set_ylabel(ylabel)
+        ax.set_xlabel('Epoch')
+        if any(len(r.epochs) for r in readers):
+            ax.legend(fontsize='small')
     axs[1].set_ylim([0, 1.02])
-    axs[1].set_ylabel('F1 Score')
-    axs[1].set_xlabel('Epoch')
-    axs[1].legend()
+    fig.tight_layout()
 
-    out_fname = f'{log_file[:-4]}_plot.png'
     fig.savefig(out_fname, bbox_inches='tight')
     plt.clf()
     plt.close(fig)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Prints nice graphs of training and validation progress from metrics logs '
+                    '(.jsonl) or older training logs (.log). Given a folder, plots every run in it '
+                    'together, e.g. all runs of a parameter sweep.')
+    parser.add_argument('logfile', help='Log file, or folder of log files, to print training data from.')
+    parser.add_argument('-o', '--output', default=None,
+                        help='Image to write (default: next to the log file, or runs_plot.png in the folder).')
+    parser.add_argument('-f', '--follow', type=float, default=0,
+                        help='If nonzero, keeps checking for new records this many seconds apart and '
+                             'redraws whenever there are some.')
+    args = vars(parser.parse_args())
+
+    loc = args['logfile']
+    if args['output']:
+        out_fname = args['output']
+    elif os.path.isfile(loc):
+        out_fname = f'{os.path.splitext(loc)[0]}_plot.png'
+    else:
+        out_fname = os.path.join(loc, 'runs_plot.png')
+
+    readers = {}
+    while True:
+        # new runs may start while following a folder
+        for run, fname in find_logs(loc).items():
+            if run not in readers or readers[run].fname != fname:
+                readers[run] = RunReader(fname)
+
+        num_new = sum(r.read_new() for r in readers.values())
+        if num_new:
+            runs = [r for r in readers.values() if r.epochs]
+            plot_runs(runs, out_fname)
+            print(f'plotted {len(runs)} runs to {out_fname} ({num_new} new records)')
+
+        if not args['follow']:
+            break
+        time.sleep(args['follow'])
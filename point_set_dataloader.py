@@ -1,26 +1,162 @@
-from torch.utils.data import IterableDataset, DataLoader
+from torch.utils.data import IterableDataset, DataLoader, get_worker_info
 from importlib import reload
 import torch
 import os
 import numpy as np
 import h5py
+import json
+from collections import OrderedDict
+from functools import partial
+import hashlib
 import logging
 import model_params as params
+import data_management.hdf5_helpers as h5h
+import data_augmentation.batch_augmentation as bat_aug
 
 def all_hdf5_keys(obj):
     '''
-    Recursively find all hdf5 keys subordinate to the given object @obj, corresponding to datasets.
+    Recursively find all hdf5 keys subordinate to the given object @obj, corresponding to songs:
+    datasets, apart from the build manifest and length index at the root of the file, and the
+    songs of packed groups, as <group>#<index>.
     '''
-    name_list = []
+    return h5h.song_keys(obj)
 
-    def visitor_func(name, node):
-        if isinstance(node, h5py.Dataset):
-            name_list.append(name)
-        else:
-            pass
 
-    obj.visititems(visitor_func)
-    return name_list
+def make_program_lut(program_ranges):
+    '''
+    turns a dict mapping ranges (lo, hi] of MIDI program numbers to categories into a lookup
+    table indexed by program number.
+    '''
+    lut = np.zeros(129, dtype='float32')
+    for (lo, hi), category in program_ranges.items():
+        lut[lo + 1:hi + 1] = category
+    return lut
+
+
+class WindowShuffleBuffer(object):
+    '''
+    Fixed-size buffer of windows used to mix windows from many different songs while streaming,
+    since windows from a single song otherwise arrive back to back. Incoming windows fill free
+    slots until the buffer is full; after that, every draw removes @draw_size windows from random
+    slots, which are then refilled by the next incoming windows. Memory use is bounded by
+    @size * seq_length * num_feats float32 values, allocated on first use, so that each
+    DataLoader worker only allocates its own buffer. resize() shrinks it for the current epoch.
+    '''
+
+    def __init__(self, size, seq_length, num_feats):
+        self.size = size
+        self.seq_length = seq_length
+        self.num_feats = num_feats
+        self.buf = None
+        self.free_slots = np.arange(size)
+        self.fill_history = []
+
+    def resize(self, size):
+        if size != self.size:
+            self.size = size
+            self.buf = None
+
+    @property
+    def fill_level(self):
+        '''
+        proportion of the buffer currently occupied by windows.
+        '''
+        return 1 - len(self.free_slots) / self.size
+
+    def shuffle(self, window_chunks, draw_size):
+        '''
+        takes an iterable of window arrays of shape (n, seq_length, num_feats) and yields arrays
+        of @draw_size windows drawn at random from the buffer. the remaining windows are drained
+        in random order once @window_chunks is exhausted, so the last draw may be smaller.
+        '''
+        if draw_size > self.size:
+            raise ValueError(f'cannot draw {draw_size} windows from a shuffle buffer of size {self.size}')
+        if self.buf is None:
+            self.buf = np.empty((self.size, self.seq_length, self.num_feats), dtype='float32')
+        self.free_slots = np.arange(self.size)
+        self.fill_history = []
+        rng = np.random.default_rng(np.random.randint(2 ** 31))
+
+        for windows in window_chunks:
+            pos = 0
+            while pos < len(windows):
+                # move as many incoming windows into free slots as possible
+                num_put = min(len(self.free_slots), len(windows) - pos)
+                self.buf[self.free_slots[:num_put]] = windows[pos:pos + num_put]
+                self.free_slots = self.free_slots[num_put:]
+                pos += num_put
+
+                # once full, draw random windows, freeing up their slots
+                if len(self.free_slots) == 0:
+                    self.fill_history.append(self.fill_level)
+                    slots = rng.choice(self.size, draw_size, replace=False)
+                    self.free_slots = slots
+                    yield self.buf[slots]
+
+        used_slots = rng.permutation(np.setdiff1d(np.arange(self.size), self.free_slots))
+        if len(self.fill_history) == 0:
+            logging.warning(f'shuffle buffer of size {self.size} never filled up: only '
+                            f'{len(used_slots)} windows were available')
+        for i in range(0, len(used_slots), draw_size):
+            self.fill_history.append((len(used_slots) - i) / self.size)
+            yield self.buf[used_slots[i:i + draw_size]]
+        self.free_slots = np.arange(self.size)
+
+    def log_fill_summary(self):
+        '''
+        logs the fill level of the buffer at each draw: a mean well below 100% means most
+        draws happened while draining, and the buffer is too large for the amount of data.
+        '''
+        fills = np.array(self.fill_history) if self.fill_history else np.zeros(1)
+        logging.info(f'shuffle buffer: size {self.size} windows, {len(self.fill_history)} draws, '
+                     f'fill level at draw time mean {fills.mean():.1%} / min {fills.min():.1%}')
+
+
+class NoteTupleCache(object):
+    '''
+    Least-recently-used cache of decoded and preprocessed note tuple arrays, bounded by the total
+    number of bytes held. each DataLoader worker has its own copy of the dataset and therefore
+    its own cache, so @max_bytes is a per-worker cap.
+    '''
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def get(self, key):
+        try:
+            arr = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return arr
+
+    def put(self, key, arr):
+        if arr.nbytes > self.max_bytes:
+            return
+        arr.flags.writeable = False
+        self.entries[key] = arr
+        self.num_bytes += arr.nbytes
+        while self.num_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= evicted.nbytes
+            self.evictions += 1
+
+    def log_summary(self):
+        logging.info(f'note tuple cache: {len(self.entries)} songs, '
+                     f'{self.num_bytes / 2 ** 20:.1f} of {self.max_bytes / 2 ** 20:.1f} MB, '
+                     f'hit rate {self.hit_rate:.1%}, {self.evictions} evictions')
 
 
 class MidiNoteTupleDataset(IterableDataset):
@@ -32,9 +168,24 @@ class MidiNoteTupleDataset(IterableDataset):
         (41, 128): 3
     }
 
+    # program_ranges as a lookup table from program number to category
+    program_lut = make_program_lut(program_ranges)
+
+    # columns of the files made by make_lmd_hdf5.py to use as features, in order of inclusion:
+    # onset, time to next onset, pitch, velocity. the fifth feature is the simplified program.
+    feature_columns = [0, 2, 3, 4]
+    program_column = 5
+
+    # names of the columns of files made by make_lmd_hdf5.py, assumed for files that predate
+    # named columns. the roles of features used by augmentation are found by name, since other
+    # builders (e.g. make_quartets_hdf5.py) order their columns differently.
+    lmd_columns = ['onset', 'duration', 'next_onset', 'pitch', 'velocity', 'program']
+    time_names = ['onset', 'next_onset', 'duration']
+
     def __init__(self, dset_fname, seq_length, num_feats=4, base=None, shuffle_files=True,
                  padding_amt=None, random_offsets=True, estimate_stats_batches=30, dataset_proportion=False,
-                 use_stats_from=None):
+                 use_stats_from=None, batch_size=None, gather_files=16, shuffle_buffer_size=0,
+                 length_buckets=0, cache_mb=0, resident=False, subset_seed=0, min_length=0):
         """
         @dset_fname - the file name of the processed hdf5 dataset
         @seq_length - length to chop sequences into
@@ -46,7 +197,28 @@ class MidiNoteTupleDataset(IterableDataset):
             default: @seq_length // 2)
         @random_offsets - randomize start position of sequences (optional, default: true)
         @estimate_stats_batches - number of batches to use for stat estimation
-        @dataset_proportion - set to true to dramatically reduce size of dataset
+        @dataset_proportion - proportion of songs to keep, to dramatically reduce size of
+            dataset. songs are chosen by a seeded sample stratified by song length and corpus,
+            with at least one song from each stratum
+        @subset_seed - seed for choosing the subset of songs used when @dataset_proportion is set
+        @batch_size - if given, yields whole float32 batches of shape (batch_size, seq_length,
+            num_feats) instead of single sequences. use with DataLoader(batch_size=None).
+        @gather_files - number of files whose windows are gathered in one step when yielding
+            whole batches
+        @shuffle_buffer_size - if nonzero, windows are streamed through a buffer of this many
+            windows and drawn from it at random, mixing windows across songs with bounded memory.
+            raised to at least @batch_size, and shrunk to the windows each worker streams.
+        @length_buckets - if nonzero, songs too short to fill a window are kept rather than
+            skipped, and windows are grouped into this many buckets by their true length. yields
+            (batch, lengths) tuples where each batch is padded only to its longest window.
+            requires @batch_size.
+        @cache_mb - if nonzero, keeps up to this many megabytes of decoded note tuples in memory
+            (per DataLoader worker), evicting the least recently used songs first
+        @resident - if true, loads all selected songs once into a single tensor in shared memory,
+            which DataLoader workers read from without copying or touching the hdf5 file. makes
+            @cache_mb unnecessary.
+        @min_length - songs with fewer notes than this are skipped. song lengths are read from
+            the length index of the hdf5 file where it has one, without opening each song.
         """
         super(MidiNoteTupleDataset).__init__()
 
@@ -56,22 +228,54 @@ class MidiNoteTupleDataset(IterableDataset):
         self.random_offsets = random_offsets
         self.shuffle_files = shuffle_files
         self.dataset_proportion = dataset_proportion
+        self.batch_size = batch_size
+        self.gather_files = gather_files
+        self.length_buckets = length_buckets
+        if length_buckets and not batch_size:
+            raise ValueError('length bucketing requires the dataset to yield whole batches, but '
+                             'no batch_size was given.')
+        self.cache = NoteTupleCache(cache_mb * 2 ** 20) if (cache_mb and not resident) else None
         self.flags = params.notetuple_flags
+        self.stats_cache_fname = f'{self.dset_fname}.stats.json'
 
-        self.f = h5py.File(self.dset_fname, 'r')
-        if base is not None:
-            self.f = self.f[base]
+        self.base = base
+        self.open_file()
         self.fnames = all_hdf5_keys(self.f)
-        if dataset_proportion:
-            self.fnames = self.fnames[:int(len(self.fnames) * dataset_proportion)]
+        self.offsets_cache = {}
+        self.feature_names = self.get_feature_names()
+        self.lengths = dict(zip(self.fnames, h5h.song_lengths(self.f, self.fnames).tolist()))
+        if min_length:
+            self.fnames = [x for x in self.fnames if self.lengths[x] >= min_length]
 
         self.num_feats = num_feats
-        padding_element = np.array(self.flags['pad'])[:self.num_feats]
+        # flags only cover the note features, so the program feature of padding is 0
+        padding_element = np.zeros(self.num_feats)
+        flag = self.flags['pad'][:self.num_feats]
+        padding_element[:len(flag)] = flag
 
         self.padding_amt = padding_amt if padding_amt else self.seq_length // 5
         self.padding_seq = np.stack(
             [padding_element for _ in range(self.padding_amt)], 0)
 
+        if dataset_proportion:
+            self.select_subset(dataset_proportion, subset_seed)
+        logging.info(f'{len(self.fnames)} songs with {sum(self.lengths[x] for x in self.fnames)} notes, '
+                     f'{self.num_windows()} windows per epoch')
+
+        # every draw takes a whole batch from the buffer, so it must hold at least one
+        self.shuffle_buffer = None
+        self.shuffle_buffer_size = shuffle_buffer_size
+        if shuffle_buffer_size:
+            if shuffle_buffer_size < (batch_size or 1):
+                logging.warning(f'shuffle buffer size {shuffle_buffer_size} is smaller than the batch '
+                                f'size {batch_size}; using {batch_size} instead')
+                self.shuffle_buffer_size = batch_size
+            self.shuffle_buffer = WindowShuffleBuffer(self.shuffle_buffer_size, seq_length, num_feats)
+
+        self.resident_data = None
+        if resident:
+            self.load_resident()
+
         self.stds = torch.ones(self.num_feats)
         self.means = torch.zeros(self.num_feats)
         if use_stats_from is not None:
@@ -79,88 +283,447 @@ class MidiNoteTupleDataset(IterableDataset):
         elif estimate_stats_batches > 0:
             self.stds, self.means = self.estimate_stats()
 
+    def open_file(self):
+        '''
+        opens the hdf5 file, or the group @base within it, for reading from this process. hdf5
+        handles don't survive a fork, so each DataLoader worker opens its own on first use.
+        '''
+        self.f = h5py.File(self.dset_fname, 'r')
+        if self.base is not None:
+            self.f = self.f[self.base]
+        self.file_pid = os.getpid()
+
+    def select_subset(self, proportion, seed):
+        '''
+        restricts the dataset to a seeded subset of @proportion of its songs, stratified by song
+        length and corpus group.
+        '''
+        lengths = np.array([self.lengths[fname] for fname in self.fnames])
+        num_windows = np.maximum(1, (lengths + 2 * self.padding_amt) // self.seq_length)
+        window_counts = dict(zip(self.fnames, num_windows))
+        num_songs = len(self.fnames)
+
+        self.fnames = h5h.stratified_subset(self.fnames, num_windows, proportion, seed=seed)
+        kept_windows = sum(window_counts[fname] for fname in self.fnames)
+        logging.info(f'using {len(self.fnames)} of {num_songs} songs '
+                     f'({kept_windows} of {num_windows.sum()} windows) with seed {seed}')
+
+    def num_windows(self, fnames=None):
+        '''
+        the number of windows in one epoch over the selected songs, or over @fnames if given,
+        counted from their lengths alone. songs too short for a full window count as one window
+        when bucketing by length.
+        '''
+        fnames = self.fnames if fnames is None else fnames
+        lengths = np.array([self.lengths[fname] for fname in fnames], dtype='int64')
+        counts = (lengths + 2 * self.padding_amt) // self.seq_length
+        if self.length_buckets:
+            counts = np.maximum(counts, 1)
+        return int(counts[lengths > 0].sum())
+
+    def get_feature_names(self):
+        '''
+        the name of the column each feature is taken from, from the column names stored in the
+        file, or those of make_lmd_hdf5.py for files without them. the simplified program feature
+        is named after its source column with a '_category' suffix.
+        '''
+        names = h5h.song_columns(self.f, self.fnames[0]) if self.fnames else None
+        names = names or self.lmd_columns
+        feature_names = [names[c] for c in self.feature_columns[:self.num_feats]]
+        if self.num_feats > len(self.feature_columns):
+            feature_names.append(f'{names[self.program_column]}_category')
+        return feature_names
+
+    def make_augmentation(self, max_transpose=0, max_time_stretch=1, permute_voices=False,
+                          num_voices=4):
+        '''
+        a batch augmentation for this dataset's windows that transposes each sequence by up to
+        @max_transpose semitones, stretches its times by a factor of up to @max_time_stretch and,
+        if @permute_voices is set, relabels its @num_voices voices at random, e.g. to swap the
+        parts of a quartet. features are found by the names of their columns, and a
+        ValueError is raised if one an augmentation needs isn't among them. returns None if all
+        are disabled.
+        '''
+        def feature(name, aug):
+            if name not in self.feature_names:
+                raise ValueError(f'{aug} needs a {name} feature, but features are {self.feature_names}')
+            return self.feature_names.index(name)
+
+        augs = []
+        if max_transpose:
+            augs.append(partial(bat_aug.transpose_batch, pitch_col=feature('pitch', 'transposition'),
+                                max_shift=max_transpose))
+        if max_time_stretch > 1:
+            time_cols = [i for i, name in enumerate(self.feature_names) if name in self.time_names]
+            if not time_cols:
+                raise ValueError(f'time stretching needs a time feature, but features are '
+                                 f'{self.feature_names}')
+            augs.append(partial(bat_aug.stretch_time, time_cols=time_cols, max_stretch=max_time_stretch))
+        if permute_voices:
+            # padding rows hold voice 0, so only rows with a pitch count as notes
+            augs.append(partial(bat_aug.permute_voices, voice_col=feature('voice', 'voice permutation'),
+                                num_voices=num_voices, pitch_col=feature('pitch', 'voice permutation')))
+        return bat_aug.compose(*augs) if augs else None
+
     def simplify_programs(self, programs):
-        x = np.zeros(programs.shape)
-        for k in self.program_ranges.keys():
-            in_category = (k[0] < programs) * (programs <= k[1])
-            x[in_category] = self.program_ranges[k]
-        return np.expand_dims(x, 1)
+        return np.expand_dims(self.program_lut[programs.astype('int64')], 1)
 
     def estimate_stats(self, num_vals=1e6):
         '''
-        estimates mean and stdv of each feature using one-pass mean and variance calculation
+        estimates mean and stdv of each feature over (at most) @num_vals note tuples. each file's
+        windows are reduced to (count, mean, sum of squared deviations) with numpy and these are
+        merged with the parallel variance algorithm of Chan et al., rather than doing a Welford
+        update for every row. results are cached in a json sidecar next to the hdf5 file, keyed
+        by a hash of the dataset contents and windowing parameters, so that later datasets built
+        from the same data load them instantly.
         '''
-        M = 0
-        S = 0
+        stats_key = self.stats_hash()
+        cached = self.read_stats_cache(stats_key)
+        if cached is not None:
+            logging.info(f'loaded feature stats for {self.dset_fname} from cache (key {stats_key})')
+            return cached
+
         k = 0
-        for i, seq in enumerate(self.__iter__()):
+        M = np.zeros(self.num_feats)
+        S = np.zeros(self.num_feats)
+        # songs too short for a single window are skipped without reading them
+        fnames = [x for x in self.fnames
+                  if self.lengths[x] > 0 and self.lengths[x] + 2 * self.padding_amt >= self.seq_length]
+        fnames = np.random.permutation(fnames) if self.shuffle_files else fnames
+        for fname in fnames:
             if k > num_vals:
                 break
-            for idx in range(seq.shape[0]):
-                k += 1
-                x = seq[idx]
-                oldM = M
-                M = M + (x - M) / k
-                S = S + (x - M) * (x - oldM)
+            windows = self.get_file_windows(fname)
+            if windows is None:
+                continue
+            x = windows.reshape(-1, self.num_feats).astype('float64')
+            n = x.shape[0]
+            if n == 0:
+                continue
+            mean = x.mean(0)
+            sq_devs = ((x - mean) ** 2).sum(0)
+
+            # merge this file's moments into the running total
+            delta = mean - M
+            M = M + delta * (n / (k + n))
+            S = S + sq_devs + (delta ** 2) * (k * n / (k + n))
+            k += n
+
+        if k < 2:
+            logging.warning(f'too few note tuples in {self.dset_fname} to estimate feature stats; '
+                            f'leaving features unnormalized')
+            return torch.ones(self.num_feats), torch.zeros(self.num_feats)
         means = M
         stds = np.sqrt(S / (k-1))
+        self.write_stats_cache(stats_key, stds, means)
         return torch.tensor(stds, dtype=torch.float), torch.tensor(means, dtype=torch.float)
 
+    def stats_hash(self):
+        '''
+        hashes the size and modification time of the hdf5 file, the name and length of every song
+        in use, and the parameters that change how files are windowed, which together determine
+        the estimated stats. rebuilding the file under the same name changes the key.
+        '''
+        st = os.stat(self.dset_fname)
+        h = hashlib.sha1()
+        h.update(f'{st.st_size}-{st.st_mtime_ns}-{self.seq_length}-{self.num_feats}-'
+                 f'{self.padding_amt}-{self.f.name}'.encode())
+        for fname in sorted(self.fnames):
+            h.update(f'{fname}:{self.lengths[fname]}'.encode())
+        return h.hexdigest()
+
+    def read_stats_cache(self, stats_key):
+        try:
+            with open(self.stats_cache_fname, 'r') as f:
+                entry = json.load(f)[stats_key]
+        except (OSError, ValueError, KeyError):
+            return None
+        return torch.tensor(entry['stds'], dtype=torch.float), torch.tensor(entry['means'], dtype=torch.float)
+
+    def write_stats_cache(self, stats_key, stds, means):
+        try:
+            with open(self.stats_cache_fname, 'r') as f:
+                cache = json.load(f)
+        except (OSError, ValueError):
+            cache = {}
+        cache[stats_key] = {'stds': list(map(float, stds)), 'means': list(map(float, means))}
+        try:
+            with open(self.stats_cache_fname, 'w') as f:
+                json.dump(cache, f, indent=1)
+        except OSError:
+            logging.warning(f'could not write feature stats cache to {self.stats_cache_fname}')
+
     def normalize_batch(self, item):
         return (item - self.means) / self.stds
 
     def unnormalize_batch(self, item):
         return ((item * self.stds) + self.means).round()
 
-    def __iter__(self):
+    def load_resident(self):
         '''
-        Main iteration function.
+        loads every selected file, padded, into a single float32 tensor in shared memory, indexed
+        by the row offsets of each padded file. DataLoader workers inherit a handle to the same
+        memory instead of reading and decoding their own copies from the hdf5 file.
         '''
+        lengths = np.array([self.lengths[fname] for fname in self.fnames], dtype='int64')
+        offsets = np.concatenate([[0], np.cumsum(lengths + 2 * self.padding_amt)])
+        data = torch.empty((offsets[-1], self.num_feats), dtype=torch.float).share_memory_()
+        data_arr = data.numpy()
+
+        for i, fname in enumerate(self.fnames):
+            data_arr[offsets[i]:offsets[i + 1]] = self.load_padded(fname)
+            if not i % 2000:
+                logging.info(f'loading songs into shared memory: {i} of {len(self.fnames)}')
+
+        self.resident_index = {fname: (offsets[i], offsets[i + 1]) for i, fname in enumerate(self.fnames)}
+        self.resident_data = data
+        logging.info(f'loaded {len(self.fnames)} songs into shared memory '
+                     f'({data_arr.nbytes / 2 ** 20:.1f} MB)')
+
+    def load_notetuples(self, fname):
+        '''
+        loads the file at @fname and extracts the features used for training from it, as a
+        float32 array.
+        '''
+        x = h5h.read_song(self.f, fname, self.offsets_cache)
 
-        if self.shuffle_files:
-            np.random.shuffle(self.fnames)
+        # no need to use a custom factorization, just extract the relevant columns
+        cols = self.feature_columns[:self.num_feats]
+        notetuples = np.empty((x.shape[0], self.num_feats), dtype='float32')
+        notetuples[:, :len(cols)] = x[:, cols]
+        if self.num_feats > len(self.feature_columns):
+            notetuples[:, -1] = self.program_lut[x[:, self.program_column].astype('int64')]
+        return notetuples
+
+    def load_padded(self, fname):
+        '''
+        returns the features of the file at @fname with padding on both sides. this is computed
+        once per file if caching is enabled or the dataset is resident in memory, in which case
+        the result is shared and should not be modified.
+        '''
+        if self.resident_data is not None:
+            st, end = self.resident_index[fname]
+            return self.resident_data.numpy()[st:end]
+
+        if self.cache is not None:
+            padded_nt = self.cache.get(fname)
+            if padded_nt is not None:
+                return padded_nt
+
+        notetuples = self.load_notetuples(fname)
+        padded_nt = np.empty((notetuples.shape[0] + 2 * self.padding_amt, self.num_feats), dtype='float32')
+        padded_nt[:self.padding_amt] = self.padding_seq
+        padded_nt[self.padding_amt:self.padding_amt + notetuples.shape[0]] = notetuples
+        padded_nt[self.padding_amt + notetuples.shape[0]:] = self.padding_seq
+
+        if self.cache is not None:
+            self.cache.put(fname, padded_nt)
+        return padded_nt
+
+    def get_file_windows(self, fname, keep_short=False):
+        '''
+        breaks the file at @fname into an array of windows of shape (num_seqs, seq_length,
+        num_feats), with the onset of each window recentered to start at time = 0. returns None
+        if the file is too short to be used with the seq_length desired, unless @keep_short is
+        set, in which case the whole padded song is returned as a single shorter window.
+        '''
+        padded_nt = self.load_padded(fname)
+        if padded_nt.shape[0] == 2 * self.padding_amt:
+            return None
+
+        # figure out how many sequences we can get out of this
+        num_seqs = padded_nt.shape[0] // self.seq_length
+        if num_seqs == 0 and keep_short:
+            num_seqs, seq_length = 1, padded_nt.shape[0]
+        elif num_seqs == 0:
+            return None
+        else:
+            seq_length = self.seq_length
+
+        remainder = padded_nt.shape[0] - (num_seqs * seq_length)
+        offset = np.random.randint(remainder + 1) if self.random_offsets else 0
+
+        end = offset + num_seqs * seq_length
+        windows = padded_nt[offset:end].reshape(num_seqs, seq_length, self.num_feats).copy()
+
+        # recenter each individual window to start at time = 0
+        windows[:, :, 0] -= windows[:, :, 0].min(1, keepdims=True)
+
+        return windows
+
+    def get_window_index(self, fnames):
+        '''
+        returns a flat float32 array holding all padded files in @fnames, along with the start
+        index of every window within it. if the dataset is resident in memory, this is the
+        resident array itself, and nothing is copied.
+        '''
+        if self.resident_data is not None:
+            flat = self.resident_data.numpy()
+            bounds = np.array([self.resident_index[fname] for fname in fnames], dtype='int64').reshape(-1, 2)
+            song_starts = bounds[:, 0]
+            padded_lens = bounds[:, 1] - bounds[:, 0]
+        else:
+            all_padded = [self.load_padded(fname) for fname in fnames]
+            flat = np.concatenate(all_padded)
+            padded_lens = np.array([x.shape[0] for x in all_padded], dtype='int64')
+            song_starts = np.cumsum(padded_lens) - padded_lens
+
+        num_seqs = padded_lens // self.seq_length
+        remainders = padded_lens - num_seqs * self.seq_length
+        if self.random_offsets:
+            offsets = np.floor(np.random.rand(len(fnames)) * (remainders + 1)).astype('int64')
+        else:
+            offsets = np.zeros(len(fnames), dtype='int64')
+
+        # the i-th window of a song starts at song_start + offset + i * seq_length
+        first_window = np.repeat(np.cumsum(num_seqs) - num_seqs, num_seqs)
+        window_nums = np.arange(num_seqs.sum()) - first_window
+        starts = np.repeat(song_starts + offsets, num_seqs) + window_nums * self.seq_length
+
+        return flat, starts
+
+    def iter_batches(self, fnames):
+        '''
+        yields batches of shape (batch_size, seq_length, num_feats), gathering the windows of
+        @gather_files files at a time directly into each batch's buffer. the last batch may be
+        smaller than batch_size.
+        '''
+        seq_range = np.arange(self.seq_length)
+        buf = None
+        filled = 0
+
+        for i in range(0, len(fnames), self.gather_files):
+            flat, starts = self.get_window_index(fnames[i:i + self.gather_files])
+            pos = 0
+            while pos < len(starts):
+                if buf is None:
+                    buf = np.empty((self.batch_size, self.seq_length, self.num_feats), dtype='float32')
+                    filled = 0
+                num_take = min(self.batch_size - filled, len(starts) - pos)
+                inds = starts[pos:pos + num_take, None] + seq_range
+                np.take(flat, inds, axis=0, out=buf[filled:filled + num_take])
+                filled += num_take
+                pos += num_take
+
+                if filled == self.batch_size:
+                    buf[:, :, 0] -= buf[:, :, 0].min(1, keepdims=True)
+                    yield buf
+                    buf = None
+
+        if buf is not None and filled > 0:
+            buf = buf[:filled]
+            buf[:, :, 0] -= buf[:, :, 0].min(1, keepdims=True)
+            yield buf
+
+    def iter_bucketed(self, fnames):
+        '''
+        yields (batch, lengths) tuples, with windows grouped into @length_buckets buckets by
+        length. each batch is padded only up to the longest window it contains.
+        '''
+        bounds = np.ceil(np.linspace(0, self.seq_length, self.length_buckets + 1)[1:])
+        buckets = [[] for _ in bounds]
+
+        def make_batch(windows):
+            lengths = np.array([x.shape[0] for x in windows], dtype='int64')
+            batch = np.empty((len(windows), lengths.max(), self.num_feats), dtype='float32')
+            batch[:] = self.padding_seq[0]
+            for i, x in enumerate(windows):
+                batch[i, :lengths[i]] = x
+            return batch, lengths
+
+        for fname in fnames:
+            windows = self.get_file_windows(fname, keep_short=True)
+            if windows is None:
+                continue
+
+            # all windows from one file have the same length, so they share a bucket
+            bucket = buckets[np.searchsorted(bounds, windows.shape[1])]
+            bucket.extend(windows)
+            while len(bucket) >= self.batch_size:
+                yield make_batch(bucket[:self.batch_size])
+                del bucket[:self.batch_size]
 
+        for bucket in buckets:
+            if bucket:
+                yield make_batch(bucket)
+
+    def iter_window_chunks(self, fnames):
+        '''
+        yields arrays of recentered windows, of shape (n, seq_length, num_feats), gathered from
+        @gather_files files at a time.
+        '''
+        seq_range = np.arange(self.seq_length)
+        for i in range(0, len(fnames), self.gather_files):
+            flat, starts = self.get_window_index(fnames[i:i + self.gather_files])
+            windows = flat[starts[:, None] + seq_range]
+            windows[:, :, 0] -= windows[:, :, 0].min(1, keepdims=True)
+            yield windows
+
+    def iter_shuffled(self, fnames):
+        '''
+        yields batches (or single sequences, if batch_size is not set) drawn from the shuffle
+        buffer. a buffer larger than the windows of @fnames (the files of this DataLoader worker)
+        would never fill and only cost memory, so it is shrunk to fit them.
+        '''
+        draw_size = self.batch_size or 1
+        size = max(min(self.shuffle_buffer_size, self.num_windows(fnames)), draw_size)
+        if size < self.shuffle_buffer_size:
+            logging.info(f'shuffle buffer size {self.shuffle_buffer_size} is larger than the '
+                         f'{self.num_windows(fnames)} windows of this epoch; using {size} instead')
+        self.shuffle_buffer.resize(size)
+        if self.batch_size:
+            yield from self.shuffle_buffer.shuffle(self.iter_window_chunks(fnames), self.batch_size)
+        else:
+            file_windows = (self.get_file_windows(fname) for fname in fnames)
+            file_windows = (x for x in file_windows if x is not None)
+            for draw in self.shuffle_buffer.shuffle(file_windows, 1):
+                yield draw[0]
+        self.shuffle_buffer.log_fill_summary()
+
+    def iter_sequences(self, fnames):
+        '''
+        yields single sequences of shape (seq_length, num_feats), one file at a time.
+        '''
         # iterate through all given fnames, breaking them into chunks of seq_length...
-        for fname in self.fnames:
-            # x = self.f[fname]
-            x = self.f[self.fnames[0]]
-
-            # no need to use a custom factorization, just extract the relevant columns
-            # onset, duration, time to next onset, pitch, velocity, program
-            programs = self.simplify_programs(x[:, 5])
-            # notetuples = np.concatenate([x[:, 1:4], programs], 1)
-            notetuples = np.concatenate([x[:, [0, 2, 3, 4]], programs], 1)
-            notetuples = notetuples[:, :self.num_feats]
-
-            # pad runlength encoding on both sides
-            padded_nt = np.concatenate([
-                self.padding_seq,
-                notetuples,
-                self.padding_seq
-                ])
-
-            # figure out how many sequences we can get out of this
-            num_seqs = np.floor(padded_nt.shape[0] / self.seq_length)
+        for fname in fnames:
+            windows = self.get_file_windows(fname)
 
             # check if the current file is too short to be used with the seq_length desired
-            if num_seqs == 0:
+            if windows is None:
                 continue
 
-            remainder = padded_nt.shape[0] - (num_seqs * self.seq_length)
-            offset = np.random.randint(remainder + 1) if self.random_offsets else 0
-
             # return sequences of notes from each file, seq_length in length.
             # move to the next file when the current one has been exhausted.
-            for i in range(int(num_seqs)):
-                st = i * self.seq_length + offset
-                end = (i+1) * self.seq_length + offset
-                seq = padded_nt[st:end]
+            for seq in windows:
+                yield seq
+
+    def __iter__(self):
+        '''
+        Main iteration function.
+        '''
 
-                # recenter each individual batch to start at time = 0
-                min_time_offset = np.min(seq[:, 0])
-                seq[:, 0] -= min_time_offset
+        # when running in multiple DataLoader workers, each one takes a disjoint subset of files
+        fnames = list(self.fnames)
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            fnames = fnames[worker_info.id::worker_info.num_workers]
+            if self.resident_data is None and self.file_pid != os.getpid():
+                self.open_file()
 
-                yield seq
+        if self.shuffle_files:
+            np.random.shuffle(fnames)
+
+        if self.length_buckets:
+            yield from self.iter_bucketed(fnames)
+        elif self.shuffle_buffer is not None:
+            yield from self.iter_shuffled(fnames)
+        elif self.batch_size:
+            yield from self.iter_batches(fnames)
+        else:
+            yield from self.iter_sequences(fnames)
+
+        if self.cache is not None:
+            self.cache.log_summary()
 
 
 if __name__ == '__main__':
@@ -177,5 +740,14 @@ if __name__ == '__main__':
         if i > 2:
             break
 
+    # the same dataset yielding whole batches, skipping per-sample collation
+    dset.batch_size = 15
+    dload = DataLoader(dset, batch_size=None)
+    for i, x in enumerate(dload):
+        print(i, x.shape)
+        batches.append(x)
+        if i > 2:
+            break
+
 
 
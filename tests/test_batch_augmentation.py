@@ -0,0 +1,122 @@
+import h5py
+import pytest
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+import data_management.hdf5_helpers as h5h
+import data_management.make_synthetic_hdf5 as syn
+import data_augmentation.batch_augmentation as bat_aug
+import training_helper_functions as tr_funcs
+from point_set_dataloader import MidiNoteTupleDataset
+
+
+class PassThroughErrors(object):
+    '''
+    stands in for an ErrorGenerator: the input is the batch itself and the target is all zeros.
+    '''
+
+    def add_errors_to_batch(self, batch, num_errors, lengths=None):
+        return batch.numpy(), np.zeros(batch.shape[:2], dtype='float32')
+
+
+class PerNoteModel(torch.nn.Module):
+
+    def __init__(self, num_feats):
+        super().__init__()
+        self.linear = torch.nn.Linear(num_feats, 1)
+
+    def forward(self, x):
+        return self.linear(x)
+
+
+def make_quartet_dataset(path, num_songs=20, song_len=200):
+    '''
+    songs in the column layout of make_quartets_hdf5.py, with notes cycling through four voices.
+    '''
+    rng = np.random.RandomState(0)
+    columns = ['voice', 'onset', 'next_onset', 'duration', 'pitch', 'diatonic_pitch', 'accidental']
+    with h5py.File(path, 'w') as f:
+        grp = f.create_group('train')
+        for i in range(num_songs):
+            arr = np.zeros((song_len, len(columns)), dtype='int64')
+            arr[:, 0] = np.arange(song_len) % 4
+            arr[:, 1] = np.arange(song_len) // 4 * 12
+            arr[:, 2] = np.where(arr[:, 0] == 3, 12, 0)
+            arr[:, 3] = 12
+            arr[:, 4] = rng.randint(40, 80, song_len)
+            arr[:, 5] = arr[:, 4] // 2
+            h5h.create_note_dataset(grp, f'song_{i}', arr, columns)
+        h5h.write_length_index(f)
+
+
+def make_lmd_dataset(path, num_songs=10):
+    rng = np.random.RandomState(0)
+    arr, offsets = syn.make_notetuple_block(rng, num_songs, (100, 300))
+    with h5py.File(path, 'w') as f:
+        h5h.create_packed_group(f.create_group('train'), 'syn', arr, offsets, syn.note_columns)
+        h5h.write_length_index(f)
+
+
+def test_permute_voices_leaves_padding_alone():
+    batch = torch.tensor([[[0., 0, 60, 80, 2], [0., 0, 0, 0, 0]]]).repeat(16, 1, 1)
+    out = bat_aug.permute_voices(batch, voice_col=4, num_voices=4, pitch_col=2)
+    assert (out[:, 1] == 0).all()
+    assert set(out[:, 0, 4].tolist()) <= {0., 1., 2., 3.}
+    assert len(set(out[:, 0, 4].tolist())) > 1
+
+
+def test_augmentation_finds_features_by_column_name(tmp_path):
+    path = str(tmp_path / 'quartets.hdf5')
+    make_quartet_dataset(path)
+    dset = MidiNoteTupleDataset(path, 64, num_feats=4, base='train', estimate_stats_batches=0)
+    assert dset.feature_names == ['voice', 'next_onset', 'duration', 'pitch']
+
+    batch = torch.from_numpy(dset.get_file_windows(dset.fnames[0]))
+    out = dset.make_augmentation(max_transpose=5)(batch)
+    assert torch.equal(batch[..., :3], out[..., :3])
+
+    out = dset.make_augmentation(max_time_stretch=2)(batch)
+    assert torch.equal(batch[..., [0, 3]], out[..., [0, 3]])
+
+
+def test_voice_permutation_needs_a_voice_feature(tmp_path):
+    path = str(tmp_path / 'lmd.hdf5')
+    make_lmd_dataset(path)
+    dset = MidiNoteTupleDataset(path, 64, num_feats=5, base='train', estimate_stats_batches=0)
+    assert dset.feature_names[:4] == ['onset', 'next_onset', 'pitch', 'velocity']
+    with pytest.raises(ValueError):
+        dset.make_augmentation(permute_voices=True)
+
+
+def test_permute_voices_runs_in_run_epoch(tmp_path):
+    path = str(tmp_path / 'quartets.hdf5')
+    make_quartet_dataset(path)
+    dset = MidiNoteTupleDataset(path, 64, num_feats=4, base='train', batch_size=8,
+                                estimate_stats_batches=0)
+    augment = dset.make_augmentation(permute_voices=True)
+    assert augment is not None
+
+    seen = []
+
+    def recording_augment(batch):
+        out = augment(batch)
+        seen.append((batch, out))
+        return out
+
+    model = PerNoteModel(4)
+    optimizer = torch.optim.SGD(model.parameters(), lr=0.01)
+    criterion = torch.nn.BCEWithLogitsLoss()
+    loss, _ = tr_funcs.run_epoch(model, DataLoader(dset, batch_size=None), optimizer, criterion,
+                                 PassThroughErrors(), augment=recording_augment)
+
+    assert np.isfinite(loss)
+    assert seen
+    changed = False
+    for batch, out in seen:
+        # only the voices of notes are touched, and stay valid voices
+        assert torch.equal(batch[..., 1:], out[..., 1:])
+        is_note = batch[..., 3] > 0
+        assert torch.equal(batch[..., 0][~is_note], out[..., 0][~is_note])
+        assert set(out[..., 0][is_note].unique().tolist()) <= {0., 1., 2., 3.}
+        changed |= not torch.equal(batch, out)
+    assert changed
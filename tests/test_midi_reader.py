@@ -0,0 +1,34 @@
+import numpy as np
+import data_management.midi_reader as mr
+
+
+def midi_file(path, tracks, division=480):
+    header = b'MThd' + (6).to_bytes(4, 'big') + (1).to_bytes(2, 'big') + \
+        len(tracks).to_bytes(2, 'big') + division.to_bytes(2, 'big')
+    chunks = [b'MTrk' + len(t).to_bytes(4, 'big') + t for t in tracks]
+    with open(path, 'wb') as f:
+        f.write(header + b''.join(chunks))
+    return str(path)
+
+
+end_of_track = b'\x00\xff\x2f\x00'
+
+
+def test_no_tracks(tmp_path):
+    notes, beats = mr.read_midi(midi_file(tmp_path / 'empty.mid', []))
+    assert notes.shape == (0, len(mr.note_columns))
+    assert len(beats) == 0
+
+
+def test_empty_track(tmp_path):
+    notes, beats = mr.read_midi(midi_file(tmp_path / 'eot.mid', [end_of_track]))
+    assert notes.shape == (0, len(mr.note_columns))
+    assert len(beats) == 0
+
+
+def test_one_note_at_default_tempo(tmp_path):
+    # program 40 on channel 0, then middle c for one quarter note, at the default 120 bpm
+    track = b'\x00\xc0\x28' + b'\x00\x90\x3c\x64' + b'\x83\x60\x80\x3c\x00' + end_of_track
+    notes, beats = mr.read_midi(midi_file(tmp_path / 'note.mid', [track]))
+    np.testing.assert_allclose(notes, [[40, 0, 0.5, 60, 100, 0]])
+    np.testing.assert_allclose(beats, [0])
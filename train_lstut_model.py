@@ -12,6 +12,7 @@ import plot_outputs as po
 import model_params
 import logging
 import argparse
+from functools import partial
 
 import matplotlib
 matplotlib.use('Agg')
@@ -48,6 +49,13 @@ dset_tr = dl.MidiNoteTupleDataset(
     num_feats=params.num_feats,
     padding_amt=params.padding_amt,
     dataset_proportion=params.dataset_proportion,
+    subset_seed=params.subset_seed,
+    batch_size=params.batch_size,
+    shuffle_buffer_size=params.shuffle_buffer_size,
+    length_buckets=params.length_buckets,
+    cache_mb=params.cache_mb,
+    resident=params.resident,
+    min_length=params.min_length,
 )
 dset_vl = dl.MidiNoteTupleDataset(
     dset_fname=params.dset_path,
@@ -56,12 +64,25 @@ dset_vl = dl.MidiNoteTupleDataset(
     num_feats=params.num_feats,
     padding_amt=params.padding_amt,
     dataset_proportion=params.dataset_proportion,
+    subset_seed=params.subset_seed,
+    batch_size=params.batch_size,
+    length_buckets=params.length_buckets,
+    cache_mb=params.cache_mb,
+    resident=params.resident,
+    min_length=params.min_length,
     use_stats_from=dset_tr)
 
+# augmentation is only applied to training batches
+augment = dset_tr.make_augmentation(params.max_transpose, params.max_time_stretch, params.permute_voices)
+
 error_generator = err_gen.ErrorGenerator(ngram=5, models_fpath=params.error_model)
 
-dloader = DataLoader(dset_tr, params.batch_size, pin_memory=True)
-dloader_val = DataLoader(dset_vl, params.batch_size, pin_memory=True)
+# datasets yield whole batches, so the dataloader shouldn't collate them. workers persist across
+# epochs, keeping their song caches, shuffle buffers and open hdf5 files.
+loader_kwargs = {'batch_size': None, 'pin_memory': True, 'num_workers': params.num_workers,
+                 'persistent_workers': params.num_workers > 0}
+dloader = DataLoader(dset_tr, **loader_kwargs)
+dloader_val = DataLoader(dset_vl, **loader_kwargs)
 num_feats = dset_tr.num_feats
 
 model = lstut.LSTUT(**params.lstut_settings).to(device)
@@ -90,6 +111,10 @@ if dry_run:
 for epoch in range(params.num_epochs):
     epoch_start_time = time.time()
 
+    # per-phase step timing, which does nothing unless profile_steps is set
+    train_timer = tr_funcs.StepTimer(enabled=params.profile_steps)
+    val_timer = tr_funcs.StepTimer(enabled=params.profile_steps)
+
     # perform training epoch
     model.train()
     train_loss, tr_exs = tr_funcs.run_epoch(
@@ -100,7 +125,12 @@ for epoch in range(params.num_epochs):
         device=device,
         example_generator=error_generator,
         train=True,
-        log_each_batch=False
+        log_each_batch=False,
+        prefetch=params.prefetch,
+        augment=augment,
+        timer=train_timer,
+        log_step=partial(params.log_metrics, 'step', epoch=epoch),
+        log_every=params.log_metrics_every
     )
 
     # test on validation set
@@ -116,7 +146,9 @@ for epoch in range(params.num_epochs):
             device=device,
             example_generator=error_generator,
             train=False,
-            log_each_batch=False
+            log_each_batch=False,
+            prefetch=params.prefetch,
+            timer=val_timer
         )
 
     val_losses.append(val_loss)
@@ -138,6 +170,21 @@ for epoch in range(params.num_epochs):
         f'tr_f1      {tr_f1:1.6f} | '
         f'val_f1     {val_f1:1.6f} | '
     )
+    train_timer.log_summary(f'epoch {epoch:3d} train')
+    val_timer.log_summary(f'epoch {epoch:3d} val')
+    params.log_metrics(
+        'epoch',
+        epoch=epoch,
+        s_per_epoch=epoch_end_time - epoch_start_time,
+        train_loss=train_loss,
+        val_loss=val_loss,
+        tr_thresh=tr_thresh,
+        tr_f1=tr_f1,
+        val_f1=val_f1,
+        lr=optimizer.param_groups[0]['lr'],
+        train_timing=train_timer.summary() if params.profile_steps else None,
+        val_timing=val_timer.summary() if params.profile_steps else None,
+    )
 
     # save an image
     if not epoch % params.save_img_every and epoch > 0:
@@ -107,6 +107,14 @@ for epoch in range(params.num_epochs):
         f's/epoch {(epoch_end_time - epoch_start_time):3.5f} | '
         f'train_loss {log_train_loss:2.7f} | '
         f'val_loss {log_val_loss:2.7f} ')
+    params.log_metrics(
+        'epoch',
+        epoch=epoch,
+        s_per_epoch=epoch_end_time - epoch_start_time,
+        train_loss=log_train_loss,
+        val_loss=log_val_loss,
+        lr=optimizer.param_groups[0]['lr'],
+    )
 
     # save an image
     if not epoch % params.save_img_every and epoch > 0:
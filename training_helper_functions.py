@@ -1,5 +1,8 @@
+import time
 import torch
 import logging
+import threading
+import queue
 import numpy as np
 import plot_outputs as po
 
@@ -28,8 +31,255 @@ def log_gpu_info():
 #     return errored_input, error_locs
 
 
+class StepTimer(object):
+    '''
+    Records the wall time spent in each phase of every training step, to find out what an epoch
+    is bound by. phases are timed as laps: lap(phase) records the time since the previous lap (or
+    since start()) made in the same thread, so batches prepared in a background thread are timed
+    separately from the training loop. the epoch runs from begin() to stop(), which run_epoch
+    calls around its loop. if @synchronize is set and cuda is available, each lap made in the
+    thread that called begin() first waits for all queued cuda work, so that it is charged to the
+    phase that queued it, at the cost of stalling the gpu between phases. a disabled timer does
+    nothing.
+    '''
+
+    def __init__(self, enabled=True, synchronize=True):
+        self.enabled = enabled
+        self.synchronize = synchronize and torch.cuda.is_available()
+        self.times = {}
+        self.num_samples = 0
+        self.clock = threading.local()
+        self.sync_thread = threading.get_ident()
+        self.start_time = time.perf_counter()
+        self.elapsed = None
+
+    def begin(self):
+        '''
+        starts the epoch window from the calling thread, which is the only one that synchronizes.
+        '''
+        self.sync_thread = threading.get_ident()
+        self.start_time = time.perf_counter()
+        self.elapsed = None
+        self.start()
+
+    def stop(self):
+        '''
+        ends the epoch window, so that a later summary() doesn't count time spent after it.
+        '''
+        self.elapsed = time.perf_counter() - self.start_time
+
+    def start(self):
+        if self.enabled:
+            self.clock.last = time.perf_counter()
+
+    def lap(self, phase):
+        if not self.enabled:
+            return
+        # a background thread waiting on the device would also charge the training loop's
+        # queued work to its own phases
+        if self.synchronize and threading.get_ident() == self.sync_thread:
+            torch.cuda.synchronize()
+        now = time.perf_counter()
+        self.times.setdefault(phase, []).append(now - self.clock.last)
+        self.clock.last = now
+
+    def count(self, num_samples):
+        self.num_samples += num_samples
+
+    def summary(self):
+        '''
+        the median, 95th percentile and total time of each phase in seconds, along with the wall
+        time from begin() to stop() (or until now, if not stopped) and the number of samples per
+        second over it.
+        '''
+        elapsed = self.elapsed
+        if elapsed is None:
+            elapsed = time.perf_counter() - self.start_time
+        phases = {}
+        for phase, times in self.times.items():
+            p50, p95 = np.percentile(times, [50, 95])
+            phases[phase] = {'p50': float(p50), 'p95': float(p95), 'total': float(np.sum(times)),
+                             'steps': len(times)}
+        return {'elapsed': elapsed, 'samples': self.num_samples,
+                'samples_per_s': self.num_samples / elapsed, 'phases': phases}
+
+    def log_summary(self, name):
+        if not self.enabled:
+            return
+        s = self.summary()
+        phases = ' | '.join(
+            f"{phase} {x['p50'] * 1000:.2f}/{x['p95'] * 1000:.2f} ms ({x['total'] / s['elapsed']:.0%})"
+            for phase, x in s['phases'].items())
+        logging.info(f"{name} timing (p50/p95 per step, share of epoch) | "
+                     f"{s['samples_per_s']:.1f} samples/s | {phases}")
+
+
+def prepare_batch(batch, example_generator, augment=None, timer=None):
+    '''
+    augments a batch from a dataloader with @augment, if given, then adds errors to it, returning
+    the augmented batch, the true lengths of its sequences (or None) and the errored input and
+    target as numpy arrays. if @timer is given, records the time spent waiting for the batch
+    ('load'), augmenting it and adding errors to it ('corrupt').
+    '''
+    if timer is not None:
+        timer.lap('load')
+
+    # length-bucketed datasets yield the true length of each sequence along with the batch
+    lengths = None
+    if type(batch) in (list, tuple):
+        batch, lengths = batch
+
+    batch = batch.float()
+    if augment is not None:
+        batch = augment(batch)
+        if timer is not None:
+            timer.lap('augment')
+    batch = batch.cpu()
+    inp, target = example_generator.add_errors_to_batch(batch, 1, lengths=lengths)
+    if timer is not None:
+        timer.lap('corrupt')
+    return batch, lengths, inp, target
+
+
+class BatchPrefetcher(object):
+    '''
+    Prepares up to @num_prefetch batches ahead of the training loop in a background thread:
+    fetching them from the dataloader, adding errors, and moving them to @device. numpy outputs
+    are wrapped without copying. on a cuda device they are then copied into reused pinned buffers
+    and transferred with non-blocking copies on a side stream, so that transfers overlap with
+    computation on the default stream. on cpu, this just overlaps batch preparation with
+    computation. if a StepTimer @timer is given, the background thread records its load,
+    augment and corrupt phases and the time spent staging batches on the device ('staging').
+    close() stops the thread if the consumer stops iterating early.
+    '''
+
+    def __init__(self, dloader, example_generator, device='cpu', num_prefetch=2, augment=None,
+                 timer=None):
+        self.dloader = dloader
+        self.example_generator = example_generator
+        self.augment = augment
+        self.timer = timer
+        self.device = torch.device(device)
+        self.num_prefetch = num_prefetch
+        self.use_cuda = self.device.type == 'cuda'
+        self.stream = torch.cuda.Stream(self.device) if self.use_cuda else None
+
+        # one set of pinned buffers per slot. a slot is only reused after num_prefetch + 2 more
+        # batches have been staged, by which point its transfer has long been consumed.
+        self.num_slots = num_prefetch + 2
+        self.pinned = {}
+        self.slot_events = [None] * self.num_slots
+
+        self.stop_event = threading.Event()
+        self.queue = None
+        self.thread = None
+
+    def to_device(self, arr, slot, name):
+        t = torch.from_numpy(arr)
+        if not self.use_cuda:
+            return t.to(self.device)
+
+        buf = self.pinned.get((slot, name))
+        if buf is None or buf.shape != t.shape or buf.dtype != t.dtype:
+            buf = torch.empty(t.shape, dtype=t.dtype).pin_memory()
+            self.pinned[(slot, name)] = buf
+        buf.copy_(t)
+        with torch.cuda.stream(self.stream):
+            return buf.to(self.device, non_blocking=True)
+
+    def put(self, q, item):
+        '''
+        puts @item on @q, waiting for space until the consumer stops. returns False if it did.
+        '''
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def producer(self, q):
+        if self.timer is not None:
+            self.timer.start()
+        try:
+            for i, batch in enumerate(self.dloader):
+                batch, lengths, inp, target = prepare_batch(batch, self.example_generator, self.augment,
+                                                            self.timer)
+
+                slot = i % self.num_slots
+                if self.slot_events[slot] is not None:
+                    self.slot_events[slot].synchronize()
+
+                inp = self.to_device(inp, slot, 'inp')
+                target = self.to_device(target, slot, 'target')
+
+                event = None
+                if self.use_cuda:
+                    event = torch.cuda.Event()
+                    event.record(self.stream)
+                    self.slot_events[slot] = event
+                if self.timer is not None:
+                    self.timer.lap('staging')
+                if not self.put(q, (batch, lengths, inp, target, event)):
+                    return
+
+                # time spent blocked on a full queue isn't part of any phase
+                if self.timer is not None:
+                    self.timer.start()
+        except Exception as e:
+            self.put(q, e)
+            return
+        self.put(q, None)
+
+    def close(self):
+        '''
+        stops the background thread, dropping any batches it has prepared, and waits for it to
+        exit. called when iteration ends, including when the consumer stops early.
+        '''
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        while self.thread.is_alive():
+            try:
+                while True:
+                    self.queue.get_nowait()
+            except queue.Empty:
+                pass
+            self.thread.join(timeout=0.1)
+        self.thread = None
+        self.queue = None
+
+    def __iter__(self):
+        self.close()
+        self.stop_event = threading.Event()
+        self.queue = queue.Queue(maxsize=self.num_prefetch)
+        self.thread = threading.Thread(target=self.producer, args=(self.queue,), daemon=True)
+        self.thread.start()
+
+        try:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                elif isinstance(item, Exception):
+                    raise item
+
+                batch, lengths, inp, target, event = item
+                if event is not None:
+                    # make the compute stream wait for the transfer, and stop the allocator from
+                    # reusing this memory while the compute stream is still using it
+                    torch.cuda.current_stream(self.device).wait_event(event)
+                    inp.record_stream(torch.cuda.current_stream(self.device))
+                    target.record_stream(torch.cuda.current_stream(self.device))
+                yield batch, lengths, inp, target
+        finally:
+            self.close()
+
+
 def run_epoch(model, dloader, optimizer, criterion, example_generator, device='cpu',
-              train=True, log_each_batch=False, clip_grad_norm=0.5, autoregressive=False):
+              train=True, log_each_batch=False, clip_grad_norm=0.5, autoregressive=False, prefetch=0,
+              augment=None, timer=None, log_step=None, log_every=0):
     '''
     Performs a training or validation epoch.
     @model: the model to use.
@@ -42,41 +292,79 @@ def run_epoch(model, dloader, optimizer, criterion, example_generator, device='c
     @log_each_batch: if true, logs information about each batch's loss / time elapsed.
     @autoregressive: if true, feeds the target into the model along with the input, for
         autoregressive teacher forcing.
+    @prefetch: if nonzero, prepares this many batches ahead in a background thread, overlapping
+        error generation and host-to-device transfers with the forward and backward passes.
+    @augment: if given, a function applied to each whole batch before errors are added, such as
+        one made by a dataset's make_augmentation.
+    @timer: if given, a StepTimer that records the time of each phase of each step: waiting for
+        a prepared batch ('data'), the host-to-device copy, the forward pass and loss, the
+        backward pass, the optimizer step and the loss bookkeeping ('metrics'), along with the
+        phases of preparing each batch, which happen in the background when prefetching.
+    @log_step: if given along with @log_every, called as log_step(step=i, loss=mean loss) after
+        every @log_every batches, e.g. with a Params object's log_metrics.
     '''
     num_seqs_used = 0
     total_loss = 0.
+    if timer is None:
+        timer = StepTimer(enabled=False)
 
-    for i, batch in enumerate(dloader):
+    if prefetch:
+        batches = BatchPrefetcher(dloader, example_generator, device, prefetch, augment, timer)
+    else:
+        batches = (prepare_batch(batch, example_generator, augment, timer) for batch in dloader)
 
-        batch = batch.float().cpu()
-        inp, target = example_generator.add_errors_to_batch(batch, 1)
+    # the prefetcher's thread is stopped even if the loop exits early
+    timer.begin()
+    try:
+        for i, (batch, lengths, inp, target) in enumerate(batches):
+            timer.lap('data')
 
-        # batch = batch.to(device)
-        inp = torch.tensor(inp, device=device)
-        target = torch.tensor(target, device=device)
+            # batch = batch.to(device)
+            inp = torch.as_tensor(inp, device=device)
+            target = torch.as_tensor(target, device=device)
+            timer.lap('transfer')
 
-        if train:
-            optimizer.zero_grad()
+            if train:
+                optimizer.zero_grad()
 
-        if autoregressive:
-            output = model(inp, target)
-        else:
-            output = model(inp)
+            if autoregressive:
+                output = model(inp, target)
+            elif lengths is not None:
+                output = model(inp, lengths.to(device))
+            else:
+                output = model(inp)
 
-        loss = criterion(output.squeeze(-1), target)
+            if lengths is None:
+                loss = criterion(output.squeeze(-1), target)
+            else:
+                # padded positions don't contribute to the loss
+                not_padding = torch.arange(target.shape[1], device=device)[None, :] < lengths.to(device)[:, None]
+                loss = criterion(output.squeeze(-1)[not_padding], target[not_padding])
+            timer.lap('forward')
 
-        if train:
-            loss.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
-            optimizer.step()
+            if train:
+                loss.backward()
+                torch.nn.utils.clip_grad_norm_(model.parameters(), clip_grad_norm)
+                timer.lap('backward')
+                optimizer.step()
+                timer.lap('optimizer')
 
-        batch_loss = loss.sum().item()
-        total_loss += batch_loss
-        num_seqs_used += target.numel()
+            batch_loss = loss.sum().item()
+            num_entries = target.numel() if lengths is None else int(lengths.sum())
+            total_loss += batch_loss
+            num_seqs_used += num_entries
+            timer.count(inp.shape[0])
 
-        if log_each_batch:
-            log_loss = (batch_loss / target.numel())
-            logging.info(f'    batch {i}, loss {log_loss:2.7f}')
+            if log_each_batch:
+                log_loss = (batch_loss / num_entries)
+                logging.info(f'    batch {i}, loss {log_loss:2.7f}')
+            if log_step is not None and log_every and not (i + 1) % log_every:
+                log_step(step=i, loss=batch_loss / num_entries)
+            timer.lap('metrics')
+    finally:
+        if prefetch:
+            batches.close()
+        timer.stop()
 
     mean_loss = total_loss / num_seqs_used
     example_dict = {'orig': batch, 'input': inp, 'target': target, 'output': output}